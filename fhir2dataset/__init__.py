@@ -1,12 +1,21 @@
 import re
+from typing import List, Union
 
 import pandas as pd
 
+from fhir2dataset.batch import QueryBatch  # noqa
 from fhir2dataset.fhirrules import FHIRRules  # noqa
 from fhir2dataset.parser import Parser  # noqa
 from fhir2dataset.query import Query  # noqa
 
 
+def _rename_columns(df: pd.DataFrame) -> pd.DataFrame:
+    # rename the columns to match the sql syntax, in place to avoid copying the data
+    # patient:Patient.name.given -> patient.name.given
+    df.columns = [re.sub(r"\:\w+\.", ".", column) for column in df.columns]
+    return df
+
+
 def sql(sql_query: str, fhir_api_url: str = None, token: str = None) -> pd.DataFrame:
     """Interpret a SQL-like query and query a FHIR api
 
@@ -21,7 +30,27 @@ def sql(sql_query: str, fhir_api_url: str = None, token: str = None) -> pd.DataF
     config = Parser().from_sql(sql_query)
     query = Query(fhir_api_url=fhir_api_url, token=token).from_config(config)
     df = query.execute()
-    # rename the columns to match the sql syntax
-    # patient:Patient.name.given -> patient.name.given
-    df = df.rename(lambda x: re.sub("\:\w+\.", ".", x), axis="columns")  # noqa
-    return df
+    return _rename_columns(df)
+
+
+def sql_batch(
+    sql_queries: List[Union[str, dict]], fhir_api_url: str = None, token: str = None
+) -> List[pd.DataFrame]:
+    """Interpret several SQL-like queries and query a FHIR api. The searches shared by several
+    queries (same alias resource type and same filters) are only fetched once.
+
+    Arguments:
+        sql_queries (list): queries in a SQL-like syntax or dictionaries in the format of
+            a configuration file
+        fhir_api_url (str): the base url of the FHIR server (e.g. http://hapi.fhir.org/baseR4/)
+        token (str): a Bearer Auth token
+
+    Returns:
+        list: the result of each query in a tabular format, in the same order as sql_queries
+    """  # noqa
+    configs = [
+        Parser().from_sql(sql_query) if isinstance(sql_query, str) else sql_query
+        for sql_query in sql_queries
+    ]
+    batch = QueryBatch(fhir_api_url=fhir_api_url, token=token).from_configs(configs)
+    return [_rename_columns(df) for df in batch.execute()]
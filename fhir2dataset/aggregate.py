@@ -0,0 +1,157 @@
+import json
+import logging
+import threading
+from typing import Dict, List
+
+import pandas as pd
+
+from fhir2dataset.data_class import Aggregate
+from fhir2dataset.tools.dataframe import first_value
+
+logger = logging.getLogger(__name__)
+
+# function used to combine the partial results of an aggregate computed on different pages
+PARTIAL_FUNCTIONS = {"count": "sum", "min": "min", "max": "max", "sum": "sum"}
+
+# key used to group all the rows together when there is no GROUP BY
+ALL_ROWS_KEY = "_all_rows"
+
+
+def _hashable(value):
+    """Returns a hashable version of a cell value so that it can be used as a group key"""
+    value = first_value(value)
+    if isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+class GroupByAggregator:
+    """Computes aggregates per group incrementally, one dataframe (e.g. one page of resources)
+    at a time. Only the partial aggregates of each group are kept between two dataframes, so
+    the memory used is proportional to the number of groups, not to the number of rows
+    (except for COUNT(DISTINCT ...) which keeps the distinct values of each group).
+
+    Lists in the aggregated columns are exploded: each of their values is aggregated. Lists in
+    the group keys are replaced by their first value.
+
+    Attributes:
+        keys (list): names of the columns of the group keys
+        aggregates (dict): the key is the name of the aggregate and the value the Aggregate
+        columns (dict): the key is the name of the aggregate and the value the name of the
+            aggregated column (None for COUNT(*))
+        partials (dict): the key is the name of the aggregate and the value a dataframe of
+            its partial value for each group (or, for a COUNT(DISTINCT ...), of the distinct
+            (group keys, value) pairs seen so far)
+    """  # noqa
+
+    def __init__(self, keys: List[str], aggregates: Dict[str, Aggregate], columns: Dict[str, str]):
+        self.keys = keys or [ALL_ROWS_KEY]
+        self.aggregates = aggregates
+        self.columns = columns
+
+        self.partials = {}
+
+    def update(self, df: pd.DataFrame):
+        """Adds the rows of df to the aggregates
+
+        Arguments:
+            df (pd.DataFrame): dataframe containing the group keys and the aggregated columns
+        """
+        if len(df) == 0:
+            return
+
+        keys = pd.DataFrame(index=df.index)
+        for key in self.keys:
+            keys[key] = 0 if key == ALL_ROWS_KEY else df[key].map(_hashable)
+
+        for name, aggregate in self.aggregates.items():
+            column = self.columns[name]
+            if column is None:
+                values = pd.Series(1, index=df.index, name=name)
+            else:
+                values = df[column]
+                if isinstance(values.dtype, pd.CategoricalDtype):  # e.g. the ids
+                    values = values.astype(object)
+                values = values.explode().rename(name)
+                if aggregate.function == "sum":
+                    values = pd.to_numeric(values, errors="coerce")
+                elif aggregate.function == "count" and not aggregate.distinct:
+                    values = values.notna().astype(int)
+            frame = keys.join(values).dropna(subset=[name])
+            frame[name] = frame[name].map(_hashable)
+
+            partial = self.partials.get(name)
+            if partial is not None:
+                frame = pd.concat([partial, frame])
+            if aggregate.distinct:
+                self.partials[name] = frame.drop_duplicates()
+            else:
+                self.partials[name] = (
+                    frame.groupby(self.keys, dropna=False)[name]
+                    .agg(PARTIAL_FUNCTIONS[aggregate.function])
+                    .reset_index()
+                )
+
+    def result(self) -> pd.DataFrame:
+        """Returns the aggregates of each group
+
+        Returns:
+            pd.DataFrame: a table with the group keys and a column per aggregate
+        """
+        result = None
+        for name, aggregate in self.aggregates.items():
+            partial = self.partials.get(name)
+            if partial is None:
+                continue
+            if aggregate.distinct:
+                partial = partial.groupby(self.keys, dropna=False)[name].nunique().reset_index()
+            result = partial if result is None else result.merge(partial, on=self.keys, how="outer")
+
+        if result is None:
+            result = pd.DataFrame(columns=self.keys)
+        if self.keys == [ALL_ROWS_KEY] and len(result) == 0:
+            # aggregates over no rows still return a row
+            result = pd.DataFrame({ALL_ROWS_KEY: [0]})
+
+        for name, aggregate in self.aggregates.items():
+            if name not in result.columns:
+                result[name] = None
+            if aggregate.function == "count":
+                result[name] = result[name].fillna(0).astype(int)
+
+        columns = [key for key in self.keys if key != ALL_ROWS_KEY] + list(self.aggregates)
+        return result[columns].reset_index(drop=True)
+
+
+class DistinctResourcesAggregator:
+    """Aggregator shared by the searches a search is split into, which are paged in parallel:
+    the rows of the resources already aggregated (a resource can match several of the
+    searches) are dropped before the wrapped aggregator is updated, so that only the ids of the
+    resources are kept in memory, not their rows.
+
+    Attributes:
+        aggregator (GroupByAggregator): the aggregator updated with the rows of each resource
+            once
+        ids (set): the ids of the resources aggregated so far
+    """  # noqa
+
+    def __init__(self, aggregator: GroupByAggregator):
+        self.aggregator = aggregator
+        self.ids = set()
+        self._lock = threading.Lock()
+
+    def update(self, df: pd.DataFrame):
+        """Adds the rows of df to the aggregates, except the ones of the resources already
+        aggregated
+
+        Arguments:
+            df (pd.DataFrame): dataframe containing the from_id column, the group keys and the
+                aggregated columns
+        """  # noqa
+        with self._lock:
+            if "from_id" in df.columns:
+                # the rows of a resource in df are kept together
+                aggregated = df["from_id"].isin(self.ids)
+                self.ids.update(df["from_id"])
+                df = df[~aggregated]
+            self.aggregator.update(df)
@@ -1,50 +1,58 @@
+import json
 import logging
 import multiprocessing
 import pprint
+import re
+import sys
+from collections import deque
+from contextlib import contextmanager
 from json import JSONDecodeError
-from typing import List, Optional
+from multiprocessing.pool import ThreadPool
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import requests
 
 # from fhir2dataset.fhirpath import fhirpath_processus_tree
+from fhir2dataset.aggregate import DistinctResourcesAggregator
+from fhir2dataset.checkpoint import Checkpoint
 from fhir2dataset.data_class import Elements
+from fhir2dataset.tools.dataframe import (
+    drop_duplicate_resources,
+    expand_columns,
+    explode_rows,
+    sort_dataframe,
+)
 from fhir2dataset.tools.progressbar import progressbar
+from fhir2dataset.url_builder import MAX_URL_LENGTH, add_url_param, split_url
 
 logger = logging.getLogger(__name__)
 
 PAGE_SIZE = 100  # Return maximum 300 entities per query
+PARALLEL_SUB_REQUESTS = 4  # Number of sub requests of a too long url made in parallel
+SHARD_PROBES = 4  # maximum number of count requests per shard to balance the shards
+MAX_BATCH_SIZE = 50  # maximum number of searches grouped into a Bundle of type batch
 
+JSON_DECODER = json.JSONDecoder()
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+EMPTY_JSON_ARRAY = re.compile(r"\[[ \t\n\r]*\]")
 
-# def concat_cell(dataset, cols_name, element):
-#     # column of one row, this single cell is of the same type as element.value, i.e. a list
-#     if element.value == []:
-#         element.value = [None]
-#     column = [element.value]
-#     dataset.append(column)
-#     cols_name.append(element.col_name)
-#     return dataset, cols_name
-#
-#
-# def concat_col(dataset, cols_name, element):
-#     for index, value in enumerate(element.value):
-#         # column of one row, this single cell is of the same type as value
-#         column = [value]
-#         dataset.append(column)
-#         cols_name.append(f"{element.col_name}_{index}")
-#     return dataset, cols_name
-#
-#
-# def concat_row(dataset, cols_name, element):
-#     # column of x=len(element.value) rows
-#     column = element.value
-#     dataset.append(column)
-#     cols_name.append(element.col_name)
-#     return dataset, cols_name
-#
-#
-# MAPPING_CONCAT = {"cell": concat_cell, "col": concat_col, "row": concat_row}
+
+@contextmanager
+def null_context():
+    """Context returning None, as contextlib.nullcontext which doesn't exist in Python 3.6"""
+    yield None
+
+
+def concat_cell(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    # the values of a resource stay in a single cell, as a list if there are several
+    return df
+
+
+# functions building the columns of an element from the column of the values extracted
+# from the resources of a page, according to the concatenation type of the element
+MAPPING_CONCAT = {"cell": concat_cell, "col": expand_columns, "row": explode_rows}
 
 
 def process_function(token, url):
@@ -57,13 +65,34 @@ def process_function(token, url):
     return response.json()
 
 
+def extract_page(elements: Elements, content: bytes) -> Dict[str, np.ndarray]:
+    """
+    Extract the elements from the raw json of a page of resources.
+    Function called by the worker processes when the pages are extracted in parallel: the
+    columns are returned as arrays, in the order of the columns, to be put back together in a
+    dataframe by the calling process. The arrays are pickled to the calling process, there is
+    no zero-copy transfer: their values are mostly python objects (strings, lists and dicts of
+    the json), which can't be shared without being serialized
+    """
+    results = json.loads(content).get("entry") or []
+    df = ApiRequest(url=None, elements=elements)._get_data(results)
+    return {column: values.to_numpy() for column, values in df.items()}
+
+
 class Response:
     """class that contains the data retrieves from an url"""
 
-    def __init__(self, total: int = None, results: List = None, next_url: str = None):
+    def __init__(
+        self,
+        total: int = None,
+        results: List = None,
+        next_url: str = None,
+        content: bytes = None,
+    ):
         self.total: Optional[int] = total
         self.results: List = results
         self.next_url: Optional[str] = next_url
+        self.content: Optional[bytes] = content  # the raw json of the response
 
 
 class BearerAuth(requests.auth.AuthBase):
@@ -84,46 +113,192 @@ class ApiCall:
     Attributes:
         url (str): the url of the api to call
         auth (BearerAuth): (optional) a bearer toke if necessary
+        post_search (bool): if true, the searches whose url is too long are sent with
+            POST [type]/_search and their parameters in a form-encoded body, in a single request
     """  # noqa
 
-    def __init__(self, url: str, token: str = None):
+    def __init__(self, url: str, token: str = None, post_search: bool = False):
         self.url = url
         self.auth = BearerAuth(token)
+        self.post_search = post_search
 
     @progressbar
-    def _get_response(self, url: str) -> Response:
-        logger.info(f"Get {url}")
+    def _get_response(self, url: str, entries: bool = True) -> Response:
+        """Requests a page of a search
 
-        url = self.__fix_url(url)
+        Arguments:
+            url (str): the url of the page
+            entries (bool): if false, the entries of the Bundle are not decoded when its
+                total and links can be read without them (see _bundle_header): the results
+                attribute of the response is then None, the entries being left in its content,
+                e.g. to be decoded by a worker process
 
-        response = requests.get(url, auth=self.auth)
+        Returns:
+            Response: the total, the resources, the next url and the raw json of the page
+        """  # noqa
+        url = self.__fix_url(url)
 
-        failed = False
-        try:
-            response_content = response.json()
-            # One of these entries should be found
-            if "entry" not in response_content and "total" not in response_content:
-                failed = True
-        except JSONDecodeError:
-            failed = True
-
-        if not failed:
-            results = response_content.get("entry")
-            links = response_content.get("link", [])
-            next_pages = [link["url"] for link in links if link["relation"] == "next"]
-
-            response = Response(
-                total=response_content.get("total", 0),
-                results=results,
-                next_url=next_pages[0] if next_pages and results else None,
+        if self.post_search and len(url) > MAX_URL_LENGTH:
+            path, _, params = url.partition("?")
+            logger.info(f"Post {path}/_search with {params}")
+            response = requests.post(
+                f"{path}/_search",
+                data=params.encode(),
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                auth=self.auth,
             )
-            return response
         else:
+            logger.info(f"Get {url}")
+            response = requests.get(url, auth=self.auth)
+
+        try:
+            parsed_response = None if entries else self._bundle_header(response.content)
+            if parsed_response is None:
+                parsed_response = self._bundle_response(response.json())
+        except (JSONDecodeError, UnicodeDecodeError):
+            parsed_response = None
+
+        if parsed_response is None:
             raise ValueError(
                 f"Request: {url}\n"
                 f"Status code of failing response: {response.status_code}\n"
                 f"Content of the failing response:\n{pprint.pformat(response.__dict__)}"
             )
+        parsed_response.content = response.content
+        return parsed_response
+
+    @staticmethod
+    def _bundle_response(response_content: dict) -> Optional[Response]:
+        """Reads the Bundle returned by a search
+
+        Arguments:
+            response_content (dict): the json of the Bundle
+
+        Returns:
+            Response: the total, the resources and the next url of the Bundle, None if it isn't
+                the result of a search
+        """  # noqa
+        # One of these entries should be found
+        if "entry" not in response_content and "total" not in response_content:
+            return None
+
+        results = response_content.get("entry")
+        links = response_content.get("link", [])
+        next_pages = [link["url"] for link in links if link["relation"] == "next"]
+
+        return Response(
+            total=response_content.get("total", 0),
+            results=results,
+            next_url=next_pages[0] if next_pages and results else None,
+        )
+
+    @staticmethod
+    def _bundle_header(content: bytes) -> Optional[Response]:
+        """Reads the total and the next url of the Bundle returned by a search without decoding
+        its entries, which is possible when its link element comes before its entry element,
+        as in the order of the elements of a Bundle: only the elements before the entries are
+        decoded
+
+        Arguments:
+            content (bytes): the raw json of the Bundle
+
+        Returns:
+            Response: the total and the next url of the Bundle, without its resources, None if
+                they can't be read without the entries or if it isn't the result of a search
+        """  # noqa
+        text = content.decode()
+        index = JSON_WHITESPACE.match(text).end()
+        if not text.startswith("{", index):
+            return None
+        header = {}
+        index += 1
+        while True:
+            index = JSON_WHITESPACE.match(text, index).end()
+            if text.startswith("}", index):
+                if "total" not in header:
+                    return None
+                has_entries = False
+                break
+            key, index = JSON_DECODER.raw_decode(text, index)
+            index = JSON_WHITESPACE.match(text, index).end() + 1  # after the ':'
+            index = JSON_WHITESPACE.match(text, index).end()
+            if key == "entry":
+                if "link" not in header:
+                    return None
+                has_entries = EMPTY_JSON_ARRAY.match(text, index) is None
+                break
+            header[key], index = JSON_DECODER.raw_decode(text, index)
+            index = JSON_WHITESPACE.match(text, index).end()
+            if text.startswith(",", index):
+                index += 1
+
+        next_pages = [link["url"] for link in header.get("link", []) if link["relation"] == "next"]
+        return Response(
+            total=header.get("total", 0),
+            next_url=next_pages[0] if next_pages and has_entries else None,
+        )
+
+    def _get_batch_responses(
+        self, urls: List[str], max_batch_size: int = MAX_BATCH_SIZE
+    ) -> List[Response]:
+        """Makes the GET searches of urls with Bundles of type batch POSTed to the service base
+        url (the url attribute), each Bundle grouping at most max_batch_size searches, so that
+        they cost a single round trip
+
+        Arguments:
+            urls (list): the urls of the searches, starting with the service base url
+            max_batch_size (int): maximum number of searches of a Bundle
+
+        Returns:
+            list: the response of each search, in the order of urls
+        """  # noqa
+        base_url = self.url.rstrip("/")
+        # the urls of the searches, relative to the service base url
+        base_length = len(base_url)
+        responses = []
+        for start in range(0, len(urls), max_batch_size):
+            end = start + max_batch_size
+            batch_urls = [self.__fix_url(url) for url in urls[start:end]]
+            bundle = {
+                "resourceType": "Bundle",
+                "type": "batch",
+                "entry": [
+                    {"request": {"method": "GET", "url": url[base_length:].lstrip("/")}}
+                    for url in batch_urls
+                ],
+            }
+            logger.info(f"Post a batch of {len(batch_urls)} searches to {base_url}")
+            response = requests.post(base_url, json=bundle, auth=self.auth)
+
+            try:
+                entries = response.json().get("entry", [])
+            except JSONDecodeError:
+                entries = []
+            if len(entries) != len(batch_urls):
+                raise ValueError(
+                    f"Batch of the requests: {batch_urls}\n"
+                    f"Status code of failing response: {response.status_code}\n"
+                    f"Content of the failing response:\n{pprint.pformat(response.__dict__)}"
+                )
+            for url, entry in zip(batch_urls, entries):
+                status = entry.get("response", {}).get("status", "")
+                search_response = self._bundle_response(entry.get("resource", {}))
+                if not status.startswith("2") or search_response is None:
+                    raise ValueError(
+                        f"Request: {url} in a batch\n"
+                        f"Status of failing response: {status}\n"
+                        f"Content of the failing response:\n{pprint.pformat(entry)}"
+                    )
+                responses.append(search_response)
+        return responses
+
+    def _get_batch_counts(self, urls: List[str], max_batch_size: int = MAX_BATCH_SIZE) -> List[int]:
+        """Counts the resources matching each url with _summary=count searches grouped into
+        Bundles of type batch (see _get_batch_responses)"""  # noqa
+        responses = self._get_batch_responses(
+            [f"{url}?_summary=count" for url in urls], max_batch_size
+        )
+        return [response.total for response in responses]
 
     def _get_count(self, url: str) -> int:
         url_count = f"{url}?_summary=count"
@@ -147,10 +322,14 @@ class ApiCall:
 
         if "_count" not in next_url:
             # Append _count info
-            next_url = f"{next_url}?_count={PAGE_SIZE}"
+            next_url = f"{next_url}?_count={self._page_size()}"
 
         return next_url
 
+    def _page_size(self) -> int:
+        """Number of resources requested per page"""
+        return PAGE_SIZE
+
     @staticmethod
     def __fix_url(url):
         """Apply a set of hot fixes on the url"""
@@ -194,6 +373,30 @@ class ApiRequest(ApiCall):
             offset functionality of some FHIR Apis
         pbar : tqdm progress bar object
         bar_frac (int): total amount of time allocated to this Api call
+        limit (int): (optional) maximum number of resources to retrieve. The pages are
+            then requested with a smaller _count and the paging stops once enough resources
+            have been retrieved
+        sort_by (list): (optional) list of (column, ascending) tuples. If given with a limit,
+            the limit first resources according to this order are kept: all the pages are
+            retrieved but only a bounded top-k table is kept in memory between the pages
+        aggregator (GroupByAggregator): (optional) if given, each page is added to its
+            aggregates and then dropped instead of being kept in df
+        residual_filter (callable): (optional) function applied to the dataframe of each page
+            to keep only the resources respecting the conditions that the API can't evaluate
+        total (int): (optional) number of resources matching the url, if already known it is
+            not asked again to the API
+        extraction_workers (int): (optional) number of processes extracting the elements from
+            the pages in parallel, while the next pages are requested. The pages are still
+            added in their order
+        prefetch_pages (bool): if true, the next page is requested while the current page is
+            processed, which overlaps the requests and the extraction with servers that only
+            give next links
+        shards (int): (optional) maximum number of disjoint _lastUpdated windows the search
+            is split into, the windows being paged in parallel. It doesn't need the
+            _getpagesoffset paging of parallel_requests
+        checkpoint_dir (str): (optional) directory where the pages are stored while they are
+            retrieved (see Checkpoint). If the pages of the url were already partly stored
+            there, the paging is resumed from the last stored page
     """  # noqa
 
     def __init__(
@@ -204,12 +407,31 @@ class ApiRequest(ApiCall):
         parallel_requests: bool = False,
         pbar=None,
         bar_frac: int = 0,
+        limit: int = None,
+        sort_by: List[Tuple[str, bool]] = None,
+        aggregator=None,
+        residual_filter: Callable[[pd.DataFrame], pd.DataFrame] = None,
+        total: int = None,
+        extraction_workers: int = None,
+        prefetch_pages: bool = False,
+        shards: int = None,
+        post_search: bool = False,
+        checkpoint_dir: str = None,
     ):
-        ApiCall.__init__(self, url, token)
+        ApiCall.__init__(self, url, token, post_search)
         self.elements = elements
         self.df = self._init_data()
 
         self.parallel_requests = parallel_requests
+        self.limit = limit
+        self.sort_by = sort_by
+        self.aggregator = aggregator
+        self.residual_filter = residual_filter
+        self.total = total
+        self.extraction_workers = extraction_workers
+        self.prefetch_pages = prefetch_pages
+        self.shards = shards
+        self.checkpoint_dir = checkpoint_dir
 
         self.pbar = pbar
         self.bar_frac = bar_frac
@@ -217,21 +439,36 @@ class ApiRequest(ApiCall):
 
     def get_all(self):
         """collects all the data corresponding to the initial url request by calling the following pages"""  # noqa
+        # a too long url is split, unless it can be sent with POST [type]/_search
+        urls = [self.url] if self.post_search else split_url(self.url)
+        if len(urls) > 1:
+            logger.info(f"the url {self.url} is too long, it is split into {len(urls)} urls")
+            return self._get_all_split(urls)
+
+        page_size = self._page_size()
         if self.number_calls is None:
-            total_resources = self._get_count(self.url)
+            total_resources = self.total if self.total is not None else self._get_count(self.url)
             logger.info(f"there are {total_resources} matching resources for {self.url}")
-            self.number_calls = int(np.ceil(total_resources / PAGE_SIZE))
+            if self.limit is not None and self.sort_by is None:
+                total_resources = min(total_resources, self.limit)
+            self.number_calls = int(np.ceil(total_resources / page_size))
 
         if self.number_calls == 0:
             return self._get_data([])
 
+        if self._shardable():
+            urls, totals = self._shard_urls(total_resources)
+            if len(urls) > 1:
+                logger.info(f"the search {self.url} is split into {len(urls)} shards")
+                return self._get_all_split(urls, totals)
+
         if self.parallel_requests:
             urls = []
             for i in range(self.number_calls):
                 urls.append(
                     (
                         self.auth.token,
-                        f"{self.url}&_getpagesoffset={i*PAGE_SIZE}&_count={PAGE_SIZE}",
+                        f"{self.url}&_getpagesoffset={i*page_size}&_count={page_size}",
                     )
                 )
 
@@ -240,21 +477,293 @@ class ApiRequest(ApiCall):
             p.close()
             self.pbar.update(self.bar_frac)
         else:
-            results = []
+            checkpoint = self._checkpoint()
+            results = [] if checkpoint is None else checkpoint.frames()
+            number_resources = 0
+            # pages being extracted by the worker processes, in the order of the pages, with
+            # their next link
+            pending = deque()
+
+            with self._extraction_pool() as pool:
+                # the entries of the pages extracted by the workers are only decoded by them
+                if checkpoint is None:
+                    responses = self._responses(entries=pool is None)
+                elif checkpoint.next_url is None:
+                    responses = []  # all the pages were already retrieved
+                else:
+                    responses = self._responses(checkpoint.next_url, entries=pool is None)
+                for response in responses:
+                    if pool is None:
+                        results, number_page_resources = self._add_page(
+                            results, self._get_data(response.results), checkpoint, response.next_url
+                        )
+                        number_resources += number_page_resources
+                    else:
+                        pending.append(
+                            (
+                                pool.apply_async(extract_page, (self.elements, response.content)),
+                                response.next_url,
+                            )
+                        )
+                        while pending and pending[0][0].ready():
+                            page, next_url = pending.popleft()
+                            results, _ = self._add_page(
+                                results, pd.DataFrame(page.get()), checkpoint, next_url
+                            )
+                    if self._has_enough_resources(number_resources):
+                        break
+
+                while pending:
+                    page, next_url = pending.popleft()
+                    results, _ = self._add_page(
+                        results, pd.DataFrame(page.get()), checkpoint, next_url
+                    )
 
-            next_url = self.url
-            while next_url:
-                next_url = self._fix_next_url(next_url)
-                response = self._get_response(next_url)
-                page_results = self._get_data(response.results)
+        self._concat(results)
+        if self.sort_by is not None and self.limit is not None:
+            self.df = self._top(self.df).reset_index(drop=True)
+        elif self.limit is not None:
+            self.df = self.df.iloc[: self.limit]
+
+        return self.df
 
-                results.append(page_results)
+    def _responses(self, url: str = None, entries: bool = True):
+        """Requests the pages of the url one after the other, following the next links
+
+        If prefetch_pages, the next page is requested in a background thread as soon as the
+        link to it is known, while the current page is being processed.
+
+        Arguments:
+            url (str): (optional) url of the first page requested, e.g. the next link of the
+                last page stored by a checkpoint (default: the url attribute)
+            entries (bool): if false, the entries of the pages are left undecoded in their
+                content when possible (see ApiCall._get_response)
+
+        Yields:
+            Response: the response of each page, in the order of the pages
+        """  # noqa
+        prefetch = self.prefetch_pages and not (self.limit is not None and self.sort_by is None)
+        with ThreadPool(1) if prefetch else null_context() as fetcher:
+            next_url = url or self.url
+            prefetched = None
+            while next_url:
+                if prefetched is None:
+                    response = self._get_response(self._fix_next_url(next_url), entries=entries)
+                else:
+                    response = prefetched.get()
                 next_url = response.next_url
+                if fetcher is not None and next_url:
+                    prefetched = fetcher.apply_async(
+                        self._get_response, (self._fix_next_url(next_url),), {"entries": entries}
+                    )
+                yield response
 
-        self._concat(results)
+    def _add_page(
+        self,
+        results: List[pd.DataFrame],
+        page_results: pd.DataFrame,
+        checkpoint: Checkpoint = None,
+        next_url: str = None,
+    ):
+        """Adds the data of a page to the results retrieved so far
+
+        Arguments:
+            results (list): the dataframes of the pages retrieved so far
+            page_results (pd.DataFrame): the data of the page
+            checkpoint (Checkpoint): (optional) the checkpoint the page is added to
+            next_url (str): the next link of the page, stored by the checkpoint
+
+        Returns:
+            list: the dataframes of the pages retrieved so far, including the page
+            int: the number of resources of the page that are kept
+        """  # noqa
+        if self.residual_filter is not None:
+            page_results = self.residual_filter(page_results)
+
+        if self.aggregator is not None:
+            self.aggregator.update(page_results)
+        elif self.sort_by is not None and self.limit is not None:
+            # keep only the current top-k resources
+            results = [self._top(pd.concat([*results, page_results]))]
+        else:
+            results.append(page_results)
+        if checkpoint is not None:
+            checkpoint.add(page_results, next_url)
+        return results, len(page_results)
+
+    def _checkpoint(self) -> Optional[Checkpoint]:
+        """Returns the checkpoint of the pages of the url, if a checkpoint directory is given
+        and all the pages are kept: not when they are aggregated, or when only the first or
+        the top-k resources are kept"""  # noqa
+        if self.checkpoint_dir is None or self.aggregator is not None or self.limit is not None:
+            return None
+        return Checkpoint(self.checkpoint_dir, self.url, self.elements)
+
+    def _extraction_pool(self):
+        """Returns the pool of processes extracting the pages in parallel, or a context
+        returning None if the pages are extracted by the calling process: when there is a
+        single page or when the paging can stop before the last page"""  # noqa
+        if (
+            not self.extraction_workers
+            or self.extraction_workers <= 1
+            or self.number_calls <= 1
+            or (self.limit is not None and self.sort_by is None)
+        ):
+            return null_context()
+        return multiprocessing.Pool(min(self.extraction_workers, self.number_calls))
+
+    def _get_all_split(self, urls: List[str], totals: List[int] = None) -> pd.DataFrame:
+        """Collects in parallel the data of the urls the initial url was split into and merges
+        them, a resource being retrieved only once
+
+        Arguments:
+            urls (list): the urls whose results together are the results of the initial url
+            totals (list): (optional) the number of resources matching each url, if known
+
+        Returns:
+            pd.DataFrame: the data of the initial url
+        """  # noqa
+        # the pages of the urls are aggregated as they are retrieved, each resource once
+        aggregator = (
+            None if self.aggregator is None else DistinctResourcesAggregator(self.aggregator)
+        )
+        sub_requests = [
+            ApiRequest(
+                url=url,
+                elements=self.elements,
+                token=self.auth.token,
+                pbar=self.pbar,
+                bar_frac=self.bar_frac / len(urls),
+                limit=self.limit,
+                sort_by=self.sort_by,
+                residual_filter=self.residual_filter,
+                total=totals[index] if totals else None,
+                extraction_workers=self.extraction_workers,
+                prefetch_pages=self.prefetch_pages,
+                post_search=self.post_search,
+                checkpoint_dir=self.checkpoint_dir,
+                aggregator=aggregator,
+            )
+            for index, url in enumerate(urls)
+        ]
+        with ThreadPool(min(len(urls), max(PARALLEL_SUB_REQUESTS, self.shards or 0))) as pool:
+            results = pool.map(ApiRequest.get_all, sub_requests)
+
+        if self.aggregator is not None:
+            self.df = self._init_data()
+        elif "from_id" in self.df.columns:
+            # a resource can match several urls (e.g. when the split parameter has several
+            # values): only its rows retrieved by the first of these urls are kept
+            self.df = drop_duplicate_resources([self.df, *results])
+        else:
+            self._concat(results)
+        if self.sort_by is not None and self.limit is not None:
+            self.df = self._top(self.df).reset_index(drop=True)
+        elif self.limit is not None:
+            self.df = self.df.iloc[: self.limit]
 
         return self.df
 
+    def _shardable(self) -> bool:
+        """Checks whether the search can be split into shards paged in parallel: there must
+        be several pages, the order of the resources given by the API must not matter and the
+        paging must not stop before the last page"""  # noqa
+        return (
+            self.shards is not None
+            and self.shards > 1
+            and self.number_calls > 1
+            and "_sort=" not in self.url
+            and not (self.limit is not None and self.sort_by is None)
+        )
+
+    def _shard_urls(self, total: int) -> Tuple[List[str], List[int]]:
+        """Splits the search into at most shards disjoint _lastUpdated windows with balanced
+        numbers of resources:
+
+        1. Starting from the window between the first and the last update, the window with
+           the most resources is cut in two at its middle, the number of resources of each
+           half being given by a _summary=count request on the first half, until all the
+           windows are small compared to a shard (or enough requests have been made).
+        2. The consecutive windows are grouped into shards of about the same number of
+           resources.
+
+        Arguments:
+            total (int): the number of resources matching the search
+
+        Returns:
+            list: the url of each shard, the first one having no lower bound and the last
+                one no upper bound so that no resource is missed
+            list: the number of resources of each shard
+        """  # noqa
+        first, last = self._last_updated("_lastUpdated"), self._last_updated("-_lastUpdated")
+        if first is None or last is None:
+            return [self.url], [total]
+
+        # windows [start, end[ with their number of resources
+        windows = [(first, last, total)]
+        shard_size = total / self.shards
+        for _ in range(SHARD_PROBES * self.shards):
+            index = max(range(len(windows)), key=lambda index: windows[index][2])
+            start, end, count = windows[index]
+            middle = (start + (end - start) / 2).floor("ms")
+            if count <= shard_size / 2 or middle <= start:
+                break
+            count_before = self._get_count(self._window_url(start, middle))
+            windows[index] = (middle, end, count - count_before)
+            windows.insert(index, (start, middle, count_before))
+
+        shards = []
+        for start, end, count in windows:
+            if shards and (shards[-1][2] < shard_size or len(shards) == self.shards):
+                shards[-1] = (shards[-1][0], end, shards[-1][2] + count)
+            else:
+                shards.append((start, end, count))
+
+        bounds = [start for start, _, _ in shards[1:]]
+        urls = [
+            self._window_url(start, end) for start, end in zip([None, *bounds], [*bounds, None])
+        ]
+        return urls, [count for _, _, count in shards]
+
+    def _last_updated(self, sort: str) -> Optional[pd.Timestamp]:
+        """Returns the first or the last (according to sort) date of update of the resources
+        matching the search, in UTC"""  # noqa
+        url = self.url
+        for key, value in [("_sort", sort), ("_count", "1"), ("_elements", "meta")]:
+            url = add_url_param(url, key, value)
+        response = self._get_response(url)
+        try:
+            last_updated = pd.Timestamp(response.results[0]["resource"]["meta"]["lastUpdated"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return None
+        if last_updated.tzinfo is None:
+            return last_updated.tz_localize("UTC")
+        return last_updated.tz_convert("UTC")
+
+    def _window_url(self, start: Optional[pd.Timestamp], end: Optional[pd.Timestamp]) -> str:
+        """Returns the url of the resources of the search updated in [start, end["""
+        url = self.url
+        for prefix, bound in [("ge", start), ("lt", end)]:
+            if bound is not None:
+                instant = bound.tz_localize(None).isoformat(timespec="milliseconds")
+                url = add_url_param(url, "_lastUpdated", f"{prefix}{instant}Z")
+        return url
+
+    def _page_size(self) -> int:
+        """Number of resources requested per page, reduced when only a few are needed"""
+        if self.limit is not None and self.sort_by is None:
+            return max(min(PAGE_SIZE, self.limit), 1)
+        return PAGE_SIZE
+
+    def _has_enough_resources(self, number_resources: int) -> bool:
+        """Checks whether the paging can stop before the last page"""
+        return self.limit is not None and self.sort_by is None and number_resources >= self.limit
+
+    def _top(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Keeps the limit first rows of df according to the sort_by order"""
+        columns, ascending = zip(*self.sort_by)
+        return sort_dataframe(df, list(columns), list(ascending), limit=self.limit)
+
     def _get_data(self, results: List) -> pd.DataFrame:
         """Retrieves the information from the json instance of a resource that is relevant
         to the query (ie listed in self.elements) and put it in a Dataframe
@@ -286,7 +795,7 @@ class ApiRequest(ApiCall):
                     data_item = resource["id"]
                 else:
                     raise ValueError(f"Invalid fhirpath {fhirpath}")
-                data_items.append(data_item)
+                data_items.append(ApiRequest._intern(data_item))
 
             filtered_resources.append(data_items)
 
@@ -301,7 +810,7 @@ class ApiRequest(ApiCall):
         # Drop duplicate columns (when you have two where clauses on a parameter)
         df = df.loc[:, ~df.columns.duplicated()]
 
-        return df
+        return self._flatten_item_results(df)
 
     def _concat(self, results: List[pd.DataFrame]) -> pd.DataFrame:
         """Recursively concat the results of all the pages together
@@ -315,6 +824,16 @@ class ApiRequest(ApiCall):
         self.df = pd.concat([self.df, *results]).reset_index(drop=True)
         return self.df
 
+    @classmethod
+    def _intern(cls, value):
+        """Interns the strings of a value extracted from a resource, so that the values repeated
+        in many resources (e.g. gender, status, systems or references) are stored only once"""  # noqa
+        if isinstance(value, str):
+            return sys.intern(value)
+        if isinstance(value, list):
+            return [cls._intern(item) for item in value]
+        return value
+
     @classmethod
     def _rgetattr(cls, obj, keys):
         """
@@ -345,50 +864,29 @@ class ApiRequest(ApiCall):
         else:
             return [cls._rgetattr(o, keys) for o in obj]
 
-    # INFO: Disabled as we prefere keep lists for the moment
-    # def _flatten_item_results(self, elements: Elements):
-    #     """creates the tabular version of the elements given as input argument.
-    #     For each element of elements, at least one column is added according to the
-    #     following process.
-    #     1. The first step is to reproduce the type of concatenation desired for each element
-    #     If the concatenation type of the element is:
-    #         * cell: a single column is created with a single row. The single cell is therefore
-    #           of the same type of element.value, i.e. a list.
-    #         * row: a single column is created and creates a row for each element in the
-    #           element.value list.
-    #         * col: len(element.value) column are created. Each column contains a single cell
-    #           composed of an element from the element.value list.
-    #
-    #     2. The second step is to produce the product of all possible combinations between columns
-    #     For example, if at the end of step 1, the table is :
-    #     Col_1 | Col_2 | Col_3
-    #     pat_1 | Pete  | Ginger
-    #     pat_1 | P.    | Ginger
-    #           | Peter | G.
-    #
-    #     The table resulting from step 2 will be :
-    #     Col_1 | Col_2 | Col_3
-    #     pat_1 | Pete  | Ginger
-    #     pat_1 | Pete  | G.
-    #     pat_1 | P.    | Ginger
-    #     pat_1 | P.    | G.
-    #     pat_1 | Peter | Ginger
-    #     pat_1 | Peter | G.
-    #
-    #     Args:
-    #         elements (fhir2dataset.Elements): instance of elements
-    #
-    #     Returns:
-    #         pd.DataFrame: resulting dataframe
-    #     """  # noqa
-    #     cols_name = []
-    #     dataset = []
-    #
-    #     for element in elements:
-    #         MAPPING_CONCAT[element.concat_type](dataset, cols_name, element)
-    #
-    #     df = pd.DataFrame(list(product(*dataset)), columns=cols_name)
-    #     return df
+    def _flatten_item_results(self, df: pd.DataFrame) -> pd.DataFrame:
+        """creates the tabular version of the selected elements of a page according to their
+        concatenation type:
+            * cell: the values of a resource stay in a single cell, as a list if there are
+              several values.
+            * row: a row is created for each value. The rows of a resource with several
+              elements of type row are the product of the values of these elements.
+            * col: a column '<col_name>_<i>' is created for the i-th value, as many columns
+              being created as the maximum number of values of a resource of the page.
+
+        Each concatenation is done on the column of the whole page at once.
+
+        Args:
+            df (pd.DataFrame): dataframe of the values extracted from the resources of a page
+
+        Returns:
+            pd.DataFrame: resulting dataframe
+        """  # noqa
+        for element in self.elements.where(goal="select"):
+            # the id of a resource is a single value
+            if element.col_name != "from_id" and element.col_name in df.columns:
+                df = MAPPING_CONCAT[element.concat_type](df, element.col_name)
+        return df
 
     def _init_data(self) -> pd.DataFrame:
         """generation of a dictionary whose keys correspond to the column name and the value to an empty list
@@ -398,6 +896,9 @@ class ApiRequest(ApiCall):
         """  # noqa
         data = {}
         for element in self.elements.elements:
+            if element.goal == "select" and element.concat_type == "col":
+                # the columns of the values are only known once the resources are retrieved
+                continue
             if element.col_name not in data:  # Drop duplicates
                 data[element.col_name] = []
         return pd.DataFrame(data)
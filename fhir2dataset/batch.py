@@ -0,0 +1,228 @@
+import logging
+import re
+from typing import List
+
+import pandas as pd
+import tqdm
+
+from fhir2dataset.api import ApiRequest
+from fhir2dataset.data_class import Elements
+from fhir2dataset.fhirrules import FHIRRules
+from fhir2dataset.parser import Parser
+from fhir2dataset.query import Query
+
+logger = logging.getLogger(__name__)
+
+# options of the queries used by the shared searches to retrieve their pages
+PAGE_OPTIONS = ["extraction_workers", "prefetch_pages", "shards", "post_search"]
+
+
+class SharedSearch:
+    """Search on the FHIR api shared by several aliases of several queries
+
+    Attributes:
+        url (str): the url of the search, identical for all the aliases sharing it
+        elements (Elements): union of the elements needed by each alias
+        users (list): list of (query, alias) tuples that will use the result of the search
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.elements = Elements()
+        self.users = []
+
+    def add(self, query: Query, resource_alias: str):
+        """Registers an alias of a query as a user of the search and adds the elements it needs
+
+        Arguments:
+            query (Query): the query containing the alias
+            resource_alias (str): the alias whose resources are retrieved by the search
+        """
+        col_names = [element.col_name for element in self.elements.elements]
+        for element in query.graph_query.resources_by_alias[resource_alias].elements.elements:
+            if element.col_name not in col_names:
+                self.elements.append(element)
+                col_names.append(element.col_name)
+        self.users.append((query, resource_alias))
+
+
+class QueryBatch:
+    """Executes several queries at once
+
+    The searches made for the aliases of all the queries are merged when they are identical
+    (i.e. they have the same url). Each merged search is executed only once and retrieves the
+    union of the elements needed by each alias. The joins and the projections are then made
+    for each query on the shared dataframes.
+
+    Attributes:
+        queries (list): list of Query instances to execute
+        searches (dict): the key is an url (with the elements flattened into rows or columns,
+            if any) and the value the SharedSearch made with this url
+    """  # noqa
+
+    def __init__(
+        self,
+        fhir_api_url: str = None,
+        token: str = None,
+        fhir_rules: FHIRRules = None,
+        **query_options,
+    ):
+        """
+        Arguments:
+            fhir_api_url (str): the service base URL (e.g. http://hapi.fhir.org/baseR4/)
+            token (str): (Optional) the bearer token to authenticate to the FHIR server,
+                if necessary
+            fhir_rules (FHIRRules): (Optional) an instance of FHIR rules, initialized
+                with search parameters, shared by all the queries
+
+        Keyword Arguments:
+            **query_options: the other options of Query (e.g. infer_types or
+                extraction_workers), given to each query of the batch. The options of the
+                pages (extraction_workers, prefetch_pages, shards and post_search) are also
+                used by the shared searches. The queries reading local files, storing their
+                state or their pages, or using $everything are executed on their own
+        """  # noqa
+        self.fhir_api_url = fhir_api_url or "http://hapi.fhir.org/baseR4/"
+        self.fhir_rules = fhir_rules or FHIRRules(fhir_api_url=self.fhir_api_url)
+        self.token = token
+        self.query_options = query_options
+
+        self.queries = []
+        self.searches = {}
+
+    def from_sql(self, sql_queries: List[str]):
+        """Adds queries written in a SQL-like syntax to the batch
+
+        Arguments:
+            sql_queries (list): list of queries in a SQL-like syntax
+        """
+        return self.from_configs([Parser().from_sql(sql_query) for sql_query in sql_queries])
+
+    def from_configs(self, configs: List[dict]):
+        """Adds queries in the format of a configuration file to the batch
+
+        Arguments:
+            configs (list): list of dictionaries in the format of a configuration file
+        """
+        for config in configs:
+            query = Query(
+                fhir_api_url=self.fhir_api_url,
+                token=self.token,
+                fhir_rules=self.fhir_rules,
+                **self.query_options,
+            )
+            self.queries.append(query.from_config(config))
+        return self
+
+    def execute(self, debug: bool = False) -> List[pd.DataFrame]:
+        """Executes all the queries of the batch
+
+        1. builds the graph and the urls of each query
+        2. merges the identical searches
+        3. retrieves each merged search once
+        4. filters the shared dataframes with the conditions of each query that the API can't
+           evaluate
+        5. executes the joins and the projections of each query on the shared dataframes
+
+        Arguments:
+            debug (bool): if debug is true then the columns needed for internal processing
+                are kept in the final dataframes (default: {False})
+
+        Returns:
+            list: the result table of each query, in the order the queries were added
+        """  # noqa
+        self._plan()
+
+        with tqdm.tqdm(
+            total=1, unit_scale=100, bar_format="{l_bar}{bar}| {n:.02f}/{total:.02f}"
+        ) as pbar:
+            bar_frac = 1 / max(len(self.searches), 1)
+            for search in self.searches.values():
+                call = ApiRequest(
+                    url=search.url,
+                    elements=search.elements,
+                    token=self.token,
+                    pbar=pbar,
+                    bar_frac=bar_frac,
+                    **{
+                        option: value
+                        for option, value in self.query_options.items()
+                        if option in PAGE_OPTIONS
+                    },
+                )
+                df = call.get_all()
+                for query, resource_alias in search.users:
+                    query.dataframes[resource_alias] = query._filter_residuals(
+                        resource_alias, self._project(df, query, resource_alias)
+                    )
+
+        return [
+            (
+                query.execute(debug=debug)
+                if self._executed_alone(query)
+                else query._process(debug=debug)
+            )
+            for query in self.queries
+        ]
+
+    @staticmethod
+    def _executed_alone(query: Query) -> bool:
+        """Checks whether a query doesn't share its searches: if it computes aggregates, which
+        are computed by the API when possible, or if its resources aren't retrieved by
+        searches whose pages are only kept in memory"""  # noqa
+        return bool(
+            query.aggregates
+            or query.group_by
+            or query._reads_files()
+            or query.state_dir is not None
+            or query.checkpoint_dir is not None
+            or query.patient_everything
+        )
+
+    def _plan(self):
+        """Groups the searches of all the queries by url. The queries executed alone (see
+        _executed_alone) are left apart
+        """  # noqa
+        self.searches = {}
+        for query in self.queries:
+            if self._executed_alone(query):
+                continue
+            query._build_graph_query()
+            for resource_alias, url in query._compute_urls().items():
+                # the elements flattened into rows or columns change the shape of the
+                # dataframe: only the aliases flattening them the same way share a search
+                flattened = tuple(
+                    (element.col_name, element.concat_type)
+                    for element in query.graph_query.resources_by_alias[
+                        resource_alias
+                    ].elements.where(goal="select")
+                    if element.col_name != "from_id" and element.concat_type != "cell"
+                )
+                key = (url, flattened) if flattened else url
+                if key not in self.searches:
+                    self.searches[key] = SharedSearch(url)
+                self.searches[key].add(query, resource_alias)
+
+        number_searches = sum(len(search.users) for search in self.searches.values())
+        logger.info(f"{number_searches} searches merged into " f"{len(self.searches)} searches")
+
+    @staticmethod
+    def _project(df: pd.DataFrame, query: Query, resource_alias: str) -> pd.DataFrame:
+        """Selects in the dataframe of a shared search the columns needed by an alias
+
+        Arguments:
+            df (pd.DataFrame): dataframe retrieved by the shared search
+            query (Query): the query containing the alias
+            resource_alias (str): the alias
+
+        Returns:
+            pd.DataFrame: a new dataframe containing only the columns of the alias
+        """
+        columns = []
+        for element in query.graph_query.resources_by_alias[resource_alias].elements.elements:
+            if element.goal == "select" and element.concat_type == "col":
+                pattern = re.compile(rf"{re.escape(element.col_name)}_\d+")
+                columns += [name for name in df.columns if pattern.fullmatch(name)]
+            elif element.col_name not in columns:
+                columns.append(element.col_name)
+        return df[columns].copy()
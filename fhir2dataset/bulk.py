@@ -0,0 +1,156 @@
+import json
+import logging
+import multiprocessing
+import os
+from functools import partial
+from typing import List
+
+import pandas as pd
+
+from fhir2dataset.api import ApiRequest, null_context
+from fhir2dataset.data_class import Element, Elements
+from fhir2dataset.store import check_conditions, filter_conditions
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000  # number of lines of a NDJSON file extracted at once
+NDJSON_EXTENSION = ".ndjson"
+
+
+def ndjson_files(directory: str, resource_type: str) -> List[str]:
+    """Lists the NDJSON files of a Bulk Data export containing the resources of a type. The
+    name of a file contains its resource type between dots (e.g. Patient.ndjson or
+    1.Patient.ndjson)
+
+    Arguments:
+        directory (str): directory of the files of the export
+        resource_type (str): the resource type (e.g. Patient)
+
+    Returns:
+        list: the paths of the files, sorted by name
+    """  # noqa
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(NDJSON_EXTENSION)
+        and resource_type in name[: -len(NDJSON_EXTENSION)].split(".")
+    ]
+
+
+def extract_file(
+    path: str,
+    resource_type: str,
+    elements: Elements,
+    conditions: List[Element] = None,
+    limit: int = None,
+) -> pd.DataFrame:
+    """
+    Extract the elements of the resources of a NDJSON file respecting the conditions.
+    The file is read line by line and extracted by chunks of CHUNK_SIZE resources, so that
+    only the rows kept are held in memory. Function called by the worker processes when the
+    files are extracted in parallel
+    """
+    request = ApiRequest(url=None, elements=elements)
+    frames = [request._get_data([])]
+    number_resources = 0
+    chunk = []
+    with open(path, "rb") as ndjson_file:
+        for line in ndjson_file:
+            if line.strip():
+                chunk.append({"resource": json.loads(line)})
+            if len(chunk) == CHUNK_SIZE:
+                frames.append(_extract_chunk(request, chunk, resource_type, conditions))
+                number_resources += len(frames[-1])
+                chunk = []
+                if limit is not None and number_resources >= limit:
+                    break
+        else:
+            frames.append(_extract_chunk(request, chunk, resource_type, conditions))
+    df = pd.concat(frames).reset_index(drop=True)
+    return df if limit is None else df.iloc[:limit]
+
+
+def _extract_chunk(
+    request: ApiRequest, chunk: List[dict], resource_type: str, conditions: List[Element]
+) -> pd.DataFrame:
+    # a file may contain the resources of several types
+    resources = [entry for entry in chunk if entry["resource"].get("resourceType") == resource_type]
+    return filter_conditions(request._get_data(resources), conditions)
+
+
+class BulkRequest:
+    """Reads the resources of a type from the NDJSON files of a FHIR Bulk Data export
+    ($export), instead of searching them on the API with an ApiRequest
+
+    Attributes:
+        directory (str): directory of the NDJSON files of the export
+        resource_type (str): the type of the resources to read (e.g. Patient)
+        elements (Elements): instance of the Elements class, the elements to extract from
+            each resource
+        conditions (list): (optional) the where elements the resources must respect. As there
+            is no API to evaluate them, all the conditions are evaluated on the values
+            extracted from the resources
+        limit (int): (optional) maximum number of resources to read
+        workers (int): (optional) number of processes extracting the files in parallel
+        pbar: (optional) tqdm progress bar object
+        bar_frac (float): fraction of the progress bar allocated to the reading
+    """  # noqa
+
+    def __init__(
+        self,
+        directory: str,
+        resource_type: str,
+        elements: Elements,
+        conditions: List[Element] = None,
+        limit: int = None,
+        workers: int = None,
+        pbar=None,
+        bar_frac: float = 0,
+    ):
+        self.directory = directory
+        self.resource_type = resource_type
+        self.elements = elements
+        self.conditions = conditions or []
+        check_conditions(self.conditions)
+        self.limit = limit
+        self.workers = workers
+        self.pbar = pbar
+        self.bar_frac = bar_frac
+
+    def get_all(self) -> pd.DataFrame:
+        """Extracts the resources of all the files of the resource type, in the order of the
+        files
+
+        Returns:
+            pd.DataFrame: the elements of the resources in tabular format
+        """  # noqa
+        paths = ndjson_files(self.directory, self.resource_type)
+        logger.info(f"{len(paths)} NDJSON files of {self.resource_type} in {self.directory}")
+        frames = [ApiRequest(url=None, elements=self.elements)._get_data([])]
+        number_resources = 0
+        with self._extraction_pool(paths) as pool:
+            extract = partial(
+                extract_file,
+                resource_type=self.resource_type,
+                elements=self.elements,
+                conditions=self.conditions,
+                limit=self.limit,
+            )
+            results = map(extract, paths) if pool is None else pool.imap(extract, paths)
+            for df in results:
+                frames.append(df)
+                number_resources += len(df)
+                if self.pbar is not None:
+                    self.pbar.update(self.bar_frac / len(paths))
+                if self.limit is not None and number_resources >= self.limit:
+                    break
+        df = pd.concat(frames).reset_index(drop=True)
+        return df if self.limit is None else df.iloc[: self.limit]
+
+    def _extraction_pool(self, paths: List[str]):
+        """Returns the pool of processes extracting the files in parallel, or a context
+        returning None if the files are extracted by the calling process: when there is a
+        single file or when the reading can stop before the last file"""  # noqa
+        if not self.workers or self.workers <= 1 or len(paths) <= 1 or self.limit is not None:
+            return null_context()
+        return multiprocessing.Pool(min(self.workers, len(paths)))
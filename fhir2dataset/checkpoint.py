@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import List, Optional
+
+import pandas as pd
+
+from fhir2dataset.data_class import Elements
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PAGES = 10  # number of pages stored together in a chunk of a checkpoint
+CURSOR_FILENAME = "cursor.json"
+
+
+def key_digest(key) -> str:
+    """Returns a digest identifying a json-serializable key (e.g. the configuration of a
+    query), usable as a directory name"""  # noqa
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def remove_checkpoints(directory: str):
+    """Removes a directory of checkpoints, if it exists"""
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+
+class Checkpoint:
+    """Pages of a search stored in a directory while they are retrieved, so that a search
+    interrupted (e.g. by a network error) can be resumed from its last stored page instead of
+    from its first page.
+
+    The pages are stored by chunks of every pages, each chunk being the pickled dataframe of
+    its pages, along with a cursor: the next link of the last stored page (None once the last
+    page is stored). The cursor is written after the chunk, and atomically, so that it never
+    refers to pages that are not stored. The next links must still be valid when the search is
+    resumed, which depends on how long the server keeps its search results.
+
+    Attributes:
+        path (str): the directory of the checkpoint of the search
+        every (int): number of pages per chunk
+        next_url (str): url of the first page not stored yet, None if all the pages are
+            stored
+    """  # noqa
+
+    def __init__(self, directory: str, url: str, elements: Elements, every: int = None):
+        """
+        Arguments:
+            directory (str): the directory of the checkpoints of all the searches
+            url (str): url of the first page of the search
+            elements (Elements): the elements extracted from the pages
+            every (int): number of pages per chunk (default: {10})
+        """  # noqa
+        self.path = os.path.join(
+            directory, key_digest([url, [element.col_name for element in elements.elements]])
+        )
+        self.every = every or CHECKPOINT_PAGES
+        self.next_url = url
+        self._chunks = 0
+        self._pages = []
+        cursor_path = os.path.join(self.path, CURSOR_FILENAME)
+        if os.path.exists(cursor_path):
+            with open(cursor_path) as json_file:
+                cursor = json.load(json_file)
+            self.next_url, self._chunks = cursor["next_url"], cursor["chunks"]
+            logger.info(f"{url} is resumed from its checkpoint of {self._chunks} chunks")
+
+    def _chunk_path(self, index: int) -> str:
+        return os.path.join(self.path, f"chunk_{index}.pkl")
+
+    def frames(self) -> List[pd.DataFrame]:
+        """Returns the dataframes of the chunks stored so far"""
+        return [pd.read_pickle(self._chunk_path(index)) for index in range(self._chunks)]
+
+    def add(self, page: pd.DataFrame, next_url: Optional[str]):
+        """Adds a page retrieved, the pages being stored once there are every of them or once
+        the last page is added
+
+        Arguments:
+            page (pd.DataFrame): the data of the page
+            next_url (str): the next link of the page, None if it is the last page
+        """  # noqa
+        self._pages.append(page)
+        if len(self._pages) >= self.every or next_url is None:
+            self._store(next_url)
+
+    def _store(self, next_url: Optional[str]):
+        os.makedirs(self.path, exist_ok=True)
+        pd.concat(self._pages, ignore_index=True).to_pickle(self._chunk_path(self._chunks))
+        self._chunks += 1
+        self._pages = []
+        self.next_url = next_url
+        cursor_path = os.path.join(self.path, CURSOR_FILENAME)
+        with open(f"{cursor_path}.tmp", "w") as json_file:
+            json.dump({"next_url": next_url, "chunks": self._chunks}, json_file)
+        os.replace(f"{cursor_path}.tmp", cursor_path)
@@ -2,7 +2,7 @@
 """
 import logging
 from dataclasses import dataclass, field
-from typing import List, Optional
+from typing import List, Optional, Union
 
 from fhir2dataset.tools.visualization import custom_repr
 
@@ -14,8 +14,10 @@ class SearchParameter:
     code: Optional[str] = field(default=None)
     fhirpath: Optional[str] = field(default=None)
     resource_types: Optional[List[str]] = field(default=None)
+    type: Optional[str] = field(default=None)  # e.g. token, date, number
     prefix: Optional[str] = field(default=None)
-    value: Optional[str] = field(default=None)
+    # a list of values (each a string or a {prefix: value} dict) is combined with OR
+    value: Optional[Union[str, List[Union[str, dict]]]] = field(default=None)
 
 
 @dataclass
@@ -30,6 +32,7 @@ class Element:
     goal: str = field(default="select")  # select, where or join
     concat_type: Optional[str] = field(default="cell")
     search_parameter: Optional["SearchParameter"] = field(default=None)
+    value_type: Optional[str] = field(default=None)  # date, number or boolean if known
 
 
 @dataclass
@@ -67,6 +70,41 @@ class ResourceAliasInfo(ResourceAliasInfoBasic):
         return custom_repr(super().__repr__())
 
 
+@dataclass
+class Aggregate:
+    """aggregate computed on the rows of the result table (e.g. COUNT(*) or COUNT(DISTINCT p._id))
+
+    If column is None, the aggregate is computed on the rows themselves (e.g. COUNT(*)).
+    """  # noqa
+
+    function: str  # count, min, max or sum
+    alias: Optional[str] = field(default=None)
+    column: Optional[str] = field(default=None)
+    distinct: bool = field(default=False)
+
+
+@dataclass
+class OrderBy:
+    """sort key of the result table, column being a searchparam or a fhirpath of the alias"""
+
+    alias: str
+    column: str
+    ascending: bool = field(default=True)
+
+
+@dataclass
+class GroupBy:
+    """group key of the result table, column being a searchparam or a fhirpath of the alias.
+
+    values (optional) lists all the values the key can take, allowing the API to count the
+    resources of each group.
+    """  # noqa
+
+    alias: str
+    column: str
+    values: Optional[List[str]] = field(default=None)
+
+
 @dataclass
 class EdgeInfo:
     parent: str
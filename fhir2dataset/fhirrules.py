@@ -1,21 +1,43 @@
 import json
 import logging
 import os
+import re
 from collections import defaultdict
 from functools import lru_cache
-from typing import List
+from typing import List, Optional
 
 from fhir2dataset.data_class import SearchParameter
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_METADATA_DIR = "tools/metadata"
+# maximum number of references followed by a chained parameter or nested _has by default
+DEFAULT_MAX_CHAIN_DEPTH = 3
+
+# values of search parameters bound to a required value set that is the same for all the
+# resource types using them
+SEARCHPARAM_VALUES = {
+    "gender": ["male", "female", "other", "unknown"],
+}
+
+# types of the values of the elements that can be converted from their json representation,
+# given by the type of the search parameters on these elements
+SEARCHPARAM_VALUE_TYPES = {"date": "date", "number": "number"}
+# types of the values of the elements given by the suffix of their name (e.g. birthDate,
+# effectiveDateTime, valueQuantity.value or deceasedBoolean)
+SUFFIX_VALUE_TYPES = [
+    (re.compile(r"(Date|DateTime|Instant|lastUpdated)$"), "date"),
+    (re.compile(r"(Integer|Decimal|PositiveInt|UnsignedInt|Quantity\.value)$"), "number"),
+    (re.compile(r"(Boolean|\.active)$"), "boolean"),
+]
 
 
 class SearchParameters:
     def __init__(self, search_parameters: List[SearchParameter] = None):
         self.items = search_parameters or []
         self._data = defaultdict(lambda: defaultdict(dict))
+        self._types = defaultdict(dict)
+        self._value_types = {}
 
         for search_parameter in self.items:
             self._add_data(search_parameter)
@@ -51,6 +73,23 @@ class SearchParameters:
 
         return fhirpath
 
+    def searchparam_type(self, search_param: str, resource_type: str = "all"):
+        """Retrieve the type of a searchparam of a certain resource type (e.g. 'token'), None
+        if the searchparam doesn't exist in the rules"""  # noqa
+        return self._types[search_param].get(resource_type)
+
+    def fhirpath_to_value_type(self, fhirpath: str):
+        """Retrieve the type of the values of the element at fhirpath, if a searchparam
+        of type date or number is defined on this element
+
+        Arguments:
+            fhirpath (str): fhirpath of an element (e.g. 'Patient.birthDate')
+
+        Returns:
+            str: 'date' or 'number', None if the type is unknown
+        """  # noqa
+        return self._value_types.get(fhirpath)
+
     def _add_data(self, search_parameter: SearchParameter):
         """Fill the _data store dict with information from a searchparam"""
         fhirpath = search_parameter.fhirpath
@@ -59,6 +98,14 @@ class SearchParameters:
 
         for resource_type in resource_types:
             self._data[code][resource_type] = fhirpath
+            self._types[code][resource_type] = search_parameter.type
+
+        value_type = SEARCHPARAM_VALUE_TYPES.get(search_parameter.type)
+        if value_type and fhirpath:
+            for path in fhirpath.split(" | "):
+                # only the plain paths, e.g. not (Observation.effective as dateTime)
+                if re.fullmatch(r"[A-Za-z.]+", path):
+                    self._value_types[path] = value_type
 
 
 class FHIRRules:
@@ -67,6 +114,9 @@ class FHIRRules:
 
     Attributes:
         searchparameters (SearchParameters): an instance json of a SearchParameters resource
+        max_chain_depth (int): maximum number of references that the FHIR API accepts to follow
+            in a chained parameter (e.g. 2 for encounter.subject:Patient.gender) or in nested
+            _has parameters
     """  # noqa
 
     def __init__(
@@ -74,6 +124,7 @@ class FHIRRules:
         fhir_api_url: str = None,
         path: str = None,
         searchparameters_filename: str = "SearchParameters.json",
+        max_chain_depth: int = DEFAULT_MAX_CHAIN_DEPTH,
     ):
         """
         Arguments:
@@ -82,8 +133,12 @@ class FHIRRules:
             path (str): path to the folder containing the searchparameters file (default: None)
             searchparameters_filename (str): filename of a json that contains a resource of
                 type SearchParameters  (default: {"SearchParameters.json"})
+            max_chain_depth (int): maximum number of references that the FHIR API accepts to
+                follow in a chained parameter or in nested _has parameters, 1 to only use the
+                conditions of the neighbouring resources (default: {3})
         """  # noqa
         self.fhir_api_url = fhir_api_url
+        self.max_chain_depth = max_chain_depth
         self.path = path or os.path.join(os.path.dirname(__file__), DEFAULT_METADATA_DIR)
         self.searchparameters_filename = searchparameters_filename
         self.searchparameters = self.build_searchparameters()
@@ -117,6 +172,110 @@ class FHIRRules:
                 )
         return fhirpath
 
+    def is_searchparam(self, search_param: str, resource_type: str) -> bool:
+        """Checks whether search_param is a search parameter that the API can apply on
+        resources of type resource_type (including the ones common to all resources,
+        e.g. '_id')
+
+        Arguments:
+            search_param (str): searchparam or fhirpath (e.g. 'gender' or 'Patient.gender')
+            resource_type (str): name of a resource type (e.g. 'Patient')
+
+        Returns:
+            bool: True if search_param is a search parameter of the resource type
+        """  # noqa
+        search_param = search_param.split(":")[0]  # remove modifiers, e.g. code:text
+        for base in [resource_type, "DomainResource", "Resource"]:
+            if self.searchparameters.searchparam_to_fhirpath(search_param, base):
+                return True
+        return False
+
+    def searchparam_type(self, search_param: str, resource_type: str) -> Optional[str]:
+        """Retrieve the type of a search parameter that the API can apply on resources of type
+        resource_type (including the ones common to all resources, e.g. '_id')
+
+        Arguments:
+            search_param (str): searchparam, with or without modifier (e.g. 'code:text')
+            resource_type (str): name of a resource type (e.g. 'Observation')
+
+        Returns:
+            str: the type of the searchparam (e.g. 'token'), None if it isn't a searchparam
+        """  # noqa
+        search_param = search_param.split(":")[0]  # remove modifiers, e.g. code:text
+        for base in [resource_type, "DomainResource", "Resource"]:
+            searchparam_type = self.searchparameters.searchparam_type(search_param, base)
+            if searchparam_type:
+                return searchparam_type
+        return None
+
+    def resource_searchparams(self, resource_type: str) -> List[SearchParameter]:
+        """Lists the search parameters that can be applied on the resources of a type
+        (including the ones common to all resources, e.g. '_id'), the fhirpath of each being
+        restricted to the paths of the resource type
+
+        Arguments:
+            resource_type (str): name of a resource type (e.g. 'Patient')
+
+        Returns:
+            list: a SearchParameter per code, whose fhirpaths start with the resource type
+                (e.g. 'Patient.name.family')
+        """  # noqa
+        bases = {resource_type, "DomainResource", "Resource"}
+        paths_by_code = {}
+        for search_parameter in self.searchparameters.items:
+            if not search_parameter.fhirpath or not bases & set(search_parameter.resource_types):
+                continue
+            for path in search_parameter.fhirpath.split(" | "):
+                for base in bases:
+                    # e.g. Patient.name.family or (Observation.value as Quantity)
+                    match = re.fullmatch(rf"(\(?){base}\.(.*)", path)
+                    if match:
+                        path = f"{match.group(1)}{resource_type}.{match.group(2)}"
+                        paths = paths_by_code.setdefault(
+                            search_parameter.code, (search_parameter.type, [])
+                        )[1]
+                        if path not in paths:
+                            paths.append(path)
+        return [
+            SearchParameter(
+                code=code,
+                fhirpath=" | ".join(paths),
+                resource_types=[resource_type],
+                type=searchparam_type,
+            )
+            for code, (searchparam_type, paths) in paths_by_code.items()
+        ]
+
+    def searchparam_values(self, search_param: str) -> List[str]:
+        """Retrieve the values a searchparam can take, if they are known
+
+        Arguments:
+            search_param (str): a searchparam (e.g. 'gender')
+
+        Returns:
+            list: the values of the searchparam, None if they are unknown
+        """
+        return SEARCHPARAM_VALUES.get(search_param)
+
+    def value_type(self, fhirpath: str):
+        """Infers the type of the values of the element at fhirpath from the type of the
+        searchparams defined on it or, failing that, from the suffix of its name (e.g.
+        effectiveDateTime or valueQuantity.value)
+
+        Arguments:
+            fhirpath (str): fhirpath of an element (e.g. 'Patient.birthDate')
+
+        Returns:
+            str: 'date', 'number' or 'boolean', None if the type is unknown
+        """  # noqa
+        value_type = self.searchparameters.fhirpath_to_value_type(fhirpath)
+        if value_type:
+            return value_type
+        for suffix, value_type in SUFFIX_VALUE_TYPES:
+            if suffix.search(fhirpath):
+                return value_type
+        return None
+
     def build_searchparameters(self) -> SearchParameters:
         """builds an instance of SearchParameters storing all the possible searchparameters
         (instance of SearchParameter) whose information comes from a bundle composed only of
@@ -143,6 +302,7 @@ class FHIRRules:
                         code=resource["code"],
                         fhirpath=resource["expression"],
                         resource_types=resource["base"],
+                        type=resource.get("type"),
                     )
                 )
 
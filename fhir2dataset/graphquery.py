@@ -1,10 +1,19 @@
 import logging
 from collections import defaultdict
 from pprint import pformat
+from typing import List
 
 import networkx as nx
 
-from fhir2dataset.data_class import EdgeInfo, Element, Elements, ResourceAliasInfo, SearchParameter
+from fhir2dataset.data_class import (
+    EdgeInfo,
+    Element,
+    Elements,
+    GroupBy,
+    OrderBy,
+    ResourceAliasInfo,
+    SearchParameter,
+)
 from fhir2dataset.fhirrules import FHIRRules
 
 logger = logging.getLogger(__name__)
@@ -42,7 +51,13 @@ class GraphQuery:
         self.resources_by_alias = defaultdict(ResourceAliasInfo)
 
     def build(
-        self, select_dict: dict, from_dict: dict, join_dict: dict = None, where_dict: dict = None
+        self,
+        select_dict: dict,
+        from_dict: dict,
+        join_dict: dict = None,
+        where_dict: dict = None,
+        order_by_list: List[OrderBy] = None,
+        group_by_list: List[GroupBy] = None,
     ):
         """Populates the attributes resources_graph and resources_by_alias according
         to the information filled in.
@@ -52,13 +67,20 @@ class GraphQuery:
             from_dict (dict): all requested resources
             join_dict (dict): the inner join rules between resources (default: None)
             where_dict (dict): the (cumulative) conditions to be met by the resources (default: None)
+            order_by_list (list): the sort keys of the result table (default: None)
+            group_by_list (list): the group keys of the result table (default: None)
         """  # noqa
         self._from(**from_dict)
         if join_dict:
             self._join(**join_dict)
         if where_dict:
             self._where(**where_dict)
-        self._select(**select_dict)
+        if select_dict:
+            self._select(**select_dict)
+        if order_by_list:
+            self._order_by(order_by_list)
+        if group_by_list:
+            self._group_by(group_by_list)
 
         # FIXME: Need FHIR2Dataset#96
         # for resource_alias in self.resources_by_alias.keys():
@@ -168,11 +190,15 @@ class GraphQuery:
 
         Keyword Arguments:
             **wheres: the key is an alias, the value is a dictionary containing itself keys which
-                are searchparams and whose values must be respected by the associated search params
+                are searchparams and whose values must be respected by the associated search params.
+                A value which is a list of values is respected if one of its values is respected.
+                The keys which are fhirpaths rather than searchparams can't be sent to the API:
+                their conditions are evaluated on the retrieved resources
         """  # noqa
         for resource_alias, conditions in wheres.items():
             for search_param, values in conditions.items():
-                fhirpath = self._check_searchparam_or_fhirpath(resource_alias, search_param)
+                # the modifier of the searchparam (e.g. code:text) doesn't change the element
+                fhirpath = self._column_to_fhirpath(resource_alias, search_param.split(":")[0])
                 if not isinstance(values, list):
                     values = [values]
 
@@ -188,7 +214,12 @@ class GraphQuery:
                             break
 
                     search_param_obj = SearchParameter(
-                        code=search_param, prefix=prefix, value=value
+                        code=search_param,
+                        type=self.fhir_rules.searchparam_type(
+                            search_param, self.resources_by_alias[resource_alias].resource_type
+                        ),
+                        prefix=prefix,
+                        value=value,
                     )
                     self.resources_by_alias[resource_alias].elements.append(
                         Element(
@@ -215,9 +246,68 @@ class GraphQuery:
                         goal="select",
                         col_name=col_name,
                         fhirpath=fhirpath,
+                        value_type=self.fhir_rules.value_type(fhirpath),
                     )
                 )
 
+    def _order_by(self, order_by_list: List[OrderBy]):
+        """updates the resources_by_alias attribute with the elements used to sort the result
+        table
+
+        Arguments:
+            order_by_list (list): the sort keys, whose column is a searchparam or a fhirpath
+        """  # noqa
+        for order_by in order_by_list:
+            self.resources_by_alias[order_by.alias].elements.append(
+                Element(
+                    goal="order",
+                    col_name=f"order_{order_by.column}",
+                    fhirpath=self._column_to_fhirpath(order_by.alias, order_by.column),
+                )
+            )
+
+    def _group_by(self, group_by_list: List[GroupBy]):
+        """updates the resources_by_alias attribute with the elements used to group the rows
+        of the result table
+
+        Arguments:
+            group_by_list (list): the group keys, whose column is a searchparam or a fhirpath
+        """  # noqa
+        for group_by in group_by_list:
+            self.resources_by_alias[group_by.alias].elements.append(
+                Element(
+                    goal="group",
+                    col_name=f"group_{group_by.column}",
+                    fhirpath=self._column_to_fhirpath(group_by.alias, group_by.column),
+                )
+            )
+
+    def _column_to_fhirpath(self, resource_alias: str, column: str) -> str:
+        """transforms a column of an alias, given as a searchparam (including the ones common to
+        all resources such as _lastUpdated) or as a fhirpath with or without the resource type,
+        into its fhirpath
+
+        Args:
+            resource_alias (str): alias associated with a resource
+            column (str): searchparam or fhirpath (e.g. 'birthdate' or 'name.family')
+
+        Returns:
+            str: string of characters corresponding to a fhirpath (e.g. 'Patient.birthDate')
+        """  # noqa
+        resource_type = self.resources_by_alias[resource_alias].resource_type
+        fhirpath = self.fhir_rules.searchparam_to_fhirpath(
+            resource_type=resource_type, search_param=column
+        ) or self.fhir_rules.searchparam_to_fhirpath(resource_type="Resource", search_param=column)
+        if fhirpath:
+            fhirpath = fhirpath.replace("Resource.", f"{resource_type}.")
+        elif column.startswith(f"{resource_type}."):
+            fhirpath = column
+        else:
+            fhirpath = f"{resource_type}.{column}"
+        if fhirpath == f"{resource_type}.id":
+            fhirpath = "_id"
+        return fhirpath
+
     def _check_searchparam_or_fhirpath(self, resource_alias: str, searchparam_or_fhirpath: str):
         """transforms searchparam_or_fhirpath into its fhirpath if it's a searchparam, otherwise it returns the argument as it was entered.
 
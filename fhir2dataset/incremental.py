@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+import pandas as pd
+
+from fhir2dataset.checkpoint import key_digest
+
+logger = logging.getLogger(__name__)
+
+# column of the meta.lastUpdated of the resources, from which the watermarks are computed
+LAST_UPDATED = "_lastUpdated"
+WATERMARKS_FILENAME = "watermarks.json"
+
+
+def watermark(last_updated: pd.Series, previous: str = None) -> Optional[str]:
+    """Computes the high-water mark of the meta.lastUpdated of resources, as an instant in UTC
+    to the millisecond that can be written in an url (e.g. 2021-01-01T10:00:00.000Z)
+
+    Arguments:
+        last_updated (pd.Series): the meta.lastUpdated of the resources
+        previous (str): (optional) the previous watermark, kept if no resource is more recent
+
+    Returns:
+        str: the watermark, None if there is no resource and no previous watermark
+    """  # noqa
+    instants = pd.to_datetime(last_updated, errors="coerce", utc=True).dropna()
+    if previous is not None:
+        instants = pd.concat([instants, pd.Series([pd.Timestamp(previous)])])
+    if len(instants) == 0:
+        return None
+    return instants.max().strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class IncrementalState:
+    """Local state of the incremental executions of a query, stored in a directory of its
+    own: the dataframes of the aliases retrieved so far, the watermark of each alias (the
+    most recent meta.lastUpdated of its resources) and the last result table.
+
+    The dataframes are stored with pickle: the state directory must only be written by
+    trusted users.
+
+    Attributes:
+        path (str): the directory of the state of the query
+        watermarks (dict): the key is an alias and the value its watermark
+        changed (bool): whether the dataframes changed during the current execution
+    """  # noqa
+
+    def __init__(self, state_dir: str, key: dict):
+        """
+        Arguments:
+            state_dir (str): the directory of the states of all the queries
+            key (dict): what identifies the query (its configuration, the url of the API...),
+                a state being only reused by the same query
+        """  # noqa
+        self.path = os.path.join(state_dir, key_digest(key))
+        self.watermarks = {}
+        self.changed = False
+        watermarks_path = os.path.join(self.path, WATERMARKS_FILENAME)
+        if os.path.exists(watermarks_path):
+            with open(watermarks_path) as json_file:
+                self.watermarks = json.load(json_file)
+
+    def _frame_path(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.pkl")
+
+    def frame(self, resource_alias: str) -> Optional[pd.DataFrame]:
+        """Returns the dataframe of an alias stored by the last execution, None if there is
+        none"""  # noqa
+        if resource_alias not in self.watermarks:
+            return None
+        return pd.read_pickle(self._frame_path(f"alias_{resource_alias}"))
+
+    def save(self, frames: Dict[str, pd.DataFrame]):
+        """Stores the dataframes of the aliases and their watermark, computed from their
+        meta.lastUpdated column
+
+        Arguments:
+            frames (dict): the key is an alias and the value its dataframe
+        """  # noqa
+        os.makedirs(self.path, exist_ok=True)
+        for debug in [False, True]:
+            # the result tables of the previous dataframes are outdated
+            if os.path.exists(self._frame_path(f"result_{debug}")):
+                os.remove(self._frame_path(f"result_{debug}"))
+        for resource_alias, df in frames.items():
+            df.to_pickle(self._frame_path(f"alias_{resource_alias}"))
+            self.watermarks[resource_alias] = watermark(
+                df[LAST_UPDATED], self.watermarks.get(resource_alias)
+            )
+        # the watermarks are written last: if the storage is interrupted, the next execution
+        # retrieves again the resources updated since the previous watermarks
+        self.save_watermarks()
+
+    def save_watermarks(self):
+        """Stores the watermarks, e.g. when they moved forward without the dataframes changing
+        (the resources updated since the last execution no longer match the query)"""  # noqa
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, WATERMARKS_FILENAME), "w") as json_file:
+            json.dump(self.watermarks, json_file)
+
+    def result(self, debug: bool) -> Optional[pd.DataFrame]:
+        """Returns the result table of the last execution, None if there is none"""
+        path = self._frame_path(f"result_{debug}")
+        return pd.read_pickle(path) if os.path.exists(path) else None
+
+    def save_result(self, df: pd.DataFrame, debug: bool):
+        """Stores the result table of the execution"""
+        df.to_pickle(self._frame_path(f"result_{debug}"))
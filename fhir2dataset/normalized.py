@@ -0,0 +1,50 @@
+import logging
+from typing import Callable, Dict, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class NormalizedResult:
+    """Result of a query kept as one table per alias and one link table per join, instead of
+    a single table repeating the columns of a resource for each resource joined with it.
+
+    Attributes:
+        tables (dict): the key is an alias and the value the table of its resources, with a
+            row per resource and the columns of the select
+        links (dict): the key is a (parent alias, child alias) tuple and the value the table
+            of the (parent id, child id) pairs of the references of the join between them
+    """  # noqa
+
+    def __init__(
+        self,
+        tables: Dict[str, pd.DataFrame],
+        links: Dict[Tuple[str, str], pd.DataFrame],
+        flatten: Callable[[], pd.DataFrame],
+    ):
+        """
+        Arguments:
+            tables (dict): the table of each alias
+            links (dict): the link table of each join
+            flatten (callable): function joining the tables into the result table
+        """  # noqa
+        self.tables = tables
+        self.links = links
+        self._flatten = flatten
+        self._flat = None
+
+    def flatten(self) -> pd.DataFrame:
+        """Returns the result of the query as a single table. The joins are only made at the
+        first call."""  # noqa
+        if self._flat is None:
+            logger.info("the tables of the aliases are joined")
+            self._flat = self._flatten()
+        return self._flat
+
+    def __repr__(self):
+        tables = ", ".join(f"{alias}: {len(table)} rows" for alias, table in self.tables.items())
+        links = ", ".join(
+            f"{parent}->{child}: {len(link)} rows" for (parent, child), link in self.links.items()
+        )
+        return f"NormalizedResult(tables=[{tables}], links=[{links}])"
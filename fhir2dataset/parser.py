@@ -4,6 +4,7 @@ from collections.abc import Iterable
 from typing import List, Union
 
 PREFIX = ["eq", "ne", "gt", "lt", "ge", "le", "sa", "eb", "ap"]
+AGGREGATE_FUNCTIONS = ["COUNT", "MIN", "MAX", "SUM"]
 
 
 def create_mask(
@@ -49,11 +50,28 @@ def create_mask(
         mask = fr"{mask}\s"
 
     if case_insensitive:
-        mask = fr"{mask}(?i)"
+        mask = fr"(?i){mask}"
 
     return mask
 
 
+def split_unquoted(mask: str, string: str) -> List[str]:
+    """
+    Utility function: split a string on the matches of a regex mask outside of its quoted
+    literals (e.g. the OR of 'Tom or Jerry' doesn't split it)
+    """
+    # the quoted literals are blanked out so that the mask can't match inside them
+    masked = re.sub(r"'[^']*'|\"[^\"]*\"", lambda match: "_" * len(match.group()), string)
+    parts = []
+    start = 0
+    for match in re.finditer(mask, masked):
+        end = match.start()
+        parts.append(string[start:end])
+        start = match.end()
+    parts.append(string[start:])
+    return parts
+
+
 class Parser:
     def __init__(self):
         self.CLAUSES = {
@@ -75,6 +93,10 @@ class Parser:
         self.__child_join = defaultdict(dict)
         self.__parent_join = defaultdict(dict)
         self.__where = defaultdict(dict)
+        self.__aggregate = dict()
+        self.__order_by = []
+        self.__group_by = []
+        self.__limit = None
 
     def from_sql(self, sql_string: str) -> dict:
         """Convert a SQL string query into a dict of logical clauses"""
@@ -103,7 +125,10 @@ class Parser:
         config = {
             "from": dict(self.__from),
             "select": dict(self.__select),
+            "aggregate": dict(self.__aggregate),
             "where": dict(self.__where),
+            "order_by": self.__order_by,
+            "group_by": self.__group_by,
             "join": {
                 "inner": dict(self.__inner_join),
                 "child": dict(self.__child_join),
@@ -111,16 +136,49 @@ class Parser:
             },
         }
         config["join"] = {key: value for key, value in config["join"].items() if value}
-        return {key: value for key, value in config.items() if value}
+        config = {key: value for key, value in config.items() if value}
+        if self.__limit is not None:
+            config["limit"] = self.__limit
+        return config
 
     def __select_parser(self, string):
         item_parsed = re.split(create_mask(",", optional_spaces=True), string)
         for item in item_parsed:
+            aggregate_match = re.match(
+                r"^(\w+)\s?\(\s?(DISTINCT\s)?(.+?)\s?\)$", item.strip(), re.IGNORECASE
+            )
+            if aggregate_match:
+                self.__aggregate_parser(*aggregate_match.groups())
+                continue
             alias, select_rule = re.split(r"\.", item, 1)
             if alias not in self.__from.keys():
                 raise ValueError(f"Resource {alias} was used in SELECT {item} but was not defined")
             self.__select[alias].append(f"{self.__from[alias]}.{select_rule}")
 
+    def __aggregate_parser(self, function: str, distinct: str, argument: str):
+        function = function.upper()
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError(
+                f"The aggregate function {function} is not supported, it should be one of "
+                f"{AGGREGATE_FUNCTIONS}"
+            )
+        name = f"{function}({'DISTINCT ' if distinct else ''}{argument})"
+        aggregate = {"function": function.lower()}
+        if argument == "*":
+            if distinct:
+                raise ValueError(f"{name} couldn't be parsed, DISTINCT needs a column")
+        else:
+            alias, select_rule = re.split(r"\.", argument, 1)
+            if alias not in self.__from.keys():
+                raise ValueError(f"Resource {alias} was used in SELECT {name} but was not defined")
+            aggregate["alias"] = alias
+            aggregate["column"] = (
+                select_rule if select_rule == "_id" else f"{self.__from[alias]}.{select_rule}"
+            )
+        if distinct:
+            aggregate["distinct"] = True
+        self.__aggregate[name] = aggregate
+
     def __from_parser(self, string):
         if "," not in string:
             table_aliases = [string]
@@ -196,41 +254,96 @@ WHERE ...
         return alias_parent, searchparam_parent, alias_child
 
     def __where_parser(self, string):
-        item_parsed = re.split(create_mask("AND"), string)
+        item_parsed = split_unquoted(create_mask("AND"), string)
         for where_condition in item_parsed:
-            condition_parsed = re.split(
-                create_mask("=", keep_separators=True, optional_spaces=True), where_condition
-            )
-            if len(condition_parsed) != 3:
-                condition_parsed = re.split(
-                    create_mask(PREFIX, keep_separators=True), where_condition
-                )
-            if len(condition_parsed) != 3:
-                raise ValueError(f"The WHERE condition {where_condition} couldn't be parsed")
-            alias, where_rule = re.split(r"\.", condition_parsed[0], 1)
-            quotes_match = re.search(r"^['\"](.*)['\"]$", condition_parsed[2])
-            value = quotes_match.group(1) if quotes_match else condition_parsed[2]
+            in_match = re.search(r"^\s*(\S+)\s+IN\s*\((.*)\)\s*$", where_condition, re.IGNORECASE)
+            if in_match:
+                alias, where_rule = re.split(r"\.", in_match.group(1), 1)
+                values = [
+                    self.__where_value(value.strip())
+                    for value in split_unquoted(",", in_match.group(2))
+                ]
+            else:
+                parenthesis_match = re.search(r"^\s*\((.*)\)\s*$", where_condition)
+                if parenthesis_match:
+                    where_condition = parenthesis_match.group(1)
+                or_conditions = [
+                    self.__where_condition_parser(condition)
+                    for condition in split_unquoted(create_mask("OR"), where_condition)
+                ]
+                if len({(alias, where_rule) for alias, where_rule, _ in or_conditions}) > 1:
+                    raise ValueError(
+                        f"The WHERE condition {where_condition} couldn't be parsed: OR is only "
+                        "supported between conditions on the same search parameter"
+                    )
+                alias, where_rule, _ = or_conditions[0]
+                values = [value for _, _, value in or_conditions]
 
             if where_rule not in self.__where[alias]:
                 self.__where[alias][where_rule] = []
 
-            if condition_parsed[1] in PREFIX:
-                prefix = condition_parsed[1]
-                value = {prefix: value}
+            # several values of a condition are combined with OR
+            self.__where[alias][where_rule].append(values if len(values) > 1 else values[0])
+
+    def __where_condition_parser(self, where_condition):
+        condition_parsed = re.split(
+            create_mask("=", keep_separators=True, optional_spaces=True), where_condition
+        )
+        if len(condition_parsed) != 3:
+            condition_parsed = re.split(create_mask(PREFIX, keep_separators=True), where_condition)
+        if len(condition_parsed) != 3:
+            raise ValueError(f"The WHERE condition {where_condition} couldn't be parsed")
+        alias, where_rule = re.split(r"\.", condition_parsed[0].strip(), 1)
+        value = self.__where_value(condition_parsed[2].strip())
+
+        if condition_parsed[1] in PREFIX:
+            prefix = condition_parsed[1]
+            value = {prefix: value}
 
-            self.__where[alias][where_rule].append(value)
+        return alias, where_rule, value
+
+    @staticmethod
+    def __where_value(string):
+        quotes_match = re.search(r"^['\"](.*)['\"]$", string)
+        return quotes_match.group(1) if quotes_match else string
 
     def __order_by_parser(self, string):
-        raise NotImplementedError("The ORDER BY keyword is not supported for the moment.")
+        item_parsed = re.split(create_mask(",", optional_spaces=True), string)
+        for item in item_parsed:
+            order_parsed = item.strip().split(" ")
+            direction = order_parsed[1].upper() if len(order_parsed) == 2 else "ASC"
+            if len(order_parsed) > 2 or direction not in ["ASC", "DESC"]:
+                raise ValueError(f"The ORDER BY item {item} couldn't be parsed")
+            alias, order_rule = re.split(r"\.", order_parsed[0], 1)
+            if alias not in self.__from.keys():
+                raise ValueError(
+                    f"Resource {alias} was used in ORDER BY {item} but was not defined"
+                )
+            self.__order_by.append(
+                {"alias": alias, "column": order_rule, "ascending": direction == "ASC"}
+            )
 
     def __group_by_parser(self, string):
-        raise NotImplementedError("The GROUP BY keyword is not supported for the moment.")
+        item_parsed = re.split(create_mask(",", optional_spaces=True), string)
+        for item in item_parsed:
+            alias, group_rule = re.split(r"\.", item.strip(), 1)
+            if alias not in self.__from.keys():
+                raise ValueError(
+                    f"Resource {alias} was used in GROUP BY {item} but was not defined"
+                )
+            self.__group_by.append({"alias": alias, "column": group_rule})
 
     def __union_parser(self, string):
         raise NotImplementedError("The UNION keyword is not supported for the moment.")
 
     def __limit_parser(self, string):
-        raise NotImplementedError("The LIMIT keyword is not supported for the moment.")
+        try:
+            limit = int(string.strip())
+        except ValueError:
+            raise ValueError(f"The LIMIT clause {string} should be a positive integer")
+        if limit <= 0:
+            raise ValueError(f"The LIMIT clause {string} should be a positive integer")
+        self.__limit = limit
 
     @staticmethod
     def __preprocess_sql_string(sql_string: str) -> str:
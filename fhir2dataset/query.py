@@ -1,16 +1,57 @@
 import logging
+import os
+import re
+from itertools import islice, product
+from multiprocessing.pool import ThreadPool
+from typing import Optional
 
+import networkx as nx
 import pandas as pd
 import tqdm
 
-from fhir2dataset.api import ApiRequest
+from fhir2dataset.aggregate import GroupByAggregator
+from fhir2dataset.api import MAX_BATCH_SIZE, ApiCall, ApiRequest
+from fhir2dataset.bulk import CHUNK_SIZE, BulkRequest
+from fhir2dataset.checkpoint import key_digest, remove_checkpoints
+from fhir2dataset.data_class import Aggregate, Element, Elements, GroupBy, OrderBy
 from fhir2dataset.fhirrules import FHIRRules
 from fhir2dataset.graphquery import GraphQuery
+from fhir2dataset.incremental import LAST_UPDATED, IncrementalState, watermark
+from fhir2dataset.normalized import NormalizedResult
+from fhir2dataset.store import LocalStore, check_conditions, filter_conditions
+from fhir2dataset.tools.dataframe import (
+    ReferenceCodes,
+    compact_dtypes,
+    convert_types,
+    drop_duplicate_resources,
+    estimate_join_rows,
+    row_memory,
+    sort_dataframe,
+    unlist_column,
+    upsert_resources,
+)
 from fhir2dataset.tools.graph import join_path
-from fhir2dataset.url_builder import URLBuilder
+from fhir2dataset.url_builder import URLBuilder, add_url_param, searchparam_value, split_url
 
 logger = logging.getLogger(__name__)
 
+# maximum number of groups whose resources are counted by the API
+MAX_PUSHDOWN_GROUPS = 50
+# number of counts asked in parallel to the API
+PARALLEL_COUNTS = 8
+# behaviours when the joined table is estimated to exceed the budget: log a warning, raise
+# an error or return the tables of the aliases without joining them
+JOIN_GUARDS = ["warn", "raise", "normalize"]
+# formats of the result of a query: a single table or a NormalizedResult
+OUTPUTS = ["flat", "normalized"]
+# ways of putting the several values of an element in the result table: a list in a single
+# cell, a row per value or a column per value
+CONCAT_TYPES = ["cell", "row", "col"]
+# number of Patient/[id]/$everything operations run in parallel
+PARALLEL_EVERYTHING = 8
+# name of the temporary column of the integer codes of the join keys
+JOIN_KEY = "_join_key"
+
 
 class Query:
     """Query Executor
@@ -62,7 +103,21 @@ class Query:
                     "searchparam of attribute b of resource type 2": "value 4"
                 },
                 ...
-            }
+            },
+            "order_by": [
+                {"alias": "alias_1", "column": "searchparam/fhirpath", "ascending": true},
+                ...
+            ],
+            "aggregate": {
+                "COUNT(*)": {"function": "count"},
+                "MIN(alias_1.e)": {"function": "min", "alias": "alias_1", "column": "fhirpath e"},
+                ...
+            },
+            "group_by": [
+                {"alias": "alias_1", "column": "searchparam/fhirpath"},
+                ...
+            ],
+            "limit": n
         }
         ```
         for the next associated SQL query:
@@ -76,6 +131,8 @@ class Query:
         AND alias_2.d = "value 2"
         AND alias_3.a = "value 3"
         AND alias_3.b = "value 4"
+        ORDER BY alias_1.searchparam/fhirpath ASC
+        LIMIT n
         ```
 
     Attributes:
@@ -85,6 +142,15 @@ class Query:
         dataframes (dict): dictionary storing for each alias the resources requested on
             the api in tabular format
         main_dataframe (DataFrame): pandas dataframe storing the final result table
+        limit (int): maximum number of rows of the final result table (None if no limit)
+        aggregates (dict): the key is the name of the aggregate column (e.g. COUNT(*)) and
+            the value the Aggregate to compute
+        order_by (list): the OrderBy sort keys of the final result table
+        group_by (list): the GroupBy group keys of the aggregates
+        max_join_rows (int): maximum number of rows of the joined table
+        max_join_memory (int): maximum memory of the joined table, in bytes
+        join_guard (str): what to do when the joined table is estimated to exceed
+            max_join_rows or max_join_memory: 'warn', 'raise' or 'normalize'
     """  # noqa
 
     def __init__(
@@ -92,6 +158,23 @@ class Query:
         fhir_api_url: str = None,
         token: str = None,
         fhir_rules: FHIRRules = None,
+        max_join_rows: int = None,
+        max_join_memory: int = None,
+        join_guard: str = "warn",
+        infer_types: bool = False,
+        concat_type: str = "cell",
+        extraction_workers: int = None,
+        prefetch_pages: bool = False,
+        shards: int = None,
+        batch_requests: bool = False,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        post_search: bool = False,
+        patient_everything: bool = False,
+        bulk_dir: str = None,
+        store: LocalStore = None,
+        state_dir: str = None,
+        checkpoint_dir: str = None,
+        resume: bool = False,
     ):
         """Requestor's initialisation
 
@@ -101,7 +184,93 @@ class Query:
                 if necessary
             fhir_rules (FHIRRules): (Optional) an instance of FHIR rules, initialized
                 with search parameters
+            max_join_rows (int): (Optional) maximum number of rows of the joined table
+            max_join_memory (int): (Optional) maximum memory of the joined table, in bytes
+            join_guard (str): what to do when the joined table is estimated, before the
+                joins, to exceed max_join_rows or max_join_memory: 'warn' logs a warning,
+                'raise' raises a ValueError and 'normalize' returns the tables of the aliases
+                without joining them, as a NormalizedResult (default: {"warn"})
+            infer_types (bool): if true, the selected columns whose type is known from the
+                FHIR element (dates, numbers and booleans, e.g. birthDate or
+                valueQuantity.value) are converted to datetime64, float and boolean columns
+                (default: {False})
+            concat_type (str): how the several values of a selected element are put in the
+                result table: 'cell' keeps them as a list in a single cell, 'row' creates a
+                row per value and 'col' a column '<column>_<i>' per value. It can be set per
+                column with the 'concat' key of the configuration (default: {"cell"})
+            extraction_workers (int): (Optional) number of processes extracting the elements
+                from the pages in parallel, while the next pages are requested, e.g.
+                os.cpu_count() when the FHIR server answers faster than the pages are
+                extracted
+            prefetch_pages (bool): if true, the next page of a search is requested while the
+                current page is processed (default: {False})
+            shards (int): (Optional) maximum number of disjoint _lastUpdated windows a search
+                with several pages is split into, the windows being paged in parallel. It
+                works with servers which don't support _getpagesoffset
+            batch_requests (bool): if true, the independent count requests are grouped into
+                Bundles of type batch POSTed to the service base URL. It should only be set for
+                servers supporting batches; if the server rejects a batch, the requests are
+                sent one by one (default: {False})
+            max_batch_size (int): maximum number of requests grouped into a Bundle
+                (default: {50})
+            post_search (bool): if true, the searches whose url is too long are sent in a
+                single POST [type]/_search request with form-encoded parameters, instead of
+                being split into several searches. It should only be set for servers
+                supporting it (default: {False})
+            patient_everything (bool): if true, when the aliases are all joined to a single
+                Patient alias and the other aliases have no condition on a searchparam, the
+                patients are searched and the resources of the other aliases are retrieved
+                with the Patient/[id]/$everything operation of each patient, instead of a search
+                over the whole server per alias (default: {False})
+            bulk_dir (str): (Optional) directory of the NDJSON files of a FHIR Bulk Data export
+                ($export). If given, the resources are read from the files of their type
+                instead of being searched on the API, and all the where conditions are
+                evaluated on the values extracted from the resources. The files are extracted
+                in parallel by extraction_workers processes. It can't be used with store,
+                patient_everything, state_dir or checkpoint_dir, nor can store
+            store (LocalStore): (Optional) a local store of snapshots of a FHIR server. If
+                given, the where conditions on search parameters are answered by its index
+                and only the matching resources are read from its files, instead of being
+                searched on the API
+            state_dir (str): (Optional) directory of the state of the incremental executions.
+                If given, the dataframes of the aliases and the most recent meta.lastUpdated
+                of their resources are stored there, and the next executions of the same query
+                only retrieve the resources updated since then (with _lastUpdated=gt...), the
+                deleted ones being found with _history when the server supports it. The
+                joins are only made again if a resource changed
+            checkpoint_dir (str): (Optional) directory where the pages retrieved from the API
+                are stored every few pages, with the next link of the last page stored, so
+                that an execution interrupted (e.g. by a network error) can be resumed. The
+                pages of an execution are removed once all the resources are retrieved
+            resume (bool): if true, the execution resumes the searches of the last
+                interrupted execution of the same query from their last stored page, instead
+                of starting them over. It needs checkpoint_dir (default: {False})
         """  # noqa
+        if join_guard not in JOIN_GUARDS:
+            raise ValueError(f"join_guard should be one of {JOIN_GUARDS}, got {join_guard}")
+        if concat_type not in CONCAT_TYPES:
+            raise ValueError(f"concat_type should be one of {CONCAT_TYPES}, got {concat_type}")
+        if resume and checkpoint_dir is None:
+            raise ValueError("resume needs the checkpoint_dir of the interrupted execution")
+        if bulk_dir is not None and store is not None:
+            raise ValueError(
+                "bulk_dir and store can't be both given, the resources are read from one of them"
+            )
+        local_source = (
+            "bulk_dir" if bulk_dir is not None else "store" if store is not None else None
+        )
+        # the options of the retrieval of the resources from the API
+        api_options = {
+            "patient_everything": patient_everything,
+            "state_dir": state_dir,
+            "checkpoint_dir": checkpoint_dir,
+        }
+        for option, value in api_options.items():
+            if local_source is not None and value:
+                raise ValueError(
+                    f"{option} can't be used with {local_source}: the resources are read from "
+                    "local files instead of being retrieved from the API"
+                )
         self.fhir_api_url = fhir_api_url or "http://hapi.fhir.org/baseR4/"
         if not fhir_rules:
             fhir_rules = FHIRRules(fhir_api_url=self.fhir_api_url)
@@ -112,6 +281,30 @@ class Query:
         self.graph_query = None
         self.dataframes = {}
         self.main_dataframe = None
+        self.limit = None
+        self.aggregates = {}
+        self.order_by = []
+        self.group_by = []
+        self._reference_codes = ReferenceCodes()
+        self.max_join_rows = max_join_rows
+        self.max_join_memory = max_join_memory
+        self.join_guard = join_guard
+        self.infer_types = infer_types
+        self.concat_type = concat_type
+        self.concat_types = {}
+        self.extraction_workers = extraction_workers
+        self.prefetch_pages = prefetch_pages
+        self.shards = shards
+        self.batch_requests = batch_requests
+        self.max_batch_size = max_batch_size
+        self.post_search = post_search
+        self.patient_everything = patient_everything
+        self.bulk_dir = bulk_dir
+        self.store = store
+        self.state_dir = state_dir
+        self._state = None
+        self.checkpoint_dir = checkpoint_dir
+        self.resume = resume
 
     def from_config(self, config: dict):
         """Executes the query from a dictionary in the format of a configuration file
@@ -119,15 +312,41 @@ class Query:
         Arguments:
             config (dict): dictionary in the format of a configuration file
         """
+        self.aggregates = {
+            name: Aggregate(**aggregate) for name, aggregate in config.get("aggregate", {}).items()
+        }
+
+        # the columns on which aggregates are computed need to be retrieved
+        select_dict = {alias: list(cols) for alias, cols in config.get("select", {}).items()}
+        for aggregate in self.aggregates.values():
+            if aggregate.column in [None, "_id"]:
+                continue
+            if aggregate.column not in select_dict.setdefault(aggregate.alias, []):
+                select_dict[aggregate.alias].append(aggregate.column)
+
         self.config = {
             "from_dict": config.get("from", None),
-            "select_dict": config.get("select", None),
+            "select_dict": select_dict or None,
             "where_dict": config.get("where", None),
             "join_dict": config.get("join", None),
         }
+        self.order_by = [OrderBy(**order_by) for order_by in config.get("order_by", [])]
+        if self.order_by:
+            self.config["order_by_list"] = self.order_by
+        self.group_by = [GroupBy(**group_by) for group_by in config.get("group_by", [])]
+        if self.group_by:
+            self.config["group_by_list"] = self.group_by
+        self.limit = config.get("limit", None)
+        self.concat_types = config.get("concat", {})
+        for alias_concat_types in self.concat_types.values():
+            for concat_type in alias_concat_types.values():
+                if concat_type not in CONCAT_TYPES:
+                    raise ValueError(
+                        f"concat types should be one of {CONCAT_TYPES}, got {concat_type}"
+                    )
         return self
 
-    def execute(self, debug: bool = False):
+    def execute(self, debug: bool = False, output: str = "flat"):
         """Executes the complete query
 
         1. constructs a GraphQuery object to store the query as a graph
@@ -139,41 +358,1078 @@ class Query:
             debug (bool): if debug is true then the columns needed for internal processing
                 are kept in the final dataframe. Otherwise only the columns of the select are
                 kept in the final dataframe. (default: {False})
+            output (str): 'flat' to return the result table, 'normalized' to return a
+                NormalizedResult with a table per alias and a link table per join, the joins
+                being only made if its flatten method is called (default: {"flat"})
         """  # noqa
-        self.graph_query = GraphQuery(fhir_api_url=self.fhir_api_url, fhir_rules=self.fhir_rules)
-        self.graph_query.build(**self.config)
+        if output not in OUTPUTS:
+            raise ValueError(f"output should be one of {OUTPUTS}, got {output}")
+        self._build_graph_query()
+
+        if self.aggregates or self.group_by:
+            return self._execute_aggregates()
+
+        self._retrieve()
+        if self._state is not None and not self._state.changed and output == "flat":
+            result = self._state.result(debug)
+            if result is not None:
+                logger.info("no resource changed, the result of the last execution is returned")
+                self.main_dataframe = result
+                return self.main_dataframe
+
+        result = self._process(debug=debug, output=output)
+        if self._state is not None and isinstance(result, pd.DataFrame):
+            self._state.save_result(result, debug)
+        return result
 
+    def _retrieve(self):
+        """Retrieves the resources of all the aliases from the API, or from the files of the
+        Bulk Data export or of the local store if given"""  # noqa
+        logger.info(f"where conditions evaluated:\n{self.predicate_report()}")
+        if self.checkpoint_dir is not None and not self.resume:
+            remove_checkpoints(self._checkpoint_path())
         with tqdm.tqdm(
             total=1, unit_scale=100, bar_format="{l_bar}{bar}| {n:.02f}/{total:.02f}"
         ) as pbar:
-            bar_frac = 1 / len(self.graph_query.resources_by_alias)
-            for resource_alias, resource in self.graph_query.resources_by_alias.items():
-                url = URLBuilder(
-                    fhir_api_url=self.fhir_api_url,
-                    graph_query=self.graph_query,
-                    main_resource_alias=resource_alias,
-                ).compute()
-                call = ApiRequest(
-                    url=url,
-                    elements=resource.elements,
+            patient_alias = None if self._reads_files() else self._everything_alias()
+            if self.bulk_dir is not None:
+                self._read_bulk(pbar)
+            elif self.store is not None:
+                self._read_store(pbar)
+            elif self.state_dir is not None:
+                self._refresh(pbar)
+            elif patient_alias is not None:
+                self._fetch_everything(patient_alias, pbar)
+            elif (
+                self._rows_limit() is not None
+                and len(self.graph_query.resources_by_alias) > 1
+                and (not self.order_by or self._order_alias() is not None)
+            ):
+                self._fetch_semi_joined(pbar)
+            else:
+                self._fetch_dataframes(pbar)
+        if self.checkpoint_dir is not None:
+            # all the resources are retrieved, the execution doesn't need to be resumed
+            remove_checkpoints(self._checkpoint_path())
+
+    def _query_key(self) -> dict:
+        """Returns what identifies the query, for the states and checkpoints stored: its
+        configuration and all the options changing the resources retrieved or the result table
+        (but not the options only changing how the resources are retrieved, e.g. shards)"""  # noqa
+        return {
+            "fhir_api_url": self.fhir_api_url,
+            "config": self.config,
+            "limit": self.limit,
+            "concat": [self.concat_type, self.concat_types],
+            "infer_types": self.infer_types,
+            "join_guard": [self.join_guard, self.max_join_rows, self.max_join_memory],
+            "fhir_rules": [
+                self.fhir_rules.path,
+                self.fhir_rules.searchparameters_filename,
+                self.fhir_rules.max_chain_depth,
+            ],
+            "patient_everything": self.patient_everything,
+            "post_search": self.post_search,
+            "bulk_dir": self.bulk_dir,
+            "store": self.store.directory if self.store is not None else None,
+        }
+
+    def _checkpoint_path(self) -> Optional[str]:
+        """Returns the directory of the checkpoints of the query, None if there are none"""
+        if self.checkpoint_dir is None:
+            return None
+        return os.path.join(self.checkpoint_dir, key_digest(self._query_key()))
+
+    def _reads_files(self) -> bool:
+        """Checks whether the resources are read from local files instead of the API"""
+        return self.bulk_dir is not None or self.store is not None
+
+    def _rows_limit(self) -> int:
+        """Returns the maximum number of rows of the result table before any aggregation"""
+        if self.aggregates or self.group_by:
+            return None
+        return self.limit
+
+    def _execute_aggregates(self) -> pd.DataFrame:
+        """Computes the aggregates of the query for each group
+
+        1. the aggregates are computed by the API when possible (COUNT without GROUP BY, or
+           COUNT(*) grouped by keys whose values are known)
+        2. otherwise they are computed locally. For a single alias, the aggregates are updated
+           page by page while paging, so only the aggregates of each group are kept in memory.
+
+        Returns:
+            pd.DataFrame: a table with the group keys and a column per aggregate
+        """  # noqa
+        if not self.group_by and all(
+            aggregate.function == "count" for aggregate in self.aggregates.values()
+        ):
+            return self._execute_count()
+
+        result = self._group_count_pushdown() if self.group_by else None
+        if result is None:
+            result = self._aggregate_locally()
+
+        if self.limit is not None:
+            result = result.iloc[: self.limit]
+        self.main_dataframe = result
+        return self.main_dataframe
+
+    def _group_key_name(self, group_by: GroupBy) -> str:
+        """Name of the column of a group key in the result table (e.g. p:Patient.gender)"""
+        resource_type = self.graph_query.resources_by_alias[group_by.alias].resource_type
+        if group_by.column.startswith(f"{resource_type}."):
+            return f"{group_by.alias}:{group_by.column}"
+        return f"{group_by.alias}:{resource_type}.{group_by.column}"
+
+    def _group_count_pushdown(self) -> pd.DataFrame:
+        """Counts the resources of each group with parallel _summary=count calls, one per
+        combination of the values of the group keys (and one per missing key).
+
+        It is possible if the query only computes COUNT(*), if the count can be asked to the
+        API (see _count_pushdown) and if the group keys are search parameters of the
+        counted alias whose values are known.
+
+        Returns:
+            pd.DataFrame: a table with the group keys and the count, None if the counts can't
+                be computed by the API
+        """  # noqa
+        if not all(
+            aggregate.function == "count" and aggregate.column is None
+            for aggregate in self.aggregates.values()
+        ):
+            return None
+        counted_alias, url = self._count_pushdown(Aggregate(function="count"))
+        if url is None:
+            return None
+
+        resource_type = self.graph_query.resources_by_alias[counted_alias].resource_type
+        params_by_key = []
+        for group_by in self.group_by:
+            if group_by.alias != counted_alias or not self.fhir_rules.is_searchparam(
+                group_by.column, resource_type
+            ):
+                return None
+            values = group_by.values or self.fhir_rules.searchparam_values(group_by.column)
+            if values is None:
+                return None
+            params = [((group_by.column, value), value) for value in values]
+            params.append(((f"{group_by.column}:missing", "true"), None))
+            params_by_key.append(params)
+
+        combinations = list(product(*params_by_key))
+        if len(combinations) > MAX_PUSHDOWN_GROUPS:
+            return None
+
+        urls = []
+        for combination in combinations:
+            group_url = url
+            for (key, value), _ in combination:
+                group_url = add_url_param(group_url, key, value)
+            urls.append(group_url)
+        logger.info(f"the resources of {len(urls)} groups are counted by the API")
+        totals = self._get_counts(urls)
+
+        rows = [
+            [value for _, value in combination] + [total] * len(self.aggregates)
+            for combination, total in zip(combinations, totals)
+            if total > 0
+        ]
+        columns = [self._group_key_name(group_by) for group_by in self.group_by]
+        return pd.DataFrame(rows, columns=columns + list(self.aggregates))
+
+    def _aggregate_locally(self) -> pd.DataFrame:
+        """Computes the aggregates of each group on the resources retrieved from the API. The
+        resources of a single alias are aggregated page by page, unless they are stored in the
+        state directory or checkpointed, in which case they are retrieved as for the other
+        queries
+
+        Returns:
+            pd.DataFrame: a table with the group keys and a column per aggregate
+        """
+        paged = (
+            len(self.graph_query.resources_by_alias) == 1
+            and not self._reads_files()
+            and self.state_dir is None
+            and self.checkpoint_dir is None
+        )
+        # the columns of the pages are not prefixed by the alias, unlike the ones of the
+        # result table
+        prefixes = {
+            resource_alias: "" if paged else f"{resource_alias}:"
+            for resource_alias in self.graph_query.resources_by_alias
+        }
+        keys = [f"{prefixes[group_by.alias]}group_{group_by.column}" for group_by in self.group_by]
+        columns = {
+            name: (
+                None
+                if aggregate.column is None
+                else prefixes[aggregate.alias]
+                + ("from_id" if aggregate.column == "_id" else aggregate.column)
+            )
+            for name, aggregate in self.aggregates.items()
+        }
+        aggregator = GroupByAggregator(keys, self.aggregates, columns)
+
+        if paged:
+            # the aggregates are updated page by page
+            resource_alias = list(self.graph_query.resources_by_alias)[0]
+            with tqdm.tqdm(
+                total=1, unit_scale=100, bar_format="{l_bar}{bar}| {n:.02f}/{total:.02f}"
+            ) as pbar:
+                ApiRequest(
+                    url=self._compute_url(resource_alias),
+                    elements=self.graph_query.resources_by_alias[resource_alias].elements,
                     token=self.token,
                     pbar=pbar,
-                    bar_frac=bar_frac,
+                    bar_frac=1,
+                    aggregator=aggregator,
+                    residual_filter=self._residual_filter(resource_alias),
+                    extraction_workers=self.extraction_workers,
+                    prefetch_pages=self.prefetch_pages,
+                    shards=self.shards,
+                    post_search=self.post_search,
+                ).get_all()
+        else:
+            self._retrieve()
+            aggregator.update(self._process(debug=True))
+
+        result = aggregator.result()
+        result.columns = [self._group_key_name(group_by) for group_by in self.group_by] + list(
+            self.aggregates
+        )
+        return result
+
+    def _execute_count(self) -> pd.DataFrame:
+        """Computes the COUNT aggregates of the query
+
+        Each count is asked to the API with _summary=count when the query can be written as
+        a single search (see _count_pushdown). Otherwise, all the resources are retrieved
+        and the count is computed on the result table.
+
+        Returns:
+            pd.DataFrame: a table with a single row and a column per aggregate
+        """  # noqa
+        urls = {}
+        for name, aggregate in self.aggregates.items():
+            _, url = self._count_pushdown(aggregate)
+            if url is not None:
+                logger.info(f"{name} is computed by the API with {url}")
+                urls[name] = url
+        counts = dict(zip(urls, self._get_counts(list(urls.values()))))
+
+        remaining = [name for name in self.aggregates if name not in counts]
+        if remaining:
+            logger.info(f"{remaining} can't be computed by the API, the resources are retrieved")
+            self._retrieve()
+            df = self._process(debug=True)
+            for name in remaining:
+                counts[name] = self._count(df, self.aggregates[name])
+
+        self.main_dataframe = pd.DataFrame({name: [counts[name]] for name in self.aggregates})
+        return self.main_dataframe
+
+    def _count_pushdown(self, aggregate: Aggregate) -> tuple:
+        """Finds, if it exists, the url of a search whose total is the value of the aggregate
+
+        It is the case if all the joins are inner joins, if all the "where conditions" are
+        search parameters and if all of them are taken into account in the url of the search
+        on the counted alias:
+            * for COUNT(DISTINCT alias._id), the counted alias is alias
+            * for COUNT(*), the counted alias must reference (directly or not) all the other
+              aliases, so that each of its resources matches a single row of the result
+              table (assuming the references used in the joins are single-valued)
+        Every other alias needs at least one "where condition", otherwise nothing in the url
+        ensures that the counted resources are joined with a resource of this alias.
+
+        Arguments:
+            aggregate (Aggregate): a COUNT aggregate
+
+        Returns:
+            tuple: the counted alias and the url of the search, (None, None) if the count can't
+                be computed by the API
+        """  # noqa
+        if self._reads_files():
+            # the resources are read from files, there is no API to count them
+            return None, None
+        graph = self.graph_query.resources_graph
+        if any(graph.edges[edge]["info"].join_how != "inner" for edge in graph.edges):
+            return None, None
+        for resource in self.graph_query.resources_by_alias.values():
+            for element in resource.elements.where(goal="where"):
+                code = element.search_parameter.code
+                if not self.fhir_rules.is_searchparam(code, resource.resource_type):
+                    return None, None
+
+        if aggregate.column is None:
+            candidates = [
+                resource_alias
+                for resource_alias in graph.nodes
+                if graph.number_of_edges() == graph.number_of_nodes() - 1
+                and all(
+                    graph.edges[alias_1, alias_2]["info"].parent == alias_1
+                    for alias_1, alias_2 in nx.bfs_edges(graph, resource_alias)
+                )
+            ]
+        elif aggregate.column == "_id" and aggregate.distinct:
+            candidates = [aggregate.alias]
+        else:
+            candidates = []
+
+        for resource_alias in candidates:
+            url_builder = self._url_builder(resource_alias)
+            url = url_builder.compute()
+            if url_builder.pushed_aliases != set(graph.nodes):
+                continue
+            if all(
+                resource.elements.where(goal="where")
+                for other_alias, resource in self.graph_query.resources_by_alias.items()
+                if other_alias != resource_alias
+            ):
+                return resource_alias, url
+        return None, None
+
+    @staticmethod
+    def _count(df: pd.DataFrame, aggregate: Aggregate) -> int:
+        """Computes a COUNT aggregate on the result table (kept with the internal columns)
+
+        Arguments:
+            df (pd.DataFrame): the result table
+            aggregate (Aggregate): a COUNT aggregate
+
+        Returns:
+            int: the value of the aggregate
+        """
+        if aggregate.column is None:
+            return len(df)
+        column = "from_id" if aggregate.column == "_id" else aggregate.column
+        values = df[f"{aggregate.alias}:{column}"]
+        if aggregate.distinct:
+            return values.explode().dropna().astype(str).nunique()
+        return int(values.notna().sum())
+
+    def _build_graph_query(self) -> GraphQuery:
+        """Builds the GraphQuery object storing the query as a graph
+
+        Returns:
+            GraphQuery: the graph representation of the query
+        """
+        self.graph_query = GraphQuery(fhir_api_url=self.fhir_api_url, fhir_rules=self.fhir_rules)
+        self.graph_query.build(**self.config)
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            concat_types = self.concat_types.get(resource_alias, {})
+            for element in resource.elements.where(goal="select"):
+                if element.col_name != "from_id":
+                    element.concat_type = concat_types.get(element.col_name, self.concat_type)
+            if self.state_dir is not None:
+                resource.elements.append(
+                    Element(
+                        goal="watermark",
+                        col_name=LAST_UPDATED,
+                        fhirpath=f"{resource.resource_type}.meta.lastUpdated",
+                    )
+                )
+        return self.graph_query
+
+    def _compute_urls(self) -> dict:
+        """Computes the url of the request sent to the API for each alias
+
+        Returns:
+            dict: the key is an alias and the value the url retrieving its resources
+        """
+        return {
+            resource_alias: self._compute_url(resource_alias)
+            for resource_alias in self.graph_query.resources_by_alias.keys()
+        }
+
+    def _url_builder(self, resource_alias: str) -> URLBuilder:
+        """Returns the URLBuilder of the url of an alias. In incremental mode, the url only
+        takes into account the conditions of the alias itself, so that its resources don't
+        depend on the resources of the other aliases, which may be updated independently"""  # noqa
+        return URLBuilder(
+            fhir_api_url=self.fhir_api_url,
+            graph_query=self.graph_query,
+            main_resource_alias=resource_alias,
+            max_chain_depth=0 if self.state_dir is not None else None,
+        )
+
+    def _compute_url(self, resource_alias: str, params: dict = None) -> str:
+        """Computes the url of the request sent to the API for an alias
+
+        Arguments:
+            resource_alias (str): alias of the resources to retrieve
+            params (dict): (Optional) search parameters to add to the ones deduced from the
+                query, the key is the search parameter and the value its value
+
+        Returns:
+            str: the url retrieving the resources of the alias
+        """  # noqa
+        url_builder = self._url_builder(resource_alias)
+        for key, value in (params or {}).items():
+            url_builder.add_param(key, value)
+        sort_param = self._sort_param(resource_alias)
+        if sort_param is not None:
+            url_builder.add_param("_sort", sort_param)
+        return url_builder.compute()
+
+    def _fetch(
+        self,
+        resource_alias: str,
+        url: str,
+        pbar=None,
+        bar_frac: float = 0,
+        limit: int = None,
+        total: int = None,
+    ) -> pd.DataFrame:
+        """Retrieves the resources of an alias from the API
+
+        Arguments:
+            resource_alias (str): alias of the resources to retrieve
+            url (str): url of the request
+            pbar: (Optional) tqdm progress bar object
+            bar_frac (float): fraction of the progress bar allocated to this request
+            limit (int): (Optional) maximum number of resources to retrieve
+            total (int): (Optional) number of resources matching the url, if already known
+
+        Returns:
+            pd.DataFrame: the elements of the alias retrieved in tabular format
+        """  # noqa
+        sort_param = self._sort_param(resource_alias)
+        if sort_param is not None and not self.post_search and len(split_url(url)) > 1:
+            # each of the urls the url is split into is sorted by the API but not their union
+            sort_param = None
+        sort_by = None
+        if limit is not None and self._order_alias() == resource_alias and sort_param is None:
+            # the API can't sort the resources, the top-k resources are kept while paging
+            sort_by = [
+                (f"order_{order_by.column}", order_by.ascending) for order_by in self.order_by
+            ]
+
+        call = ApiRequest(
+            url=url,
+            elements=self.graph_query.resources_by_alias[resource_alias].elements,
+            token=self.token,
+            pbar=pbar,
+            bar_frac=bar_frac,
+            limit=limit,
+            sort_by=sort_by,
+            residual_filter=self._residual_filter(resource_alias),
+            total=total,
+            extraction_workers=self.extraction_workers,
+            prefetch_pages=self.prefetch_pages,
+            shards=self.shards,
+            post_search=self.post_search,
+            checkpoint_dir=self._checkpoint_path(),
+        )
+        df = call.get_all()
+        if sort_param is not None:
+            # keep the order given by the API
+            df["order_rank"] = range(len(df))
+        return df
+
+    def _residual_conditions(self, resource_alias: str) -> list:
+        """Returns the where elements of an alias whose conditions can't be sent to the API
+        because they are not on searchparams (e.g. WHERE p.name.family = 'Chopin'), all of
+        them if the resources are read from a Bulk Data export and the ones the index can't
+        answer if they are read from a local store"""  # noqa
+        resource = self.graph_query.resources_by_alias[resource_alias]
+        if self.bulk_dir is not None:
+            return resource.elements.where(goal="where")
+        if self.store is not None:
+            return [
+                element
+                for element in resource.elements.where(goal="where")
+                if not self.store.is_indexed(resource.resource_type, element.search_parameter.code)
+            ]
+        return [
+            element
+            for element in resource.elements.where(goal="where")
+            if not self.fhir_rules.is_searchparam(
+                element.search_parameter.code, resource.resource_type
+            )
+        ]
+
+    def _residual_filter(self, resource_alias: str):
+        """Returns the function filtering the resources of an alias with its residual
+        conditions, None if it has none"""  # noqa
+        if not self._residual_conditions(resource_alias):
+            return None
+        return lambda df: self._filter_residuals(resource_alias, df)
+
+    def _filter_residuals(self, resource_alias: str, df: pd.DataFrame) -> pd.DataFrame:
+        """Keeps the resources of an alias respecting its residual conditions, evaluated on the
+        where columns extracted from the resources
+
+        Arguments:
+            resource_alias (str): alias of the resources
+            df (pd.DataFrame): the elements of the alias retrieved in tabular format
+
+        Returns:
+            pd.DataFrame: the rows of df respecting the conditions
+        """  # noqa
+        kept = filter_conditions(df, self._residual_conditions(resource_alias))
+        logger.debug(f"{len(kept)}/{len(df)} resources of {resource_alias} kept")
+        return kept
+
+    def predicate_report(self) -> pd.DataFrame:
+        """Reports where each condition of the query is evaluated: by the API, in the searches
+        of the aliases listed, by the index of the local store, or by the client on the
+        retrieved resources of its alias
+
+        Returns:
+            pd.DataFrame: a table with a row per condition
+        """  # noqa
+        if self.graph_query is None:
+            self._build_graph_query()
+        pushed_aliases = {}
+        for resource_alias in self.graph_query.resources_by_alias:
+            url_builder = self._url_builder(resource_alias)
+            url_builder.compute()
+            pushed_aliases[resource_alias] = url_builder.pushed_aliases
+
+        rows = []
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            residuals = self._residual_conditions(resource_alias)
+            for element in resource.elements.where(goal="where"):
+                search_param = element.search_parameter
+                if element in residuals:
+                    applied_by, searches = "client", [resource_alias]
+                elif self.store is not None:
+                    applied_by, searches = "index", [resource_alias]
+                else:
+                    applied_by = "server"
+                    searches = [
+                        searching_alias
+                        for searching_alias, aliases in pushed_aliases.items()
+                        if resource_alias in aliases
+                    ]
+                rows.append(
+                    {
+                        "alias": resource_alias,
+                        "condition": f"{search_param.code}={searchparam_value(search_param)}",
+                        "applied_by": applied_by,
+                        "searches": searches,
+                    }
+                )
+        return pd.DataFrame(rows, columns=["alias", "condition", "applied_by", "searches"])
+
+    def _fetch_dataframes(self, pbar=None):
+        """Retrieves independently the resources of each alias from the API
+
+        When all the joins are inner joins, the result is empty as soon as an alias has no
+        resources. The number of resources of each alias is then first asked to the API and
+        the aliases are retrieved from the most selective one: once an alias is empty, the
+        other aliases are not requested.
+        """  # noqa
+        bar_frac = 1 / len(self.graph_query.resources_by_alias)
+        limit = self._rows_limit() if len(self.graph_query.resources_by_alias) == 1 else None
+        urls = self._compute_urls()
+        totals = self._probe_totals(urls)
+        empty_alias = None
+        for resource_alias in sorted(urls, key=lambda alias: totals.get(alias, float("inf"))):
+            if empty_alias is not None:
+                logger.info(f"{empty_alias} is empty, {resource_alias} is not requested")
+                self.dataframes[resource_alias] = self._empty_dataframe(resource_alias)
+                if pbar is not None:
+                    pbar.update(bar_frac)
+                continue
+            self.dataframes[resource_alias] = self._fetch(
+                resource_alias,
+                urls[resource_alias],
+                pbar=pbar,
+                bar_frac=bar_frac,
+                limit=limit,
+                total=totals.get(resource_alias),
+            )
+            if resource_alias in totals and len(self.dataframes[resource_alias]) == 0:
+                empty_alias = resource_alias
+
+    def _read_bulk(self, pbar=None):
+        """Reads the resources of each alias from the NDJSON files of the Bulk Data export,
+        keeping only the resources respecting the where conditions of the alias
+        """  # noqa
+        bar_frac = 1 / len(self.graph_query.resources_by_alias)
+        limit = self._rows_limit() if len(self.graph_query.resources_by_alias) == 1 else None
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            self.dataframes[resource_alias] = BulkRequest(
+                directory=self.bulk_dir,
+                resource_type=resource.resource_type,
+                elements=resource.elements,
+                conditions=self._residual_conditions(resource_alias),
+                limit=None if self.order_by else limit,
+                workers=self.extraction_workers,
+                pbar=pbar,
+                bar_frac=bar_frac,
+            ).get_all()
+
+    def _refresh(self, pbar=None):
+        """Retrieves the resources of each alias incrementally: the first execution retrieves
+        all of them, the next ones only the resources updated since the watermark of the
+        alias, which replace their previous version in the stored dataframe of the alias
+        """  # noqa
+        self._state = IncrementalState(self.state_dir, self._query_key())
+        bar_frac = 1 / len(self.graph_query.resources_by_alias)
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            previous = self._state.frame(resource_alias)
+            since = self._state.watermarks.get(resource_alias)
+            if previous is None or since is None:
+                df = self._fetch(resource_alias, self._compute_url(resource_alias), pbar, bar_frac)
+                self._state.changed = True
+            else:
+                updated = self._fetch(
+                    resource_alias,
+                    self._compute_url(resource_alias, params={"_lastUpdated": f"gt{since}"}),
+                    pbar,
+                    bar_frac,
+                )
+                changed = self._changed_resources(resource.resource_type, since)
+                logger.info(
+                    f"{resource_alias}: {len(updated)} resources matching the query and "
+                    f"{len(changed)} resources in all updated or deleted since {since}"
+                )
+                df = upsert_resources(previous, updated, changed["from_id"])
+                self._state.changed |= (
+                    len(updated) > 0 or previous["from_id"].isin(changed["from_id"]).any()
+                )
+                # the resources no longer matching the query needn't be checked again
+                self._state.watermarks[resource_alias] = watermark(changed[LAST_UPDATED], since)
+            # the order of the API is lost when the resources are updated
+            self.dataframes[resource_alias] = df.drop(columns="order_rank", errors="ignore")
+        if self._state.changed:
+            self._state.save(self.dataframes)
+        else:
+            # the stored dataframes are still valid since the new watermarks
+            self._state.save_watermarks()
+
+    def _changed_resources(self, resource_type: str, since: str) -> pd.DataFrame:
+        """Returns the resources of a type updated or deleted since an instant: the updated
+        resources, whether they still respect the conditions of the query or not, and the
+        deleted resources found in the _history of the type, if the server supports it
+
+        Arguments:
+            resource_type (str): the resource type
+            since (str): the instant (e.g. 2021-01-01T10:00:00.000Z)
+
+        Returns:
+            pd.DataFrame: the ids of the resources (from_id column) and their meta.lastUpdated
+                if they were not deleted
+        """  # noqa
+        base_url = self.fhir_api_url.rstrip("/")
+        updated = ApiRequest(
+            url=f"{base_url}/{resource_type}?_lastUpdated=gt{since}&_elements=id,meta",
+            elements=Elements(
+                [
+                    Element(col_name="from_id", fhirpath="_id"),
+                    Element(col_name=LAST_UPDATED, fhirpath=f"{resource_type}.meta.lastUpdated"),
+                ]
+            ),
+            token=self.token,
+        ).get_all()
+        deleted_ids = []
+        try:
+            history = ApiRequest(
+                url=f"{base_url}/{resource_type}/_history?_since={since}",
+                elements=Elements(),
+                token=self.token,
+            )
+            for response in history._responses():
+                for entry in response.results or []:
+                    request = entry.get("request", {})
+                    if request.get("method") == "DELETE":
+                        # e.g. Patient/123/_history/2
+                        deleted_ids.append(request["url"].split("/")[1])
+        except ValueError as error:
+            logger.warning(
+                f"The deleted resources of {resource_type} can't be found with _history, "
+                f"they are kept:\n{error}"
+            )
+        deleted = pd.DataFrame({"from_id": deleted_ids, LAST_UPDATED: None})
+        return pd.concat([updated, deleted], ignore_index=True)
+
+    def _read_store(self, pbar=None):
+        """Reads from the local store the resources of each alias respecting its where
+        conditions answered by the index, the other conditions (e.g. with a modifier, such as
+        code:text) being evaluated on the values extracted from the resources with the same
+        search semantics, or raising a ValueError if they can't be
+        """  # noqa
+        bar_frac = 1 / len(self.graph_query.resources_by_alias)
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            residuals = self._residual_conditions(resource_alias)
+            check_conditions(residuals)
+            conditions = [
+                element.search_parameter
+                for element in resource.elements.where(goal="where")
+                if element not in residuals
+            ]
+            limit = None
+            if len(self.graph_query.resources_by_alias) == 1 and not residuals:
+                limit = None if self.order_by else self._rows_limit()
+            request = ApiRequest(url=None, elements=resource.elements)
+            resources = self.store.resources(resource.resource_type, conditions, limit)
+            frames = [request._get_data([])]
+            while True:
+                chunk = [
+                    {"resource": json_resource} for json_resource in islice(resources, CHUNK_SIZE)
+                ]
+                if not chunk:
+                    break
+                frames.append(self._filter_residuals(resource_alias, request._get_data(chunk)))
+            self.dataframes[resource_alias] = pd.concat(frames).reset_index(drop=True)
+            if pbar is not None:
+                pbar.update(bar_frac)
+
+    def _everything_alias(self) -> str:
+        """Returns the Patient alias whose patients' $everything operations can retrieve the
+        resources of the other aliases: if patient_everything is set, there is no LIMIT (the
+        semi-joins retrieve less resources), all the aliases are joined to a single Patient
+        alias and the other aliases have no condition that only a search could evaluate
+
+        Returns:
+            str: the Patient alias, None if the aliases are retrieved with searches
+        """  # noqa
+        if not self.patient_everything or self._rows_limit() is not None:
+            return None
+        resources_by_alias = self.graph_query.resources_by_alias
+        patient_aliases = [
+            resource_alias
+            for resource_alias, resource in resources_by_alias.items()
+            if resource.resource_type == "Patient"
+        ]
+        if len(patient_aliases) != 1 or not nx.is_connected(self.graph_query.resources_graph):
+            return None
+        for resource_alias, resource in resources_by_alias.items():
+            if resource_alias != patient_aliases[0] and len(
+                self._residual_conditions(resource_alias)
+            ) < len(resource.elements.where(goal="where")):
+                logger.info(
+                    f"{resource_alias} has conditions on searchparams: the aliases are retrieved "
+                    f"with searches instead of $everything"
+                )
+                return None
+        return patient_aliases[0]
+
+    def _fetch_everything(self, patient_alias: str, pbar=None):
+        """Searches the patients of the Patient alias, then retrieves in parallel the
+        resources of each patient with Patient/[id]/$everything and splits them by resource
+        type into the dataframes of the other aliases
+
+        Arguments:
+            patient_alias (str): the Patient alias
+            pbar: (Optional) tqdm progress bar object
+        """  # noqa
+        patients = self._fetch(
+            patient_alias, self._compute_url(patient_alias), pbar=pbar, bar_frac=0.5
+        )
+        self.dataframes[patient_alias] = patients
+        patient_ids = list(dict.fromkeys(patients["from_id"]))
+        logger.info(f"the resources of {len(patient_ids)} patients are retrieved with $everything")
+
+        frames_by_patient = []
+        if patient_ids:
+            with ThreadPool(min(len(patient_ids), PARALLEL_EVERYTHING)) as pool:
+                frames_by_patient = pool.map(self._patient_everything, patient_ids)
+        for resource_alias in self.graph_query.resources_by_alias:
+            if resource_alias == patient_alias:
+                continue
+            frames = [frames[resource_alias] for frames in frames_by_patient]
+            # the resources shared by several patients (e.g. practitioners) are kept once
+            df = (
+                drop_duplicate_resources(frames)
+                if frames
+                else self._empty_dataframe(resource_alias)
+            )
+            self.dataframes[resource_alias] = self._filter_residuals(resource_alias, df)
+        if pbar is not None:
+            pbar.update(0.5)
+
+    def _patient_everything(self, patient_id: str) -> dict:
+        """Retrieves the resources of a patient with Patient/[id]/$everything, following the
+        next links, and extracts the elements of each alias other than the Patient alias
+        from the resources of its type
+
+        Arguments:
+            patient_id (str): id of the patient
+
+        Returns:
+            dict: the key is an alias and the value the elements of its resources in tabular
+                format
+        """  # noqa
+        url = f"{self.fhir_api_url.rstrip('/')}/Patient/{patient_id}/$everything"
+        results = []
+        for response in ApiRequest(url=url, elements=Elements(), token=self.token)._responses():
+            results += response.results or []
+
+        frames = {}
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            if resource.resource_type == "Patient":
+                continue
+            frames[resource_alias] = ApiRequest(url=url, elements=resource.elements)._get_data(
+                [
+                    result
+                    for result in results
+                    if result["resource"]["resourceType"] == resource.resource_type
+                ]
+            )
+        return frames
+
+    def _probe_totals(self, urls: dict) -> dict:
+        """Asks in parallel to the API the number of resources of each alias, if the query has
+        several aliases joined only with inner joins
+
+        Arguments:
+            urls (dict): the key is an alias and the value the url retrieving its resources
+
+        Returns:
+            dict: the key is an alias and the value its number of resources (the aliases
+                whose url is too long to be counted at once are missing)
+        """  # noqa
+        graph = self.graph_query.resources_graph
+        if len(urls) == 1 or any(
+            graph.edges[edge]["info"].join_how != "inner" for edge in graph.edges
+        ):
+            return {}
+        probed = {
+            alias: url
+            for alias, url in urls.items()
+            if self.post_search or len(split_url(url)) == 1
+        }
+        if not probed:
+            return {}
+        return dict(zip(probed, self._get_counts(list(probed.values()))))
+
+    def _get_counts(self, urls: list) -> list:
+        """Asks to the API the number of resources matching each url, with Bundles of type
+        batch if batch_requests, otherwise with parallel _summary=count requests
+
+        Arguments:
+            urls (list): the urls of the searches
+
+        Returns:
+            list: the number of resources matching each url
+        """  # noqa
+        if not urls:
+            return []
+        if self.batch_requests and len(urls) > 1:
+            try:
+                return ApiCall(self.fhir_api_url, token=self.token)._get_batch_counts(
+                    urls, self.max_batch_size
+                )
+            except ValueError as error:
+                logger.warning(
+                    f"The batch of count requests failed, the requests are sent one by one "
+                    f"from now on:\n{error}"
+                )
+                self.batch_requests = False
+        api_call = ApiCall(self.fhir_api_url, token=self.token, post_search=self.post_search)
+        with ThreadPool(min(len(urls), PARALLEL_COUNTS)) as pool:
+            return pool.map(api_call._get_count, urls)
+
+    def _empty_dataframe(self, resource_alias: str) -> pd.DataFrame:
+        """Returns a dataframe without resources but with the columns of an alias"""
+        return ApiRequest(
+            url=self._compute_url(resource_alias),
+            elements=self.graph_query.resources_by_alias[resource_alias].elements,
+            token=self.token,
+            post_search=self.post_search,
+        )._get_data([])
+
+    def _fetch_semi_joined(self, pbar=None):
+        """Retrieves only the first resources of the driving alias (limited to the limit
+        attribute) and then, going through the graph, only the resources of the other aliases
+        that are joined with the resources already retrieved.
+
+        As the inner joins can drop resources of the driving alias, the number of resources
+        of the driving alias retrieved is doubled until the joined table has limit rows or
+        all the resources of the driving alias are retrieved
+        """  # noqa
+        driving_alias = self._driving_alias()
+        limit = self._rows_limit()
+        driving_limit = limit
+        while True:
+            self._fetch_joined_to(driving_alias, driving_limit, pbar)
+            if len(self.dataframes[driving_alias]) < driving_limit:
+                return
+            rows = self._joined_rows()
+            if rows >= limit:
+                return
+            logger.info(
+                f"the first {driving_limit} resources of {driving_alias} are joined in only "
+                f"{rows} rows, {2 * driving_limit} resources are retrieved"
+            )
+            driving_limit *= 2
+            pbar = None  # the progress bar only follows the first retrieval
+
+    def _fetch_joined_to(self, driving_alias: str, driving_limit: int, pbar=None):
+        """Retrieves the first driving_limit resources of the driving alias and then, going
+        through the graph, only the resources of the other aliases that are joined with the
+        resources already retrieved"""  # noqa
+        bar_frac = 1 / len(self.graph_query.resources_by_alias)
+        self.dataframes[driving_alias] = self._fetch(
+            driving_alias,
+            self._compute_url(driving_alias),
+            pbar=pbar,
+            bar_frac=bar_frac,
+            limit=driving_limit,
+        )
+
+        for alias_fetched, resource_alias in nx.bfs_edges(
+            self.graph_query.resources_graph, driving_alias
+        ):
+            searchparam, values = self._semi_join_values(alias_fetched, resource_alias)
+            if values:
+                url = self._compute_url(resource_alias, params={searchparam: ",".join(values)})
+                self.dataframes[resource_alias] = self._fetch(
+                    resource_alias, url, pbar=pbar, bar_frac=bar_frac
                 )
-                self.dataframes[resource_alias] = call.get_all()
+            else:
+                logger.info(f"no resource of {resource_alias} is joined, it is not requested")
+                self.dataframes[resource_alias] = self._empty_dataframe(resource_alias)
+
+    def _joined_rows(self) -> int:
+        """Returns the number of rows of the joined table of the dataframes retrieved so far,
+        which are left unchanged"""  # noqa
+        dataframes = self.dataframes
+        self.dataframes = dict(dataframes)
+        try:
+            self._clean_columns()
+            return len(self._join())
+        finally:
+            self.dataframes = dataframes
+
+    def _driving_alias(self) -> str:
+        """Returns the alias from which the joins are made, the alias of the sort keys if any"""
+        return self._order_alias() or join_path(self.graph_query.resources_graph)[0][0]
+
+    def _order_alias(self) -> str:
+        """Returns the alias of the sort keys, None if there are no sort keys or if they are on
+        several aliases
+        """  # noqa
+        aliases = {order_by.alias for order_by in self.order_by}
+        return aliases.pop() if len(aliases) == 1 else None
+
+    def _sort_param(self, resource_alias: str) -> str:
+        """Computes the value of the _sort search parameter that makes the API return the
+        resources of resource_alias in the order of the result table
+
+        Arguments:
+            resource_alias (str): an alias
+
+        Returns:
+            str: the value of _sort (e.g. '-birthdate,family'), None if the resources of
+                resource_alias can't be sorted by the API
+        """  # noqa
+        if self._order_alias() != resource_alias:
+            return None
+        resource_type = self.graph_query.resources_by_alias[resource_alias].resource_type
+        if not all(
+            self.fhir_rules.is_searchparam(order_by.column, resource_type)
+            for order_by in self.order_by
+        ):
+            return None
+        return ",".join(
+            f"{'' if order_by.ascending else '-'}{order_by.column}" for order_by in self.order_by
+        )
 
+    def _sort(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Sorts the result table according to the sort keys of the query
+
+        Arguments:
+            df (pd.DataFrame): the result table
+
+        Returns:
+            pd.DataFrame: the sorted result table
+        """
+        rank_column = f"{self._order_alias()}:order_rank"
+        if rank_column in df.columns:
+            # the resources have been sorted by the API
+            return df.sort_values(rank_column, kind="mergesort", na_position="last")
+        return sort_dataframe(
+            df,
+            [f"{order_by.alias}:order_{order_by.column}" for order_by in self.order_by],
+            [order_by.ascending for order_by in self.order_by],
+        )
+
+    def _semi_join_values(self, alias_fetched: str, resource_alias: str) -> tuple:
+        """Computes the search parameter, and its values, restricting the resources of
+        resource_alias to the ones joined with the resources already retrieved for alias_fetched
+
+        Arguments:
+            alias_fetched (str): alias whose dataframe has already been retrieved
+            resource_alias (str): neighbouring alias of alias_fetched that will be retrieved
+
+        Returns:
+            tuple: the search parameter and the list of its values (e.g. ('_id', ['1', '2']))
+        """  # noqa
+        edge_info = self.graph_query.resources_graph.edges[alias_fetched, resource_alias]["info"]
+        df = self.dataframes[alias_fetched]
+
+        if alias_fetched == edge_info.parent:
+            # the fetched resources reference the resources to retrieve
+            resource_type = self.graph_query.resources_by_alias[resource_alias].resource_type
+            references = df[f"join_{edge_info.searchparam_parent}"].explode()
+            ids = []
+            for reference in references:
+                if not isinstance(reference, str):
+                    continue
+                sub_references = reference.split("/")
+                if len(sub_references) >= 2 and sub_references[-2] == resource_type:
+                    ids.append(sub_references[-1])
+            return "_id", list(dict.fromkeys(ids))
+        else:
+            # the resources to retrieve reference the fetched resources
+            resource_type = self.graph_query.resources_by_alias[alias_fetched].resource_type
+            references = [f"{resource_type}/{id}" for id in df["from_id"].dropna()]
+            return edge_info.searchparam_parent, list(dict.fromkeys(references))
+
+    def _process(self, debug: bool = False, output: str = "flat") -> pd.DataFrame:
+        """Turns the dataframes retrieved for each alias into the result table
+
+        Arguments:
+            debug (bool): if debug is true then the columns needed for internal processing
+                are kept in the final dataframe. (default: {False})
+            output (str): 'flat' or 'normalized' (default: {"flat"})
+
+        Returns:
+            pd.DataFrame: the result table, also stored in the main_dataframe attribute. A
+                NormalizedResult instead if the output is 'normalized' or if the join guard
+                is 'normalize' and the joined table would exceed the budget
+        """  # noqa
         self._clean_columns()
 
         for resource_alias, dataframe in self.dataframes.items():
             logger.debug(f"{resource_alias} dataframe builded head - \n{dataframe.to_string()}")
 
+        if output == "normalized":
+            self.main_dataframe = self._normalize()
+            return self.main_dataframe
+        return self._assemble(debug=debug)
+
+    def _assemble(self, debug: bool = False, guarded: bool = True) -> pd.DataFrame:
+        """Joins the cleaned dataframes of the aliases into the result table
+
+        Arguments:
+            debug (bool): if debug is true then the columns needed for internal processing
+                are kept in the final dataframe. (default: {False})
+            guarded (bool): if true, the join guard is applied before the joins
+                (default: {True})
+
+        Returns:
+            pd.DataFrame: the result table, also stored in the main_dataframe attribute
+        """  # noqa
         # We check if there is more than 1 alias of resource
         if len(self.dataframes) > 1:
+            if guarded and not self._guard_joins():
+                self.main_dataframe = self._normalize()
+                return self.main_dataframe
             self.main_dataframe = self._join()
         else:
             self.main_dataframe = list(self.dataframes.values())[0]
 
+        if self.order_by:
+            self.main_dataframe = self._sort(self.main_dataframe)
         self.main_dataframe = self.main_dataframe.reset_index(drop=True)
+        if self._rows_limit() is not None:
+            self.main_dataframe = self.main_dataframe.iloc[: self._rows_limit()]
 
         logger.debug(
             f"Main dataframe builded head before columns selection-"
@@ -181,10 +1437,52 @@ class Query:
         )
         if not debug:
             self.__select_columns()
-            self.__remove_lists()
+            self.main_dataframe = self._remove_lists(self.main_dataframe)
+            if self.infer_types:
+                convert_types(self.main_dataframe, self._value_types())
+            self.main_dataframe = compact_dtypes(self.main_dataframe)
 
         return self.main_dataframe
 
+    def _normalize(self) -> NormalizedResult:
+        """Builds from the cleaned dataframes of the aliases a table per alias, with a row per
+        resource and the columns of the select, and a link table per join, with the pairs of
+        ids of the joined resources
+
+        Returns:
+            NormalizedResult: the tables and the link tables, which can be flattened into
+                the result table
+        """  # noqa
+        tables = {}
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            columns = [f"{resource_alias}:from_id"]
+            for column in self._select_columns(
+                resource_alias, self.dataframes[resource_alias].columns
+            ):
+                if column not in columns:
+                    columns.append(column)
+            table = self.dataframes[resource_alias][columns]
+            if not any(
+                element.concat_type == "row" for element in resource.elements.where(goal="select")
+            ):
+                table = table.drop_duplicates(subset=f"{resource_alias}:from_id")
+            table = self._remove_lists(table.reset_index(drop=True))
+            if self.infer_types:
+                convert_types(table, self._value_types())
+            tables[resource_alias] = compact_dtypes(table)
+
+        links = {}
+        for alias_1, alias_2 in self.graph_query.resources_graph.edges:
+            alias_parent, parent_on, child_on, _ = self._join_spec(alias_1, alias_2)
+            alias_child = alias_2 if alias_1 == alias_parent else alias_1
+            link = self.dataframes[alias_parent][[f"{alias_parent}:from_id", parent_on]]
+            link = link.explode(parent_on).dropna().drop_duplicates()
+            links[alias_parent, alias_child] = link.rename(
+                columns={parent_on: child_on}
+            ).reset_index(drop=True)
+
+        return NormalizedResult(tables, links, flatten=lambda: self._assemble(guarded=False))
+
     def _join(self) -> pd.DataFrame:
         """Execute the joins one after the other in the order specified by the
         join_path function.
@@ -201,6 +1499,74 @@ class Query:
             main_df = self._join_2_df(alias_1, alias_2, df_1, df_2)
         return main_df
 
+    def _guard_joins(self) -> bool:
+        """Estimates the size of the joined table before making the joins and, if it exceeds
+        max_join_rows or max_join_memory, applies the join guard
+
+        Returns:
+            bool: True if the joins can be made
+        """  # noqa
+        if self.max_join_rows is None and self.max_join_memory is None:
+            return True
+        rows, memory = self._estimate_join()
+        logger.info(f"the joined table is estimated to {rows} rows and {memory:.0f} bytes")
+
+        exceeded = []
+        if self.max_join_rows is not None and rows > self.max_join_rows:
+            exceeded.append(f"max_join_rows={self.max_join_rows}")
+        if self.max_join_memory is not None and memory > self.max_join_memory:
+            exceeded.append(f"max_join_memory={self.max_join_memory}")
+        if not exceeded:
+            return True
+
+        message = (
+            f"the joined table is estimated to {rows} rows and {memory:.0f} bytes, "
+            f"which exceeds {' and '.join(exceeded)}"
+        )
+        if self.join_guard == "raise":
+            raise ValueError(message)
+        if self.join_guard == "warn":
+            logger.warning(message)
+            return True
+        logger.warning(f"{message}: the tables of the aliases are returned without being joined")
+        return False
+
+    def _estimate_join(self) -> tuple:
+        """Estimates the number of rows and the memory of the table resulting from the joins,
+        without making them.
+
+        The number of rows added by each join is estimated from the occurrences of the join
+        keys in the tables of the two aliases, assuming that the rows of the table joined so
+        far are distributed like the rows of the alias whose key is used.
+
+        Returns:
+            tuple: the number of rows and the memory in bytes
+        """  # noqa
+        list_join = join_path(self.graph_query.resources_graph)
+        rows = len(self.dataframes[list_join[0][0]])
+        for alias_1, alias_2 in list_join:
+            alias_parent, parent_on, child_on, how = self._join_spec(alias_1, alias_2)
+            df_parent = self.dataframes[alias_parent]
+            df_child = self.dataframes[alias_2 if alias_1 == alias_parent else alias_1]
+            pairs = estimate_join_rows(df_parent[parent_on], df_child[child_on], how=how)
+            # the rows of the joined table are multiplied as the rows of alias_1
+            joined_rows = len(self.dataframes[alias_1])
+            rows = pairs if joined_rows == 0 else rows * pairs / joined_rows
+        memory = rows * sum(row_memory(df) for df in self.dataframes.values())
+        return int(rows), memory
+
+    def _join_spec(self, alias_1: str, alias_2: str) -> tuple:
+        """Returns the parent alias, the join columns of the parent and of the child and the
+        type of merge (with the parent on the left) of the join between two aliases"""  # noqa
+        edge_info = self.graph_query.resources_graph.edges[alias_1, alias_2]["info"]
+        how = {"child": "right", "parent": "left"}.get(edge_info.join_how, "inner")
+        return (
+            edge_info.parent,
+            f"{edge_info.parent}:join_{edge_info.searchparam_parent}",
+            f"{edge_info.child}:from_id",
+            how,
+        )
+
     def _join_2_df(
         self, alias_1: str, alias_2: str, df_1: pd.DataFrame, df_2: pd.DataFrame
     ) -> pd.DataFrame:
@@ -225,36 +1591,21 @@ class Query:
             pd.DataFrame: dataframe containing the elements of the 2 resources according to
                 an inner join
         """  # noqa
-        edge_info = self.graph_query.resources_graph.edges[alias_1, alias_2]["info"]
-        alias_parent = edge_info.parent
-        alias_child = edge_info.child
-
-        how = edge_info.join_how
-        searchparam_parent = edge_info.searchparam_parent
-
-        parent_on = f"{alias_parent}:join_{searchparam_parent}"
-        child_on = f"{alias_child}:from_id"
-
-        if how == "child":
-            how = "right"
-        elif how == "parent":
-            how = "left"
-        else:
-            how = "inner"
+        alias_parent, parent_on, child_on, how = self._join_spec(alias_1, alias_2)
 
         if alias_1 == alias_parent:
-            df_1 = df_1.explode(parent_on)
-            df_2 = df_2.explode(child_on)
-            df_merged_inner = pd.merge(
-                left=df_1, right=df_2, left_on=parent_on, right_on=child_on, how=how
-            )
+            df_parent = df_1.explode(parent_on)
+            df_child = df_2.explode(child_on)
         else:
-            df_1 = df_1.explode(child_on)
-            df_2 = df_2.explode(parent_on)
-            df_merged_inner = pd.merge(
-                left=df_2, right=df_1, left_on=parent_on, right_on=child_on, how=how
-            )
-        return df_merged_inner
+            df_parent = df_2.explode(parent_on)
+            df_child = df_1.explode(child_on)
+
+        # the references are compared through their integer codes in a dictionary shared by
+        # all the joins of the query
+        df_parent[JOIN_KEY] = self._reference_codes.encode(df_parent[parent_on])
+        df_child[JOIN_KEY] = self._reference_codes.encode(df_child[child_on])
+        df_merged_inner = pd.merge(left=df_parent, right=df_child, on=JOIN_KEY, how=how)
+        return df_merged_inner.drop(columns=JOIN_KEY)
 
     def _clean_columns(self):
         """Perform preprocessing on all dataframes harvested in the dataframe attribute:
@@ -263,38 +1614,69 @@ class Query:
         - Add the table alias as a prefix to each column name
         """  # noqa
 
-        def _add_resource_type_to_id(df, resource_type: str):
-            # add assert to check that there is only one id in list
-            df["from_id"] = f"{resource_type}/" + df["from_id"]
-            return df
-
         for resource_alias, df in self.dataframes.items():
             resource_type = self.graph_query.resources_by_alias[resource_alias].resource_type
 
-            df = df.pipe(_add_resource_type_to_id, resource_type=resource_type)
-
-            self.dataframes[resource_alias] = df.add_prefix(f"{resource_alias}:")
+            # shallow copy: the dataframes retrieved are left unchanged, without copying data
+            df = df.copy(deep=False)
+            # the resource type is only added to the distinct ids, the categories of the column
+            codes, ids = pd.factorize(df["from_id"])
+            df["from_id"] = pd.Categorical.from_codes(codes, categories=f"{resource_type}/" + ids)
+            df.columns = [f"{resource_alias}:{column}" for column in df.columns]
+            self.dataframes[resource_alias] = df
 
     def __select_columns(self):
         """Clean the final dataframe to keep only the columns of the select"""
         final_columns = []
-        for resource_alias, resource in self.graph_query.resources_by_alias.items():
-            for element in resource.elements.where(goal="select"):
-                final_columns.append(f"{resource_alias}:{element.col_name}")
+        for resource_alias in self.graph_query.resources_by_alias:
+            final_columns += self._select_columns(resource_alias, self.main_dataframe.columns)
         self.main_dataframe = self.main_dataframe[final_columns]
 
-    def __remove_lists(self):
-        """Remove lists from columns with only single elements"""
+    def _select_columns(self, resource_alias: str, columns: pd.Index) -> list:
+        """Returns the columns of the select of an alias, among the columns of a dataframe
+
+        Arguments:
+            resource_alias (str): alias associated with a resource
+            columns (pd.Index): columns of the dataframe
 
-        def unlist(x):
-            """Auxiliary function to squeeze lists with one element"""
-            if isinstance(x, list) and len(x) == 1:
-                return unlist(x[0])
+        Returns:
+            list: the columns of the selected elements, those of an element of concatenation
+                type col being the columns '<column>_<i>' of its values
+        """  # noqa
+        select_columns = []
+        for element in self.graph_query.resources_by_alias[resource_alias].elements.where(
+            goal="select"
+        ):
+            column = f"{resource_alias}:{element.col_name}"
+            if element.concat_type == "col":
+                pattern = re.compile(rf"{re.escape(column)}_\d+")
+                select_columns += [name for name in columns if pattern.fullmatch(name)]
             else:
-                return x
+                select_columns.append(column)
+        return select_columns
+
+    def _value_types(self) -> dict:
+        """Returns the type of the values of the selected columns whose type is known
+
+        Returns:
+            dict: the key is the name of a column (e.g. 'Patient:birthDate') and the value
+                the type of its values ('date', 'number' or 'boolean')
+        """  # noqa
+        value_types = {}
+        for resource_alias, resource in self.graph_query.resources_by_alias.items():
+            for element in resource.elements.where(goal="select"):
+                if element.value_type:
+                    value_types[f"{resource_alias}:{element.col_name}"] = element.value_type
+        return value_types
 
-        if len(self.main_dataframe) > 0:
-            df = self.main_dataframe.copy()
-            for column in df.columns:
-                df[column] = df[column].apply(unlist)
-            self.main_dataframe = df
+    @staticmethod
+    def _remove_lists(df: pd.DataFrame) -> pd.DataFrame:
+        """Remove lists from columns with only single elements"""
+        # shallow copy: only the columns containing lists are replaced
+        df = df.copy(deep=False)
+        for column in df.columns:
+            values = df[column]
+            unlisted = unlist_column(values)
+            if unlisted is not values:
+                df[column] = unlisted
+        return df
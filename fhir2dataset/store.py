@@ -0,0 +1,642 @@
+import calendar
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import sqlite3
+import unicodedata
+from typing import Iterator, List, Optional, Tuple
+
+import pandas as pd
+
+from fhir2dataset.data_class import Element, SearchParameter
+from fhir2dataset.fhirrules import FHIRRules
+from fhir2dataset.tools.dataframe import PREFIXED_VALUE, condition_mask
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = ".fhir2dataset.sqlite"
+INDEX_VERSION = 1  # version of the schema of the index, an index of another version is rebuilt
+INSERT_BATCH_SIZE = 10000  # number of rows inserted at once while the index is built
+# types of search parameters whose values are indexed
+INDEXED_TYPES = ["string", "token", "reference", "uri", "date", "number", "quantity"]
+# modifiers of the conditions evaluated on the values extracted from the resources, by type of
+# search parameter, besides :missing and the resource type of a reference (e.g. subject:Patient)
+LOCAL_MODIFIERS = {"string": ["exact", "contains"], "token": ["text", "not"]}
+# bounds of the dates whose precision is lower than the millisecond
+MIN_DATE = "0001-01-01T00:00:00.000"
+MAX_DATE = "9999-12-31T23:59:59.999"
+DATE = re.compile(r"(\d{4})(?:-(\d{2}))?(?:-(\d{2}))?")
+DATE_TIME = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?")
+
+SCHEMA = """
+CREATE TABLE files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER);
+CREATE TABLE resources (
+    type TEXT, id TEXT, path TEXT, offset INTEGER, length INTEGER, entry INTEGER,
+    PRIMARY KEY (type, id)
+);
+CREATE TABLE searchparams (type TEXT, code TEXT, param_type TEXT, PRIMARY KEY (type, code));
+CREATE TABLE search_index (
+    type TEXT, param TEXT, system TEXT, code TEXT, low, high, id TEXT
+);
+"""
+INDEXES = """
+CREATE INDEX search_index_code ON search_index (type, param, code);
+CREATE INDEX search_index_low ON search_index (type, param, low);
+"""
+
+
+def normalize_string(value: str) -> str:
+    """Normalizes a string as the FHIR string searches do: case and accents are ignored"""
+    decomposed = unicodedata.normalize("NFKD", value)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).lower()
+
+
+def date_bounds(value: str) -> Optional[Tuple[str, str]]:
+    """Returns the first and last instants (in UTC, to the millisecond) of the range of time
+    of a date, a dateTime or an instant, according to its precision
+
+    Example:
+        >>> date_bounds("1976-02")
+        [Out] ("1976-02-01T00:00:00.000", "1976-02-29T23:59:59.999")
+
+    Arguments:
+        value (str): the date
+
+    Returns:
+        tuple: the bounds of the date, None if it isn't a date
+    """  # noqa
+    match = DATE.fullmatch(value)
+    if match:
+        year, month, day = match.groups()
+        first_month, last_month = (month, month) if month else ("01", "12")
+        last_day = day or f"{calendar.monthrange(int(year), int(last_month))[1]:02d}"
+        return (
+            f"{year}-{first_month}-{day or '01'}T00:00:00.000",
+            f"{year}-{last_month}-{last_day}T23:59:59.999",
+        )
+    match = DATE_TIME.fullmatch(value)
+    if match:
+        instant = pd.Timestamp(value)
+        if instant.tzinfo is not None:
+            instant = instant.tz_convert("UTC").tz_localize(None)
+        low = instant.strftime("%Y-%m-%dT%H:%M:%S.%f")[:23]
+        if match.group(2):  # precision of the fraction of seconds
+            return low, low
+        precision = pd.Timedelta(seconds=1 if match.group(1) else 60)
+        return low, (instant + precision).strftime("%Y-%m-%dT%H:%M:%S.%f")[:23]
+    return None
+
+
+def compile_fhirpath(fhirpath: str) -> List[List[str]]:
+    """Transforms the fhirpath of a search parameter into the lists of keys leading to its
+    values in the json of a resource. A type given with 'as' is appended to the key of the
+    element (e.g. valueQuantity), the restrictions on the type of the referenced resources
+    are ignored and the paths using other functions are left out.
+
+    Example:
+        >>> compile_fhirpath("(Observation.value as Quantity) | Observation.subject.where(resolve() is Patient)")
+        [Out] [["valueQuantity"], ["subject"]]
+
+    Arguments:
+        fhirpath (str): fhirpath of a search parameter on a resource type
+
+    Returns:
+        list: the keys of each path, without the resource type
+    """  # noqa
+    paths = []
+    for path in fhirpath.split(" | "):
+        path = re.sub(
+            r"\(([\w.]+) as (\w+)\)",
+            lambda match: match[1] + match[2][0].upper() + match[2][1:],
+            path,
+        )
+        path = path.replace(".where(resolve() is ", "!").split("!")[0]
+        if re.fullmatch(r"\w+(\.\w+)+", path):
+            paths.append(path.split(".")[1:])
+    return paths
+
+
+def _values(value, keys: List[str]) -> Iterator:
+    """Yields the values at the end of the keys in a json value, lists being traversed. A
+    missing key of a choice element (e.g. effective) matches its typed keys (e.g.
+    effectiveDateTime or effectivePeriod)"""  # noqa
+    if isinstance(value, list):
+        for item in value:
+            yield from _values(item, keys)
+    elif not keys:
+        if value is not None:
+            yield value
+    elif isinstance(value, dict):
+        key, *keys = keys
+        if key in value:
+            yield from _values(value[key], keys)
+        else:
+            # e.g. valueQuantity for the choice element value[x]
+            start, end = len(key), len(key) + 1
+            for name, item in value.items():
+                if name.startswith(key) and name[start:end].isupper():
+                    yield from _values(item, keys)
+
+
+def _strings(value) -> Iterator[str]:
+    """Yields the strings of a json value (e.g. the parts of a HumanName)"""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+def index_values(param_type: str, value) -> Iterator[tuple]:
+    """Yields the (system, code, low, high) rows indexing a value of a search parameter
+
+    Arguments:
+        param_type (str): the type of the search parameter (e.g. token)
+        value: a value of an element of the search parameter, in its json representation
+
+    Yields:
+        tuple: the system and the code of a token or of a reference (the referenced type and
+            id), the normalized string in code for a string, the bounds of a date, a number
+            or a quantity in low and high
+    """  # noqa
+    if param_type == "string":
+        for string in _strings(value):
+            yield None, normalize_string(string), None, None
+    elif param_type == "token":
+        if isinstance(value, dict):
+            for coding in value.get("coding", [value]):
+                code = coding.get("code", coding.get("value"))
+                if isinstance(code, str):
+                    yield coding.get("system"), code, None, None
+        elif isinstance(value, bool):
+            yield None, str(value).lower(), None, None
+        elif isinstance(value, str):
+            yield None, value, None, None
+    elif param_type == "reference":
+        reference = value.get("reference") if isinstance(value, dict) else None
+        if isinstance(reference, str):
+            *_, referenced_type, referenced_id = [None, *reference.split("/")]
+            yield referenced_type, referenced_id, None, None
+    elif param_type == "uri":
+        if isinstance(value, str):
+            yield None, value, None, None
+    elif param_type == "date":
+        if isinstance(value, dict):  # Period
+            start = date_bounds(value["start"]) if "start" in value else None
+            end = date_bounds(value["end"]) if "end" in value else None
+            if start or end:
+                yield None, None, start[0] if start else MIN_DATE, end[1] if end else MAX_DATE
+        elif isinstance(value, str):
+            bounds = date_bounds(value)
+            if bounds:
+                yield (None, None, *bounds)
+    elif param_type in ["number", "quantity"]:
+        number = value.get("value") if isinstance(value, dict) else value
+        if isinstance(number, (int, float)) and not isinstance(number, bool):
+            yield None, None, float(number), float(number)
+
+
+def _condition_sql(
+    param_type: str, value: str, prefix: Optional[str], modifier: str = None
+) -> Tuple[str, list]:
+    """Builds the SQL condition on the rows of the search index of a value of a search
+    parameter, following the FHIR search semantics of its type and of its modifier, the rows
+    of the :exact and :text modifiers being given by modifier_values"""  # noqa
+    if modifier == "exact":
+        return "code = ?", [value]
+    if modifier == "contains":
+        return "instr(code, ?) > 0", [normalize_string(value)]
+    if modifier == "text":
+        return _condition_sql("string", value, prefix)
+    if param_type == "reference" and modifier and "/" not in value:
+        # e.g. subject:Patient=1
+        value = f"{modifier}/{value}"
+    if param_type in ["date", "number", "quantity"]:
+        if prefix is None and PREFIXED_VALUE.fullmatch(value):
+            prefix, value = PREFIXED_VALUE.fullmatch(value).groups()
+        if param_type == "date":
+            bounds = date_bounds(value)
+            if bounds is None:
+                raise ValueError(f"Invalid date {value}")
+            low, high = bounds
+        else:
+            low = high = float(value.split("|")[0])
+        # the range of the indexed value compared to the range of the searched value
+        equal = "(low >= ? AND high <= ?)"
+        comparisons = {
+            "eq": (equal, [low, high]),
+            "ne": (f"NOT {equal}", [low, high]),
+            "gt": ("high > ?", [high]),
+            "lt": ("low < ?", [low]),
+            "ge": (f"(high > ? OR {equal})", [high, low, high]),
+            "le": (f"(low < ? OR {equal})", [low, low, high]),
+            "sa": ("low > ?", [high]),
+            "eb": ("high < ?", [low]),
+            "ap": ("(low <= ? AND high >= ?)", [high, low]),
+        }
+        return comparisons[prefix or "eq"]
+    if param_type == "string":
+        value = normalize_string(value)
+        # the indexed strings starting with the value
+        return "(code >= ? AND code < ?)", [value, value + "\U0010ffff"]
+    if param_type == "token" and "|" in value:
+        system, code = value.split("|", 1)
+        if not system:
+            return "(system IS NULL AND code = ?)", [code]
+        if not code:
+            return "system = ?", [system]
+        return "(system = ? AND code = ?)", [system, code]
+    if param_type == "reference" and "/" in value:
+        referenced_type, referenced_id = value.rstrip("/").split("/")[-2:]
+        return "(system = ? AND code = ?)", [referenced_type, referenced_id]
+    return "code = ?", [value]
+
+
+def _alternatives_sql(
+    param_type: str, condition: SearchParameter, modifier: str = None
+) -> Tuple[str, list]:
+    """Builds the SQL condition on the rows of the search index of a condition, a condition
+    with a list of values being respected if one of its values is"""  # noqa
+    values = condition.value if isinstance(condition.value, list) else [condition.value]
+    alternatives, params = [], []
+    for value in values:
+        prefix = condition.prefix
+        if isinstance(value, dict):
+            prefix, value = next(iter(value.items()))
+        # the values separated by commas are combined with OR, each value of a list being a
+        # literal
+        alternatives_values = [str(value)]
+        if not isinstance(condition.value, list):
+            alternatives_values = str(value).split(",")
+        for alternative in alternatives_values:
+            alternative_sql, alternative_params = _condition_sql(
+                param_type, alternative, prefix, modifier
+            )
+            alternatives.append(alternative_sql)
+            params += alternative_params
+    return f"({' OR '.join(alternatives)})", params
+
+
+def modifier_values(param_type: str, modifier: Optional[str], value) -> Iterator[tuple]:
+    """Yields the (system, code, low, high) rows indexing a value of a search parameter for a
+    condition with a modifier: the raw strings for :exact, the normalized text of a
+    CodeableConcept and the displays of its codings for :text, the rows of index_values
+    otherwise"""  # noqa
+    if modifier == "exact":
+        for string in _strings(value):
+            yield None, string, None, None
+    elif modifier == "text":
+        if isinstance(value, dict):
+            texts = [value.get("text")] + [
+                coding.get("display") for coding in value.get("coding", [value])
+            ]
+            for text in texts:
+                if isinstance(text, str):
+                    yield None, normalize_string(text), None, None
+    else:
+        yield from index_values(param_type, value)
+
+
+def _index_rows(column: pd.Series, param_type: str, modifier: str = None) -> Iterator[tuple]:
+    """Yields the (position, system, code, low, high) rows indexing the json values of a
+    column, whose cells may contain lists"""  # noqa
+    for position, cell in enumerate(column):
+        for value in cell if isinstance(cell, list) else [cell]:
+            if isinstance(value, float) and math.isnan(value):
+                continue
+            for row in modifier_values(param_type, modifier, value):
+                yield (position, *row)
+
+
+def check_conditions(conditions: List[Element]):
+    """Checks that the where conditions can be evaluated on the resources read locally by
+    filter_conditions
+
+    Raises:
+        ValueError: if the type of the search parameter of a condition isn't indexed (e.g.
+            composite) or if the modifier of a condition isn't supported (e.g. code:below)
+    """  # noqa
+    for element in conditions:
+        condition = element.search_parameter
+        if condition.type is None:  # a condition on a fhirpath
+            continue
+        if condition.type not in INDEXED_TYPES:
+            raise ValueError(
+                f"The conditions on {condition.code}, a search parameter of type "
+                f"{condition.type}, can't be evaluated on the resources read locally"
+            )
+        modifier = condition.code.partition(":")[2]
+        if (
+            modifier
+            and modifier != "missing"
+            and modifier not in LOCAL_MODIFIERS.get(condition.type, [])
+            and not (condition.type == "reference" and modifier[0].isupper())
+        ):
+            raise ValueError(
+                f"The modifier :{modifier} of {condition.code} isn't supported on the "
+                "resources read locally"
+            )
+
+
+def search_mask(column: pd.Series, condition: SearchParameter) -> pd.Series:
+    """Evaluates a where condition on a search parameter with the FHIR search semantics of its
+    type and of its modifier, as the index does: the json values of its element (e.g. the
+    CodeableConcepts of a token or the References of a reference) are indexed in memory with
+    modifier_values and the SQL condition of the index is applied on them. A token is thus
+    matched by its code or its system|code and a reference by its Type/id or its id.
+
+    Arguments:
+        column (pd.Series): column of the json values of the element of the search parameter
+            of the rows, whose cells may contain lists
+        condition (SearchParameter): the condition, whose type is known and checked by
+            check_conditions
+
+    Returns:
+        pd.Series: boolean mask of the rows respecting the condition
+    """  # noqa
+    modifier = condition.code.partition(":")[2] or None
+    connection = sqlite3.connect(":memory:")
+    try:
+        connection.execute(
+            "CREATE TABLE search_index (id INTEGER, system TEXT, code TEXT, low, high)"
+        )
+        connection.executemany(
+            "INSERT INTO search_index VALUES (?, ?, ?, ?, ?)",
+            _index_rows(column, condition.type, modifier),
+        )
+        if modifier == "missing":
+            sql, params = "1", []  # the rows having a value
+        elif modifier == "not":
+            sql, params = _alternatives_sql(condition.type, condition)
+        else:
+            sql, params = _alternatives_sql(condition.type, condition, modifier)
+        matched = {
+            position
+            for (position,) in connection.execute(
+                f"SELECT DISTINCT id FROM search_index WHERE {sql}", params
+            )
+        }
+    finally:
+        connection.close()
+    mask = pd.Series([position in matched for position in range(len(column))], index=column.index)
+    values = condition.value if isinstance(condition.value, list) else [condition.value]
+    if modifier == "not" or (modifier == "missing" and "true" in map(str, values)):
+        return ~mask
+    return mask
+
+
+def filter_conditions(df: pd.DataFrame, conditions: List[Element]) -> pd.DataFrame:
+    """Keeps the rows of a dataframe respecting all the where conditions, each evaluated on
+    the where column of its element: with search_mask if it is on a search parameter, with
+    condition_mask if it is on a fhirpath
+
+    Arguments:
+        df (pd.DataFrame): the elements extracted from the resources in tabular format
+        conditions (list): the where elements (of type Element) of the conditions
+
+    Returns:
+        pd.DataFrame: the rows of df respecting the conditions
+    """  # noqa
+    if not conditions or len(df) == 0:
+        return df
+    df = df.reset_index(drop=True)
+    mask = pd.Series(True, index=df.index)
+    for element in conditions:
+        search_param = element.search_parameter
+        if search_param.type is None:
+            mask &= condition_mask(df[element.col_name], search_param.value, search_param.prefix)
+        else:
+            mask &= search_mask(df[element.col_name], search_param)
+    return df[mask].reset_index(drop=True)
+
+
+class LocalStore:
+    """Local data source reading the resources of snapshots of a FHIR server (json files of
+    resources or Bundles, NDJSON files of a Bulk Data export) instead of a FHIR API
+
+    The files are scanned once to build a persistent sqlite index of:
+        * the location (file, offset and length) of each resource, by resource type and id
+        * the normalized values of the search parameters of each resource (given by the
+          FHIRRules, including the references and the common parameters such as _id), which
+          answer the where conditions on search parameters without reading the resources
+    The index is rebuilt when the files change. Only the resources matching the conditions
+    are then read, from memory-mapped files.
+
+    Attributes:
+        directory (str): directory of the files, scanned recursively
+        index_path (str): path of the sqlite index
+        fhir_rules (FHIRRules): the rules giving the search parameters of each resource type
+    """  # noqa
+
+    def __init__(self, directory: str, index_path: str = None, fhir_rules: FHIRRules = None):
+        """
+        Arguments:
+            directory (str): directory of the json and NDJSON files
+            index_path (str): (Optional) path of the sqlite index, by default a file
+                .fhir2dataset.sqlite in the directory
+            fhir_rules (FHIRRules): (Optional) an instance of FHIR rules, initialized
+                with search parameters
+        """  # noqa
+        self.directory = directory
+        self.index_path = index_path or os.path.join(directory, INDEX_FILENAME)
+        self.fhir_rules = fhir_rules or FHIRRules()
+        self.connection = sqlite3.connect(self.index_path, check_same_thread=False)
+        self._searchparams = {}
+        if self._is_stale():
+            self.build()
+        for resource_type, code, param_type in self.connection.execute(
+            "SELECT type, code, param_type FROM searchparams"
+        ):
+            self._searchparams[resource_type, code] = param_type
+
+    def _files(self) -> List[Tuple[str, int, int]]:
+        """Lists the (path, size, modification time) of the json and NDJSON files"""
+        files = []
+        for root, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith((".json", ".ndjson")):
+                    path = os.path.join(root, filename)
+                    stat = os.stat(path)
+                    files.append((path, stat.st_size, stat.st_mtime_ns))
+        return files
+
+    def _is_stale(self) -> bool:
+        """Checks whether the index has to be (re)built"""
+        (version,) = self.connection.execute("PRAGMA user_version").fetchone()
+        if version != INDEX_VERSION:
+            return True
+        indexed = self.connection.execute("SELECT path, size, mtime FROM files ORDER BY path")
+        return sorted(self._files()) != list(indexed)
+
+    def build(self):
+        """(Re)builds the index in a single pass over the files"""
+        files = self._files()
+        logger.info(f"indexing the resources of {len(files)} files of {self.directory}")
+        with self.connection:
+            for (table,) in self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            ).fetchall():
+                self.connection.execute(f"DROP TABLE {table}")
+            self.connection.executescript(SCHEMA)
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?)", files)
+
+            searchparams_by_type = {}
+            locations, rows = [], []
+            for path, _, _ in files:
+                for resource, location in self._scan(path):
+                    resource_type = resource.get("resourceType")
+                    if resource_type not in searchparams_by_type:
+                        searchparams_by_type[resource_type] = self._compile(resource_type)
+                    locations.append((resource_type, resource.get("id"), path, *location))
+                    for code, param_type, paths in searchparams_by_type[resource_type]:
+                        for keys in paths:
+                            for value in _values(resource, keys):
+                                for row in index_values(param_type, value):
+                                    rows.append((resource_type, code, *row, resource.get("id")))
+                    if len(rows) >= INSERT_BATCH_SIZE:
+                        self._insert(locations, rows)
+                        locations, rows = [], []
+            self._insert(locations, rows)
+
+            self.connection.executemany(
+                "INSERT INTO searchparams VALUES (?, ?, ?)",
+                [
+                    (resource_type, code, param_type)
+                    for resource_type, searchparams in searchparams_by_type.items()
+                    for code, param_type, _ in searchparams
+                ],
+            )
+            self.connection.executescript(INDEXES)
+            self.connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+
+    def _insert(self, locations: List[tuple], rows: List[tuple]):
+        # a resource present in several files is only indexed from the first one
+        new_ids = set()
+        for location in locations:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO resources VALUES (?, ?, ?, ?, ?, ?)", location
+            )
+            if cursor.rowcount:
+                new_ids.add((location[0], location[1]))
+        self.connection.executemany(
+            "INSERT INTO search_index VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [row for row in rows if (row[0], row[-1]) in new_ids],
+        )
+
+    def _compile(self, resource_type: str) -> List[tuple]:
+        """Returns the (code, type, keys of each path) of the indexed search parameters of a
+        resource type"""  # noqa
+        return [
+            (search_parameter.code, search_parameter.type, paths)
+            for search_parameter in self.fhir_rules.resource_searchparams(resource_type)
+            if search_parameter.type in INDEXED_TYPES
+            for paths in [compile_fhirpath(search_parameter.fhirpath)]
+            if paths
+        ]
+
+    @staticmethod
+    def _scan(path: str) -> Iterator[Tuple[dict, tuple]]:
+        """Yields each resource of a file with its location (offset, length, entry): the line
+        of a NDJSON file, or the whole json file and the index of the resource in the entries
+        of a Bundle (-1 for a file containing a single resource)"""  # noqa
+        with open(path, "rb") as json_file:
+            if path.endswith(".ndjson"):
+                offset = 0
+                for line in json_file:
+                    if line.strip():
+                        yield json.loads(line), (offset, len(line), -1)
+                    offset += len(line)
+                return
+            content = json_file.read()
+        resource = json.loads(content)
+        if resource.get("resourceType") == "Bundle":
+            for entry, bundle_entry in enumerate(resource.get("entry", [])):
+                if "resource" in bundle_entry:
+                    yield bundle_entry["resource"], (0, len(content), entry)
+        else:
+            yield resource, (0, len(content), -1)
+
+    def is_indexed(self, resource_type: str, search_param: str) -> bool:
+        """Checks whether the conditions on a search parameter of a resource type are
+        answered by the index (the ones with a modifier, e.g. name:exact, are not)"""  # noqa
+        return (resource_type, search_param) in self._searchparams
+
+    def _where_sql(self, resource_type: str, conditions: List[SearchParameter]) -> Tuple[str, list]:
+        """Builds the SQL condition selecting the resources of a type respecting all the
+        conditions"""  # noqa
+        sql, params = "type = ?", [resource_type]
+        for condition in conditions:
+            param_type = self._searchparams[resource_type, condition.code]
+            alternatives_sql, alternatives_params = _alternatives_sql(param_type, condition)
+            sql += (
+                " AND id IN (SELECT id FROM search_index WHERE type = ? AND param = ? AND "
+                f"{alternatives_sql})"
+            )
+            params += [resource_type, condition.code, *alternatives_params]
+        return sql, params
+
+    def search(
+        self, resource_type: str, conditions: List[SearchParameter] = None, limit: int = None
+    ) -> List[str]:
+        """Finds with the index the ids of the resources of a type respecting the conditions
+
+        Arguments:
+            resource_type (str): the resource type (e.g. Patient)
+            conditions (list): (optional) the SearchParameter conditions, on indexed search
+                parameters
+            limit (int): (optional) maximum number of ids
+
+        Returns:
+            list: the ids, in the order of the files
+        """  # noqa
+        return [location[0] for location in self._locations(resource_type, conditions, limit)]
+
+    def resources(
+        self, resource_type: str, conditions: List[SearchParameter] = None, limit: int = None
+    ) -> Iterator[dict]:
+        """Reads the resources of a type respecting the conditions, only their locations in
+        the memory-mapped files being read
+
+        Arguments:
+            resource_type (str): the resource type (e.g. Patient)
+            conditions (list): (optional) the SearchParameter conditions, on indexed search
+                parameters
+            limit (int): (optional) maximum number of resources
+
+        Yields:
+            dict: the json of each resource, in the order of the files
+        """  # noqa
+        maps, bundles = {}, {}
+        try:
+            for _, path, offset, length, entry in self._locations(resource_type, conditions, limit):
+                if path not in maps:
+                    with open(path, "rb") as json_file:
+                        maps[path] = mmap.mmap(json_file.fileno(), 0, access=mmap.ACCESS_READ)
+                end = offset + length
+                if entry < 0:
+                    yield json.loads(maps[path][offset:end])
+                    continue
+                if path not in bundles:
+                    bundles[path] = json.loads(maps[path][offset:end])["entry"]
+                yield bundles[path][entry]["resource"]
+        finally:
+            for memory_map in maps.values():
+                memory_map.close()
+
+    def _locations(
+        self, resource_type: str, conditions: List[SearchParameter] = None, limit: int = None
+    ) -> List[tuple]:
+        """Returns the (id, path, offset, length, entry) of the resources of a type respecting
+        the conditions, in the order of the files"""  # noqa
+        sql, params = self._where_sql(resource_type, conditions or [])
+        query = f"SELECT id, path, offset, length, entry FROM resources WHERE {sql} ORDER BY rowid"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return self.connection.execute(query, params).fetchall()
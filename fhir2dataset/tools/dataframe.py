@@ -0,0 +1,402 @@
+"""
+Module containing vectorized operations on the dataframes built from FHIR resources
+"""
+
+import logging
+import operator
+import re
+from itertools import chain
+from operator import itemgetter
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# comparison made by each prefix of the FHIR search values
+COMPARATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "lt": operator.lt,
+    "ge": operator.ge,
+    "le": operator.le,
+    "sa": operator.gt,
+    "eb": operator.lt,
+    "ap": operator.eq,
+}
+# value of a search on a number or a date whose prefix is written before it (e.g. ge2000)
+PREFIXED_VALUE = re.compile(rf"({'|'.join(COMPARATORS)})(\d.*)")
+# temporary column of the index of the dataframe each row comes from
+SOURCE_COLUMN = "_source"
+# functions applied to each cell of an array of objects in a C-level loop, returning an array
+# of objects (unlike np.fromiter, which only builds arrays of objects since numpy 1.23)
+TYPE_OF = np.frompyfunc(type, 1, 1)
+FIRST_ITEM = np.frompyfunc(itemgetter(0), 1, 1)
+
+
+def first_value(value):
+    """Returns the first scalar of a (possibly nested) list, the value itself if it is not a list
+
+    Example:
+        >>> first_value([["2000-01-01", "2001-01-01"]])
+        [Out] "2000-01-01"
+    """  # noqa
+    while isinstance(value, list):
+        if len(value) == 0:
+            return None
+        value = value[0]
+    return value
+
+
+def sort_dataframe(
+    df: pd.DataFrame, columns: List[str], ascending: List[bool], limit: int = None
+) -> pd.DataFrame:
+    """Sorts a dataframe whose cells may contain lists, a list being sorted according to its
+    first value. Missing values are put last.
+
+    Arguments:
+        df (pd.DataFrame): dataframe to sort
+        columns (list): names of the columns to sort by
+        ascending (list): sort ascending vs. descending for each column
+        limit (int): (optional) if given, only the first limit rows are kept
+
+    Returns:
+        pd.DataFrame: the sorted dataframe
+    """  # noqa
+
+    def _key(column: pd.Series) -> pd.Series:
+        if column.dtype == object:
+            return column.map(first_value)
+        return column
+
+    df = df.sort_values(
+        by=columns, ascending=ascending, key=_key, kind="mergesort", na_position="last"
+    )
+    if limit is not None:
+        df = df.iloc[:limit]
+    return df
+
+
+class ReferenceCodes:
+    """Dictionary shared by the joins of a query giving an integer code to each reference
+    (e.g. Patient/123) so that the joins compare integers instead of strings.
+
+    The references and the ids are only encoded when they are joined: while the pages are
+    retrieved, they are kept as strings (interned by ApiRequest._get_data, so that a reference
+    repeated in many resources is stored once), since the semi-joins, the states and the
+    result table use them as strings.
+
+    Attributes:
+        references (pd.Index): the references met so far, the code of a reference being its
+            position in the index
+    """  # noqa
+
+    def __init__(self):
+        self.references = pd.Index([], dtype=object)
+
+    def encode(self, values: pd.Series) -> np.ndarray:
+        """Returns the code of each value, adding the new values to the dictionary. Missing
+        values get the code -1."""  # noqa
+        codes = self.references.get_indexer(values)
+        new_values = pd.unique(values[(codes == -1) & values.notna().to_numpy()])
+        if len(new_values) > 0:
+            self.references = self.references.append(pd.Index(new_values, dtype=object))
+            codes = self.references.get_indexer(values)
+        return codes
+
+
+def drop_duplicate_resources(
+    frames: List[pd.DataFrame], id_column: str = "from_id"
+) -> pd.DataFrame:
+    """Concatenates dataframes of resources retrieved by different requests, keeping the rows
+    of a resource retrieved by several requests only from the first of these requests (a
+    resource can have several rows, e.g. with elements flattened into rows)
+
+    Arguments:
+        frames (list): the dataframes of the requests, in their order
+        id_column (str): the column of the ids of the resources
+
+    Returns:
+        pd.DataFrame: the rows of each resource from the first request retrieving it
+    """  # noqa
+    df = pd.concat(
+        [frame.assign(**{SOURCE_COLUMN: index}) for index, frame in enumerate(frames)],
+        ignore_index=True,
+    )
+    first = df.groupby(id_column)[SOURCE_COLUMN].transform("min")
+    return df[df[SOURCE_COLUMN] == first].drop(columns=SOURCE_COLUMN).reset_index(drop=True)
+
+
+def upsert_resources(
+    df: pd.DataFrame, updated: pd.DataFrame, removed_ids, id_column: str = "from_id"
+) -> pd.DataFrame:
+    """Replaces in a dataframe of resources the rows of the resources updated since it was
+    retrieved by the rows of their new version, and drops the rows of the removed resources
+    (e.g. deleted or no longer respecting the conditions of the search)
+
+    Arguments:
+        df (pd.DataFrame): the dataframe of the resources retrieved previously
+        updated (pd.DataFrame): the new version of the updated resources
+        removed_ids: the ids of the resources removed since df was retrieved
+        id_column (str): the column of the ids of the resources
+
+    Returns:
+        pd.DataFrame: the rows of the resources of df still valid, then the rows of the
+            updated resources
+    """  # noqa
+    stale = df[id_column].isin(updated[id_column]) | df[id_column].isin(list(removed_ids))
+    return pd.concat([df[~stale], updated], ignore_index=True)
+
+
+def compact_dtypes(df: pd.DataFrame, max_unique_ratio: float = 0.5) -> pd.DataFrame:
+    """Converts, in place, the columns of strings with few distinct values (e.g. gender,
+    status or coding systems) into categoricals, which store each distinct string only once
+
+    Arguments:
+        df (pd.DataFrame): dataframe to compact
+        max_unique_ratio (float): maximum ratio between the number of distinct values and
+            the number of rows of a column converted into a categorical
+
+    Returns:
+        pd.DataFrame: the compacted dataframe
+    """  # noqa
+    for column in df.columns:
+        values = df[column]
+        if values.dtype != object or len(values) == 0:
+            continue
+        types = set(map(type, values.to_numpy()))
+        if not types <= {str, type(None)} or str not in types:
+            continue
+        if values.nunique() > max_unique_ratio * len(values):
+            continue
+        df[column] = values.astype("category")
+    return df
+
+
+def convert_types(df: pd.DataFrame, value_types: Dict[str, str]) -> pd.DataFrame:
+    """Converts, in place, the columns whose type of values is known from their json
+    representation: 'date' columns to datetime64 (in UTC when the dates have different
+    offsets), 'number' columns to float and 'boolean' columns to (nullable) booleans.
+
+    A column is left as is if one of its cells is a list of several values or can't be
+    converted, so that no value is lost.
+
+    Arguments:
+        df (pd.DataFrame): dataframe whose columns are converted
+        value_types (dict): the key is the name of a column and the value the type of its
+            values ('date', 'number' or 'boolean')
+
+    Returns:
+        pd.DataFrame: the converted dataframe
+    """  # noqa
+    for column, value_type in value_types.items():
+        if column not in df.columns or df[column].dtype != object:
+            continue
+        values = df[column]
+        types = set(map(type, values.to_numpy()))
+        if list in types or dict in types:
+            continue
+        if value_type == "date":
+            converted = pd.to_datetime(values, errors="coerce")
+            if converted.dtype == object:  # several offsets
+                converted = pd.to_datetime(values, errors="coerce", utc=True)
+        elif value_type == "number":
+            converted = pd.to_numeric(values, errors="coerce").astype(float)
+        elif value_type == "boolean":
+            if not types <= {bool, type(None)}:
+                continue
+            converted = values.astype("boolean")
+        else:
+            continue
+        if converted.notna().sum() == values.notna().sum():
+            df[column] = converted
+    return df
+
+
+def unlist_column(column: pd.Series) -> pd.Series:
+    """Replaces the lists of a single element of a column by their element, recursively
+
+    The cells are visited with C-level iterations (no Python function called per cell), only
+    the cells still containing lists are visited again, and the column is returned as is
+    when it has no list of a single element.
+
+    Example:
+        >>> unlist_column(pd.Series([[["a"]], ["b", "c"], "d"]))
+        [Out] pd.Series(["a", ["b", "c"], "d"])
+    """  # noqa
+    if column.dtype != object:
+        return column
+    values = column.to_numpy()
+    positions = np.arange(len(values))
+    unlisted = False
+    while len(positions) > 0:
+        cells = values[positions]
+        is_list = TYPE_OF(cells) == list
+        lists = cells[is_list]
+        is_single = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists)) == 1
+        positions = positions[is_list][is_single]
+        if len(positions) == 0:
+            break
+        if not unlisted:
+            values = values.copy()
+            unlisted = True
+        values[positions] = FIRST_ITEM(lists[is_single])
+    if not unlisted:
+        return column
+    return pd.Series(values, index=column.index, name=column.name)
+
+
+def _leaves(value) -> list:
+    """Returns the values of a cell as a flat list, nested lists being flattened"""
+    if isinstance(value, list):
+        return list(chain.from_iterable(map(_leaves, value)))
+    if value is None:
+        return []
+    return [value]
+
+
+def _cell_values(column: pd.Series):
+    """Returns the flat list of the values of each cell of a column, the concatenation of
+    these lists and the number of values of each cell"""  # noqa
+    leaves = list(map(_leaves, column.to_numpy()))
+    lengths = np.fromiter(map(len, leaves), dtype=np.int64, count=len(leaves))
+    values = np.array(list(chain.from_iterable(leaves)), dtype=object)
+    return values, lengths
+
+
+def explode_rows(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    """Creates a row for each value of the cells of a column (concatenation type 'row'), the
+    other columns being repeated. The rows are repeated according to the offsets of the
+    values of each cell in a single flat array of values, instead of building the product of
+    the values of each resource. A cell without value gives a row with None.
+
+    Example:
+        >>> explode_rows(pd.DataFrame({"id": [1, 2], "name": [["a", ["b"]], None]}), "name")
+        [Out] pd.DataFrame({"id": [1, 1, 2], "name": ["a", "b", None]})
+    """  # noqa
+    values, lengths = _cell_values(df[column])
+    counts = np.maximum(lengths, 1)
+    positions = np.repeat(np.arange(len(df)), counts)
+    exploded = np.full(counts.sum(), None, dtype=object)
+    # shift between the position of the values of each cell in the flat array of values and
+    # in the exploded column
+    shifts = (np.cumsum(counts) - counts) - (np.cumsum(lengths) - lengths)
+    exploded[np.repeat(shifts, lengths) + np.arange(len(values))] = values
+
+    df = df.iloc[positions].reset_index(drop=True)
+    df[column] = exploded
+    return df
+
+
+def expand_columns(df: pd.DataFrame, column: str) -> pd.DataFrame:
+    """Replaces a column by a column per value of its cells (concatenation type 'col'): the
+    i-th value of a cell goes into the column '<column>_<i>', as many columns being created
+    as the maximum number of values of a cell, the missing values being None
+
+    Example:
+        >>> expand_columns(pd.DataFrame({"name": [["a", "b"], "c"]}), "name")
+        [Out] pd.DataFrame({"name_0": ["a", "c"], "name_1": ["b", None]})
+    """  # noqa
+    values, lengths = _cell_values(df[column])
+    width = lengths.max() if len(lengths) > 0 else 0
+    matrix = np.full((len(df), width), None, dtype=object)
+    rows = np.repeat(np.arange(len(df)), lengths)
+    matrix[rows, np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)] = values
+
+    position = df.columns.get_loc(column)
+    df = df.drop(columns=column)
+    for index in range(width):
+        df.insert(position + index, f"{column}_{index}", matrix[:, index])
+    return df
+
+
+def explode_all(column: pd.Series) -> pd.Series:
+    """Explodes the (possibly nested) lists of a column, each value keeping the index of its
+    row. Empty lists become missing values."""  # noqa
+    while column.map(type).eq(list).any():
+        column = column.explode()
+    return column
+
+
+def condition_mask(
+    column: pd.Series, value: Union[str, List[Union[str, dict]]], prefix: str = None
+) -> pd.Series:
+    """Evaluates a where condition on a column whose cells may contain lists: a cell respects
+    the condition if one of its values does. Numeric values are compared as numbers to a
+    numeric condition value and the other values as strings (which orders ISO dates).
+    Missing values never respect the condition.
+
+    Example:
+        >>> condition_mask(pd.Series([["a", "b"], "c", None]), ["b", "c"])
+        [Out] pd.Series([True, True, False])
+
+    Arguments:
+        column (pd.Series): column of the values of the rows
+        value: value of the condition, or list of values (each a string or a {prefix: value}
+            dict) of which at least one must be respected. The prefix of a number or a date
+            may also be written before it, as in the urls (e.g. 'ge2000-01-01')
+        prefix (str): (optional) the prefix of the value of the condition (e.g. 'ge')
+
+    Returns:
+        pd.Series: boolean mask of the rows respecting the condition
+    """  # noqa
+    values = explode_all(column)
+    present = values.notna()
+    numbers = None
+    strings = values.astype(str)
+
+    mask = pd.Series(False, index=values.index)
+    for alternative in value if isinstance(value, list) else [value]:
+        alternative_prefix = prefix
+        if isinstance(alternative, dict):
+            alternative_prefix, alternative = next(iter(alternative.items()))
+        elif alternative_prefix is None and PREFIXED_VALUE.fullmatch(str(alternative)):
+            alternative_prefix, alternative = PREFIXED_VALUE.fullmatch(str(alternative)).groups()
+        comparator = COMPARATORS[alternative_prefix or "eq"]
+        result = comparator(strings, alternative)
+        try:
+            number = float(alternative)
+        except ValueError:
+            pass
+        else:
+            if numbers is None:
+                numbers = pd.to_numeric(values, errors="coerce")
+            # the numeric values are compared as numbers (e.g. 10 > 9)
+            result = result.where(numbers.isna(), comparator(numbers, number))
+        mask |= result
+
+    mask &= present
+    return mask.groupby(level=0).any().reindex(column.index, fill_value=False)
+
+
+def estimate_join_rows(left_on: pd.Series, right_on: pd.Series, how: str = "inner") -> int:
+    """Computes, without making it, the number of rows of the merge of two dataframes on
+    columns whose lists are exploded before the merge, from the number of occurrences of each
+    distinct key on both sides
+
+    Arguments:
+        left_on (pd.Series): join column of the left dataframe
+        right_on (pd.Series): join column of the right dataframe
+        how (str): type of merge: inner, left or right
+
+    Returns:
+        int: the number of rows of the merged dataframe
+    """  # noqa
+    left_counts = left_on.explode().value_counts(dropna=False)
+    right_counts = right_on.explode().value_counts(dropna=False)
+    rows = left_counts.mul(right_counts).sum()
+    if how == "left":
+        rows += left_counts[~left_counts.index.isin(right_counts.index)].sum()
+    elif how == "right":
+        rows += right_counts[~right_counts.index.isin(left_counts.index)].sum()
+    return int(rows)
+
+
+def row_memory(df: pd.DataFrame, sample_size: int = 1000) -> float:
+    """Estimates the memory used by a row of a dataframe, in bytes, on a sample of its rows"""
+    if len(df) == 0:
+        return 0
+    sample = df.head(sample_size)
+    return sample.memory_usage(deep=True, index=False).sum() / len(sample)
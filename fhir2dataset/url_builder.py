@@ -1,13 +1,118 @@
 import logging
+import re
 from collections import defaultdict
 from posixpath import join as urljoin
-from typing import Type
+from typing import List, Type
+from urllib.parse import urlencode, urlsplit, urlunsplit
 
-from fhir2dataset.data_class import SearchParameter
+from fhir2dataset.data_class import Element, SearchParameter
 from fhir2dataset.graphquery import GraphQuery
 
 logger = logging.getLogger(__name__)
 
+# maximum length of the urls sent to the API, longer urls are rejected by many servers
+MAX_URL_LENGTH = 2000
+# parameters controlling the results of a search rather than selecting them, whose
+# comma-separated values are not combined with OR
+RESULT_PARAMS = [
+    "_sort",
+    "_count",
+    "_include",
+    "_revinclude",
+    "_summary",
+    "_total",
+    "_elements",
+    "_contained",
+    "_containedType",
+]
+
+
+def searchparam_value(search_param: SearchParameter) -> str:
+    """Returns the value of a search parameter as written in an url (e.g. 'ge1970' or 'a,b')"""
+    values = search_param.value if isinstance(search_param.value, list) else [search_param.value]
+    prefix = search_param.prefix or ""
+    written = [
+        "".join(next(iter(value.items()))) if isinstance(value, dict) else f"{prefix}{value}"
+        for value in values
+    ]
+    if isinstance(search_param.value, list):
+        # each value of a list is a literal, whose commas are escaped
+        written = [value.replace(",", r"\,") for value in written]
+    # the values separated by commas are combined with OR by the API
+    return ",".join(written)
+
+
+def add_url_param(url: str, key: str, value: str) -> str:
+    """Adds a search parameter to an url, after its other parameters
+
+    Example:
+        >>> add_url_param("Patient?gender=female", "_count", "1")
+        [Out] "Patient?gender=female&_count=1"
+
+    Arguments:
+        url (str): url of a search
+        key (str): name of the search parameter (e.g. '_lastUpdated')
+        value (str): value of the search parameter (e.g. 'ge2021-01-01T10:00:00.000Z')
+
+    Returns:
+        str: the url with the search parameter
+    """  # noqa
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    param = urlencode({key: value}, safe=":,|")
+    return urlunsplit((scheme, netloc, path, f"{query}&{param}" if query else param, fragment))
+
+
+def split_url(url: str, max_length: int = MAX_URL_LENGTH) -> List[str]:
+    """Splits an url longer than max_length into several urls whose results together are the
+    results of the url: the comma-separated values of its longest list search parameter,
+    which are combined with OR by the API, are distributed among the urls (the parameters
+    controlling the results, such as _sort or _elements, are never split).
+
+    Example:
+        >>> split_url("Patient?_id=1,2,3&gender=female", max_length=29)
+        [Out] ["Patient?_id=1,2&gender=female", "Patient?_id=3&gender=female"]
+
+    Arguments:
+        url (str): url of a search
+        max_length (int): maximum length of the urls
+
+    Returns:
+        list: the urls, only the url itself if it is not too long or can't be split
+    """  # noqa
+    if len(url) <= max_length or "?" not in url:
+        return [url]
+    base, params = url.split("?", 1)
+    params = re.split(r"[&?]", params)
+    # the values of the search parameters, separated by the commas that are not escaped (as
+    # \, or as %5C,)
+    candidates = {
+        index: re.split(r"(?<!\\)(?<!%5C),", param.split("=", 1)[1])
+        for index, param in enumerate(params)
+        if "=" in param and param.split("=", 1)[0] not in RESULT_PARAMS
+    }
+    index = max(candidates, key=lambda i: (len(candidates[i]) > 1, len(params[i])), default=None)
+    if index is None or len(candidates[index]) < 2:
+        logger.warning(f"the url {url} is too long but can't be split")
+        return [url]
+    key, value = params[index].split("=", 1)
+    values = candidates[index]
+
+    fixed_length = len(url) - len(value)
+    chunks = [[]]
+    chunk_length = 0
+    for value in values:
+        if chunks[-1] and fixed_length + chunk_length + 1 + len(value) > max_length:
+            chunks.append([])
+            chunk_length = 0
+        chunk_length += len(value) + (1 if len(chunks[-1]) > 0 else 0)
+        chunks[-1].append(value)
+
+    # the parameters before and after the split parameter
+    before, after = params[:index], params[index:][1:]
+    return [
+        f"{base}?" + "&".join([*before, f"{key}={','.join(chunk)}", *after]) for chunk in chunks
+    ]
+
 
 class URLBuilder:
     """class that allows to build the url of a query that will be made for an alias
@@ -19,10 +124,19 @@ class URLBuilder:
             representation of the global query
         main_resource_alias (str): alias given to a set of fhir resources of a certain type
             which are the subject of the api query
+        pushed_aliases (set): aliases whose "where conditions" are taken into account in the
+            url, filled when the url is computed
+        max_chain_depth (int): maximum number of references followed to take into account
+            the "where conditions" of the other aliases, 0 to only use the conditions of the
+            main alias
     """  # noqa
 
     def __init__(
-        self, fhir_api_url: str, graph_query: GraphQuery, main_resource_alias: str
+        self,
+        fhir_api_url: str,
+        graph_query: GraphQuery,
+        main_resource_alias: str,
+        max_chain_depth: int = None,
     ) -> None:
         """
         Arguments:
@@ -30,17 +144,31 @@ class URLBuilder:
             graph_query (GraphQuery): instance of a GraphQuery object that gives a graphical
                 representation of the global query
             main_resource_alias (str): alias given to a set of fhir resources of a certain type
+            max_chain_depth (int): (Optional) overrides the max_chain_depth of the FHIR rules
         """  # noqa
         self.fhir_api_url = fhir_api_url
         self.graph_query = graph_query
         self.main_resource_alias = main_resource_alias
+        if max_chain_depth is None:
+            max_chain_depth = graph_query.fhir_rules.max_chain_depth
+        self.max_chain_depth = max_chain_depth
 
         self._params = defaultdict(list)
+        self.pushed_aliases = set()
 
     def compute(self):
         self._update_url_params()
         return self._compute_url()
 
+    def add_param(self, key: str, value: str):
+        """Adds a search parameter to the url, in addition to the ones deduced from the query
+
+        Arguments:
+            key (str): name of the search parameter (e.g. '_id')
+            value (str): value of the search parameter (e.g. '1,2,3')
+        """
+        self._params[key].append(value)
+
     def _compute_url(self) -> str:
         """Generates the url which will make it possible to recover the resources of the type
         of main_alias respecting as well as possible the conditions where on itself and on its
@@ -67,23 +195,55 @@ class URLBuilder:
 
         The FHIR API makes union when "where conditions" are requested for neighbouring resources
         Only one "where condition" on every neighbouring resource is taken into account
+
+        The "where conditions" which are not on searchparams are not sent to the API.
+
+        The "where conditions" of resources further in the graph are taken into account with
+        multi-level chained parameters (e.g. encounter:Encounter.subject:Patient.gender) or
+        nested _has parameters (e.g. _has:Encounter:subject:_has:Observation:encounter:code),
+        as long as the path to the resource doesn't mix both, doesn't go through a child join
+        and isn't longer than the max_chain_depth of the FHIR rules.
         """  # noqa
-        for resource_alias in self.graph_query.resources_graph.neighbors(self.main_resource_alias):
-            edge_info = self.graph_query.resources_graph.edges[
-                self.main_resource_alias, resource_alias
-            ]["info"]
-            if edge_info.join_how == "child":
+        max_depth = self.max_chain_depth
+        # paths to the resources reached, the value is (searchparam_prefix, is_chained, depth)
+        paths = {self.main_resource_alias: ("", None, 0)}
+        to_visit = [self.main_resource_alias]
+        while to_visit:
+            alias = to_visit.pop(0)
+            prefix, is_chained, depth = paths[alias]
+            if depth >= max_depth:
                 continue
+            for resource_alias in self.graph_query.resources_graph.neighbors(alias):
+                if resource_alias in paths:
+                    continue
+                edge_info = self.graph_query.resources_graph.edges[alias, resource_alias]["info"]
+                if edge_info.join_how == "child":
+                    continue
+                # a chained parameter goes from the parent to the child of the edge
+                edge_is_chained = edge_info.parent == alias
+                if is_chained is not None and edge_is_chained != is_chained:
+                    continue
+                paths[resource_alias] = (
+                    prefix + edge_info.searchparam_prefix[alias],
+                    edge_is_chained,
+                    depth + 1,
+                )
+                to_visit.append(resource_alias)
 
+        for resource_alias, (searchparam_prefix, _, _) in paths.items():
+            if resource_alias == self.main_resource_alias:
+                continue
             resource = self.graph_query.resources_by_alias[resource_alias]
             elements = resource.elements.where(goal="where")
 
             # Update url for each condition in "where conditions" on resource_alias
             for element in elements:
-                search_param = element.search_parameter
-                searchparam_prefix = edge_info.searchparam_prefix[self.main_resource_alias]
-
-                self._update_params_dict(search_param, searchparam_prefix=searchparam_prefix)
+                if not self._is_searchparam(element, resource.resource_type):
+                    continue
+                self._update_params_dict(
+                    element.search_parameter, searchparam_prefix=searchparam_prefix
+                )
+            self.pushed_aliases.add(resource_alias)
 
             logger.debug(f"the part of the url for the params is: {self._params}")
 
@@ -92,14 +252,24 @@ class URLBuilder:
         elements = resource_alias_info.elements.where(goal="where")
 
         for element in elements:
+            if not self._is_searchparam(element, resource_alias_info.resource_type):
+                continue
             self._update_params_dict(element.search_parameter)
+        self.pushed_aliases.add(self.main_resource_alias)
 
         logger.debug(f"the part of the url for the params is: {self._params}")
 
+    def _is_searchparam(self, element: Element, resource_type: str) -> bool:
+        """Checks whether the condition of a where element can be sent to the API. The other
+        conditions are evaluated on the retrieved resources"""  # noqa
+        return self.graph_query.fhir_rules.is_searchparam(
+            element.search_parameter.code, resource_type
+        )
+
     def _update_params_dict(
         self, search_param: Type[SearchParameter], searchparam_prefix: str = ""
     ):
         key = f"{searchparam_prefix}{search_param.code}"
-        value = f"{search_param.prefix or ''}{search_param.value}"
+        value = searchparam_value(search_param)
 
         self._params[key].append(value)
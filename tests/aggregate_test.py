@@ -0,0 +1,55 @@
+import pandas as pd
+
+from fhir2dataset.aggregate import GroupByAggregator
+from fhir2dataset.data_class import Aggregate
+
+
+def test_group_by_aggregator():
+    aggregates = {
+        "COUNT(*)": Aggregate(function="count"),
+        "MIN(birthDate)": Aggregate(function="min", alias="p", column="birthDate"),
+        "SUM(weight)": Aggregate(function="sum", alias="p", column="weight"),
+        "COUNT(DISTINCT name)": Aggregate(
+            function="count", alias="p", column="name", distinct=True
+        ),
+    }
+    columns = {
+        "COUNT(*)": None,
+        "MIN(birthDate)": "birthDate",
+        "SUM(weight)": "weight",
+        "COUNT(DISTINCT name)": "name",
+    }
+    aggregator = GroupByAggregator(["gender"], aggregates, columns)
+
+    # the rows are added page by page
+    aggregator.update(
+        pd.DataFrame(
+            {
+                "gender": [["female"], "male", "female"],
+                "birthDate": ["2000-01-01", None, "1990-05-01"],
+                "weight": [[60, 2], "80", None],
+                "name": ["Ada", "Bob", "Ada"],
+            }
+        )
+    )
+    aggregator.update(
+        pd.DataFrame(
+            {
+                "gender": ["male", None],
+                "birthDate": ["1980-01-01", "1970-01-01"],
+                "weight": [10, 50],
+                "name": ["Carl", "Dan"],
+            }
+        )
+    )
+    result = aggregator.result().set_index("gender")
+    assert result.loc["female"].tolist() == [2, "1990-05-01", 62, 1]
+    assert result.loc["male"].tolist() == [2, "1980-01-01", 90, 2]
+    assert result["COUNT(*)"].sum() == 5
+
+
+def test_group_by_aggregator_no_rows():
+    aggregator = GroupByAggregator(
+        [], {"COUNT(*)": Aggregate(function="count")}, {"COUNT(*)": None}
+    )
+    assert aggregator.result().to_dict("list") == {"COUNT(*)": [0]}
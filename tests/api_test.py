@@ -1,4 +1,7 @@
+import json
 import logging
+import re
+import threading
 
 import pandas as pd
 import pytest
@@ -114,3 +117,294 @@ def test_api_request__get_data():
     tabular_results = call_api._get_data(results)
 
     assert (expected_tabular_results == tabular_results).all().bool()
+
+
+def test_api_request_limit_page_size():
+    url = "http://hapi.fhir.org/baseR4/Patient"
+    call_api = ApiRequest(url, Elements(), limit=10)
+    assert call_api._fix_next_url(url).endswith("_count=10")
+
+    call_api = ApiRequest(url, Elements(), limit=10000)
+    assert call_api._fix_next_url(url).endswith(f"_count={query.api.PAGE_SIZE}")
+
+
+@pytest.mark.parametrize(
+    "concat_type, expected",
+    [
+        ("cell", {"from_id": ["1", "2"], "given": [[["Jean", "Paul"]], [["Anne"]]]}),
+        ("row", {"from_id": ["1", "1", "2"], "given": ["Jean", "Paul", "Anne"]}),
+        ("col", {"from_id": ["1", "2"], "given_0": ["Jean", "Anne"], "given_1": ["Paul", None]}),
+    ],
+)
+def test_api_request_concat_types(concat_type, expected):
+    elements = Elements()
+    elements.append(Element("from_id", "_id", concat_type="row"))
+    elements.append(Element("given", "Patient.name.given", concat_type=concat_type))
+    call_api = ApiRequest("http://hapi.fhir.org/baseR4/Patient", elements)
+
+    results = [
+        {"resource": {"resourceType": "Patient", "id": "1", "name": [{"given": ["Jean", "Paul"]}]}},
+        {"resource": {"resourceType": "Patient", "id": "2", "name": [{"given": ["Anne"]}]}},
+    ]
+    tabular_results = call_api._get_data(results)
+    assert tabular_results.to_dict("list") == expected
+
+
+def get_page(self, url, entries=True):
+    """Fake _get_response returning 5 pages of 3 patients"""
+    page = int(re.search(r"page=(\d+)", url).group(1)) if "page=" in url else 0
+    content = {
+        "link": (
+            [{"relation": "next", "url": f"http://fhir/Patient?page={page + 1}"}]
+            if page < 4
+            else []
+        ),
+        "entry": [
+            {"resource": {"resourceType": "Patient", "id": f"{page}-{index}"}} for index in range(3)
+        ],
+    }
+    response = ApiCall._bundle_header(json.dumps(content).encode())
+    assert response.next_url == (content["link"][0]["url"] if content["link"] else None)
+    return Response(
+        results=content["entry"] if entries else None,
+        next_url=response.next_url,
+        content=json.dumps(content).encode(),
+    )
+
+
+@pytest.mark.parametrize(
+    "content, expected",
+    [
+        ('{"total": 3, "link": [{"relation": "next", "url": "u"}], "entry": [{}]}', (3, "u")),
+        ('{ "link" : [{"relation": "next", "url": "u"}] , "entry" : [ ] }', (0, None)),
+        ('{"resourceType": "Bundle", "total": 0}', (0, None)),
+        ('{"entry": [{}], "link": [{"relation": "next", "url": "u"}]}', None),
+        ('{"resourceType": "OperationOutcome"}', None),
+    ],
+)
+def test_api_call_bundle_header(content, expected):
+    response = ApiCall._bundle_header(content.encode())
+    if expected is None:
+        assert response is None
+    else:
+        assert (response.total, response.next_url) == expected
+        assert response.results is None
+
+
+def test_api_request_extraction_workers(monkeypatch):
+    monkeypatch.setattr(ApiCall, "_get_response", get_page)
+    elements = Elements()
+    elements.append(Element("from_id", "_id"))
+
+    df = ApiRequest("http://fhir/Patient", elements, total=15, extraction_workers=2).get_all()
+    assert list(df["from_id"]) == [f"{page}-{index}" for page in range(5) for index in range(3)]
+    assert df.equals(ApiRequest("http://fhir/Patient", elements, total=15).get_all())
+
+
+def test_api_request_prefetch_pages(monkeypatch):
+    requested = {}
+
+    def get_response(self, url, entries=True):
+        response = get_page(self, url)
+        requested.setdefault(url.split("?")[1], threading.Event()).set()
+        return response
+
+    def get_data(self, results):
+        # the next page is requested while the first page is extracted
+        if results and results[0]["resource"]["id"] == "0-0":
+            assert requested.setdefault("page=1", threading.Event()).wait(timeout=5)
+        return get_data_sequential(self, results)
+
+    get_data_sequential = ApiRequest._get_data
+    monkeypatch.setattr(ApiCall, "_get_response", get_response)
+    monkeypatch.setattr(ApiRequest, "_get_data", get_data)
+    elements = Elements()
+    elements.append(Element("from_id", "_id"))
+
+    df = ApiRequest("http://fhir/Patient", elements, total=15, prefetch_pages=True).get_all()
+    assert list(df["from_id"]) == [f"{page}-{index}" for page in range(5) for index in range(3)]
+
+
+def test_api_request_shards(monkeypatch):
+    # updates skewed towards the end of the period
+    dates = pd.Timestamp("2020-01-01", tz="UTC") + pd.to_timedelta(
+        [(index / 300) ** 4 * 365 for index in range(300)], unit="D"
+    )
+    resources = [
+        {"resourceType": "Patient", "id": str(index), "meta": {"lastUpdated": date.isoformat()}}
+        for index, date in enumerate(dates)
+    ]
+    counts = []
+
+    def get_response(self, url, entries=True):
+        matching = resources
+        for prefix, bound in re.findall(r"_lastUpdated=(ge|lt)([^?&]+)", url):
+            bound = pd.Timestamp(bound)
+            matching = [
+                resource
+                for resource in matching
+                if (pd.Timestamp(resource["meta"]["lastUpdated"]) >= bound) == (prefix == "ge")
+            ]
+        if "_summary=count" in url:
+            counts.append(url)
+            return Response(total=len(matching))
+        if "_sort=-_lastUpdated" in url:
+            matching = matching[-1:]
+        elif "_sort=_lastUpdated" in url:
+            matching = matching[:1]
+        return Response(results=[{"resource": resource} for resource in matching])
+
+    monkeypatch.setattr(ApiCall, "_get_response", get_response)
+    elements = Elements()
+    elements.append(Element("from_id", "_id"))
+    call_api = ApiRequest("http://fhir/Patient", elements, shards=4)
+
+    urls, totals = call_api._shard_urls(300)
+    assert len(urls) == 4
+    assert sum(totals) == 300
+    assert max(totals) <= 150
+    assert "_lastUpdated=ge" not in urls[0] and "_lastUpdated=lt" not in urls[-1]
+
+    df = call_api.get_all()
+    assert sorted(df["from_id"], key=int) == [str(index) for index in range(300)]
+
+
+def test_api_call_batch_counts(monkeypatch):
+    bundles = []
+
+    class BatchResponse:
+        status_code = 200
+
+        def __init__(self, bundle):
+            self.bundle = bundle
+
+        def json(self):
+            return {
+                "resourceType": "Bundle",
+                "type": "batch-response",
+                "entry": [
+                    {
+                        "resource": {
+                            "resourceType": "Bundle",
+                            "total": len(entry["request"]["url"]),
+                        },
+                        "response": {"status": "200 OK"},
+                    }
+                    for entry in self.bundle["entry"]
+                ],
+            }
+
+    def post(url, json, auth):
+        assert url == "http://fhir/baseR4"
+        bundles.append(json)
+        return BatchResponse(json)
+
+    monkeypatch.setattr("fhir2dataset.api.requests.post", post)
+    urls = [
+        "http://fhir/baseR4/Patient?gender=female",
+        "http://fhir/baseR4/Patient?gender=male",
+        "http://fhir/baseR4/Patient?gender=other?birthdate=ge2000",
+    ]
+    counts = ApiCall("http://fhir/baseR4/")._get_batch_counts(urls, max_batch_size=2)
+
+    assert [len(bundle["entry"]) for bundle in bundles] == [2, 1]
+    assert bundles[0]["type"] == "batch"
+    relative_urls = [entry["request"]["url"] for bundle in bundles for entry in bundle["entry"]]
+    assert relative_urls == [
+        "Patient?gender=female&_summary=count",
+        "Patient?gender=male&_summary=count",
+        "Patient?gender=other&birthdate=ge2000&_summary=count",
+    ]
+    assert counts == [len(url) for url in relative_urls]
+
+    monkeypatch.setattr(BatchResponse, "json", lambda self: {"resourceType": "OperationOutcome"})
+    with pytest.raises(ValueError):
+        ApiCall("http://fhir/baseR4/")._get_batch_counts(urls)
+
+
+def test_api_call_post_search(monkeypatch):
+    requests_sent = []
+
+    class SearchResponse:
+        status_code = 200
+        content = b""
+
+        def json(self):
+            return {"resourceType": "Bundle", "total": 3, "entry": []}
+
+    def get(url, auth):
+        requests_sent.append(("GET", url, None))
+        return SearchResponse()
+
+    def post(url, data, headers, auth):
+        assert headers["Content-Type"] == "application/x-www-form-urlencoded"
+        requests_sent.append(("POST", url, data))
+        return SearchResponse()
+
+    monkeypatch.setattr("fhir2dataset.api.requests.get", get)
+    monkeypatch.setattr("fhir2dataset.api.requests.post", post)
+    ids = ",".join(str(index) for index in range(1000))
+    url = f"http://fhir/baseR4/Patient?_id={ids}&gender=female"
+
+    assert ApiCall(url, post_search=True)._get_count(url) == 3
+    assert requests_sent[-1] == (
+        "POST",
+        "http://fhir/baseR4/Patient/_search",
+        f"_id={ids}&gender=female&_summary=count".encode(),
+    )
+
+    short_url = "http://fhir/baseR4/Patient?gender=female"
+    ApiCall(short_url, post_search=True)._get_count(short_url)
+    assert requests_sent[-1][0] == "GET"
+
+    # without POST, the long url is split into several searches
+    del requests_sent[:]
+    ApiRequest(url, Elements()).get_all()
+    assert len(requests_sent) > 1
+    assert all(method == "GET" for method, _, _ in requests_sent)
+
+    del requests_sent[:]
+    ApiRequest(url, Elements(), post_search=True).get_all()
+    # the count and the page of the search
+    assert [method for method, _, _ in requests_sent] == ["POST", "POST"]
+
+
+@pytest.mark.parametrize("extraction_workers", [None, 2])
+def test_api_request_checkpoint(monkeypatch, tmp_path, extraction_workers):
+    requested = []
+
+    def get_response(self, url, entries=True):
+        requested.append(url.split("?")[1] if "?" in url else "page=0")
+        if "page=3" in url and not resumed:
+            raise ValueError("network error")
+        return get_page(self, url)
+
+    monkeypatch.setattr(ApiCall, "_get_response", get_response)
+    monkeypatch.setattr("fhir2dataset.checkpoint.CHECKPOINT_PAGES", 2)
+    elements = Elements()
+    elements.append(Element("from_id", "_id"))
+
+    def get_all():
+        return ApiRequest(
+            "http://fhir/Patient",
+            elements,
+            total=15,
+            extraction_workers=extraction_workers,
+            checkpoint_dir=str(tmp_path),
+        ).get_all()
+
+    resumed = False
+    with pytest.raises(ValueError):
+        get_all()
+
+    # the pages 0 and 1 were stored, the page 2 wasn't
+    resumed = True
+    requested.clear()
+    df = get_all()
+    assert requested[0] == "page=2"
+    assert list(df["from_id"]) == [f"{page}-{index}" for page in range(5) for index in range(3)]
+
+    # all the pages are stored
+    requested.clear()
+    assert get_all().equals(df)
+    assert requested == []
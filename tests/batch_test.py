@@ -0,0 +1,63 @@
+import json
+
+import pandas as pd
+
+from fhir2dataset.batch import QueryBatch
+
+
+def test_batch_plan_merges_identical_searches():
+    sql_queries = [
+        "SELECT p.gender FROM Patient AS p WHERE p.birthdate=ge2000-01-01",
+        "SELECT p.name.family FROM Patient AS p WHERE p.birthdate=ge2000-01-01",
+        "SELECT p.name.family FROM Patient AS p WHERE p.birthdate=ge1990-01-01",
+    ]
+    batch = QueryBatch().from_sql(sql_queries)
+    batch._plan()
+
+    assert len(batch.searches) == 2
+
+    search = batch.searches[batch.queries[0]._compute_urls()["p"]]
+    assert len(search.users) == 2
+    col_names = [element.col_name for element in search.elements.elements]
+    assert "Patient.gender" in col_names
+    assert "Patient.name.family" in col_names
+    assert len(col_names) == len(set(col_names))
+
+
+def test_batch_project():
+    batch = QueryBatch().from_sql(
+        [
+            "SELECT p.gender FROM Patient AS p",
+            "SELECT p.name.family FROM Patient AS p",
+        ]
+    )
+    batch._plan()
+    df = pd.DataFrame(
+        {"from_id": ["1", "2"], "Patient.gender": ["male", "female"], "Patient.name.family": [1, 2]}
+    )
+    projected = batch._project(df, batch.queries[1], "p")
+
+    assert list(projected.columns) == ["from_id", "Patient.name.family"]
+
+
+def test_batch_query_options(monkeypatch, tmp_path):
+    def get_response(self, url, entries=True):
+        raise AssertionError(f"the API is requested: {url}")
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+    patient = {"resourceType": "Patient", "id": "1", "gender": "male", "birthDate": "2000-01-01"}
+    (tmp_path / "Patient.ndjson").write_text(json.dumps(patient) + "\n")
+    batch = QueryBatch(bulk_dir=str(tmp_path), infer_types=True).from_sql(
+        [
+            "SELECT p.birthDate FROM Patient AS p",
+            "SELECT p.gender FROM Patient AS p",
+        ]
+    )
+    assert all(query.infer_types for query in batch.queries)
+
+    # the queries reading the files of an export don't share searches on the API
+    batch._plan()
+    assert batch.searches == {}
+    birth_dates, genders = batch.execute()
+    assert birth_dates["p:Patient.birthDate"].tolist() == [pd.Timestamp("2000-01-01")]
+    assert genders["p:Patient.gender"].tolist() == ["male"]
@@ -0,0 +1,145 @@
+import json
+
+import pytest
+
+from fhir2dataset.bulk import BulkRequest, ndjson_files
+from fhir2dataset.data_class import Element, Elements
+from fhir2dataset.parser import Parser
+from fhir2dataset.query import Query
+
+
+def write_ndjson(path, resources):
+    path.write_text("\n".join(json.dumps(resource) for resource in resources) + "\n\n")
+
+
+@pytest.fixture
+def export_dir(tmp_path):
+    patients = [
+        {"resourceType": "Patient", "id": str(i), "gender": gender, "birthDate": birth_date}
+        for i, (gender, birth_date) in enumerate(
+            [("female", "1990-01-01"), ("male", "1980-01-01"), ("female", "2010-01-01")]
+        )
+    ]
+    write_ndjson(tmp_path / "1.Patient.ndjson", patients[:2])
+    write_ndjson(tmp_path / "2.Patient.ndjson", patients[2:])
+    write_ndjson(
+        tmp_path / "Encounter.ndjson",
+        [
+            {
+                "resourceType": "Encounter",
+                "id": f"e{i}",
+                "status": "finished",
+                "subject": {"reference": f"Patient/{i % 3}"},
+            }
+            for i in range(5)
+        ],
+    )
+    (tmp_path / "Patient.json").write_text("{}")
+    return tmp_path
+
+
+@pytest.fixture
+def no_api(monkeypatch):
+    def get_response(self, url, entries=True):
+        raise AssertionError(f"the API is requested: {url}")
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+
+
+def test_ndjson_files(export_dir):
+    assert [path.split("/")[-1] for path in ndjson_files(str(export_dir), "Patient")] == [
+        "1.Patient.ndjson",
+        "2.Patient.ndjson",
+    ]
+    assert ndjson_files(str(export_dir), "Observation") == []
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_bulk_request(export_dir, monkeypatch, workers):
+    # several chunks per file
+    monkeypatch.setattr("fhir2dataset.bulk.CHUNK_SIZE", 1)
+    elements = Elements(
+        [
+            Element(col_name="from_id", fhirpath="_id"),
+            Element(col_name="Patient.gender", fhirpath="Patient.gender"),
+        ]
+    )
+    df = BulkRequest(str(export_dir), "Patient", elements, workers=workers).get_all()
+    assert list(df["from_id"]) == ["0", "1", "2"]
+
+    df = BulkRequest(str(export_dir), "Patient", elements, limit=1).get_all()
+    assert list(df["from_id"]) == ["0"]
+
+
+def test_query_bulk_dir(export_dir, no_api):
+    query = Query(bulk_dir=str(export_dir)).from_config(Parser().from_sql("""
+            SELECT p.gender, e.status FROM Patient AS p
+            INNER JOIN Encounter AS e ON e.subject = p._id
+            WHERE p.gender = 'female' AND p.birthdate = ge2000-01-01
+            """))
+    df = query.execute()
+    assert sorted(df["e:from_id"]) == ["Encounter/e2"]
+    assert list(query.predicate_report()["applied_by"]) == ["client", "client"]
+
+    query = Query(bulk_dir=str(export_dir)).from_config(Parser().from_sql("""
+            SELECT COUNT(*) FROM Patient AS p
+            INNER JOIN Encounter AS e ON e.subject = p._id
+            WHERE p.gender = 'female'
+            """))
+    assert query.execute()["COUNT(*)"][0] == 3
+
+    query = Query(bulk_dir=str(export_dir)).from_config(Parser().from_sql("""
+            SELECT p.gender, MIN(p.birthDate) FROM Patient AS p GROUP BY p.gender
+            """))
+    df = query.execute()
+    assert dict(zip(df["p:Patient.gender"], df["MIN(p.birthDate)"])) == {
+        "female": "1990-01-01",
+        "male": "1980-01-01",
+    }
+
+
+@pytest.mark.parametrize(
+    "condition,expected",
+    [
+        ("o.code = '29463-7'", ["o0", "o2"]),
+        ("o.code = 'http://loinc.org|29463-7'", ["o0"]),
+        ("o.code = 'http://snomed.info/sct|'", ["o2"]),
+        ("o.subject = 'Patient/1'", ["o1", "o2"]),
+        ("o.subject = '0'", ["o0"]),
+        ("o.status = 'final'", ["o0", "o1", "o2"]),
+    ],
+)
+def test_query_bulk_dir_search_types(tmp_path, no_api, condition, expected):
+    write_ndjson(
+        tmp_path / "Observation.ndjson",
+        [
+            {
+                "resourceType": "Observation",
+                "id": f"o{i}",
+                "status": "final",
+                "code": {"coding": [{"system": system, "code": code}]},
+                "subject": {"reference": f"Patient/{min(i, 1)}"},
+            }
+            for i, (system, code) in enumerate(
+                [
+                    ("http://loinc.org", "29463-7"),
+                    ("http://loinc.org", "8302-2"),
+                    ("http://snomed.info/sct", "29463-7"),
+                ]
+            )
+        ],
+    )
+    query = Query(bulk_dir=str(tmp_path)).from_config(
+        Parser().from_sql(f"SELECT o.status FROM Observation AS o WHERE {condition}")
+    )
+    assert sorted(query.execute()["o:from_id"]) == [f"Observation/{id}" for id in expected]
+
+
+def test_query_bulk_dir_unsupported_condition(tmp_path, no_api):
+    write_ndjson(tmp_path / "Observation.ndjson", [{"resourceType": "Observation", "id": "o0"}])
+    query = Query(bulk_dir=str(tmp_path)).from_config(Parser().from_sql("""
+            SELECT o.status FROM Observation AS o
+            WHERE o.code-value-quantity = 'http://loinc.org|29463-7$gt100'
+            """))
+    with pytest.raises(ValueError, match="composite"):
+        query.execute()
@@ -53,3 +53,95 @@ def test_from():
 )
 def test_where(sql_query):
     Parser().from_sql(sql_query)
+
+
+def test_limit():
+    config = Parser().from_sql("SELECT p.name.family FROM Patient AS p LIMIT 10")
+    assert config["limit"] == 10
+
+    config = Parser().from_sql(
+        "SELECT p.name.family FROM Patient AS p WHERE p.gender = 'female' LIMIT 5;"
+    )
+    assert config["limit"] == 5
+    assert config["where"] == {"p": {"gender": ["female"]}}
+
+    with pytest.raises(ValueError):
+        Parser().from_sql("SELECT p.name.family FROM Patient AS p LIMIT ten")
+    with pytest.raises(ValueError):
+        Parser().from_sql("SELECT p.name.family FROM Patient AS p LIMIT 0")
+
+
+def test_aggregate():
+    config = Parser().from_sql(
+        "SELECT COUNT(*), count(DISTINCT p._id) FROM Patient AS p WHERE p.gender = 'female'"
+    )
+    assert config["aggregate"] == {
+        "COUNT(*)": {"function": "count"},
+        "COUNT(DISTINCT p._id)": {
+            "function": "count",
+            "alias": "p",
+            "column": "_id",
+            "distinct": True,
+        },
+    }
+    assert "select" not in config
+
+    with pytest.raises(ValueError):
+        Parser().from_sql("SELECT COUNT(DISTINCT *) FROM Patient AS p")
+    with pytest.raises(ValueError):
+        Parser().from_sql("SELECT MEDIAN(p.birthdate) FROM Patient AS p")
+
+
+def test_order_by():
+    config = Parser().from_sql(
+        "SELECT p.gender FROM Patient AS p ORDER BY p.birthdate DESC, p.name.family LIMIT 3"
+    )
+    assert config["order_by"] == [
+        {"alias": "p", "column": "birthdate", "ascending": False},
+        {"alias": "p", "column": "name.family", "ascending": True},
+    ]
+    assert config["limit"] == 3
+
+    with pytest.raises(ValueError):
+        Parser().from_sql("SELECT p.gender FROM Patient AS p ORDER BY p.birthdate DOWN")
+
+
+def test_group_by():
+    config = Parser().from_sql(
+        "SELECT p.gender, COUNT(*), MIN(p.birthDate) FROM Patient AS p GROUP BY p.gender"
+    )
+    assert config["group_by"] == [{"alias": "p", "column": "gender"}]
+    assert config["aggregate"] == {
+        "COUNT(*)": {"function": "count"},
+        "MIN(p.birthDate)": {"function": "min", "alias": "p", "column": "Patient.birthDate"},
+    }
+
+
+def test_where_or():
+    config = Parser().from_sql("""
+        SELECT p.gender FROM Patient AS p
+        WHERE p.gender IN ('female', 'other') AND (p.birthdate ge 2000 OR p.birthdate lt 1900)
+        """)
+    assert config["where"] == {
+        "p": {"gender": [["female", "other"]], "birthdate": [[{"ge": "2000"}, {"lt": "1900"}]]}
+    }
+
+    with pytest.raises(ValueError):
+        Parser().from_sql(
+            "SELECT p.gender FROM Patient AS p WHERE p.gender = 'female' OR p.birthdate = 2000"
+        )
+
+
+def test_where_quoted_literals():
+    config = Parser().from_sql("""
+        SELECT p.gender FROM Patient AS p
+        WHERE p.name.family = 'Tom or Jerry' AND p.gender IN ('a,b', "c") AND
+        (p.name.given = 'x and y' OR p.name.given = 'z')
+        """)
+    assert config["where"] == {
+        "p": {
+            "name.family": ["Tom or Jerry"],
+            "gender": [["a,b", "c"]],
+            "name.given": [["x and y", "z"]],
+        }
+    }
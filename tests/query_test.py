@@ -0,0 +1,644 @@
+import re
+
+import pandas as pd
+import pytest
+
+from fhir2dataset.aggregate import GroupByAggregator
+from fhir2dataset.api import Response
+from fhir2dataset.parser import Parser
+from fhir2dataset.query import Query
+
+
+def build_query(sql_query: str) -> Query:
+    query = Query().from_config(Parser().from_sql(sql_query))
+    query._build_graph_query()
+    return query
+
+
+def test_semi_join_values():
+    query = build_query("""
+        SELECT c.code, p.gender
+        FROM Condition AS c
+        INNER JOIN Patient AS p ON c.subject = p._id
+        LIMIT 2
+        """)
+    query.dataframes["c"] = pd.DataFrame(
+        {
+            "from_id": ["c1", "c2"],
+            "join_subject": ["Patient/1", ["Patient/2", "Group/3", "Patient/1"]],
+        }
+    )
+    assert query._semi_join_values("c", "p") == ("_id", ["1", "2"])
+
+    query.dataframes["p"] = pd.DataFrame({"from_id": ["1", "2"]})
+    assert query._semi_join_values("p", "c") == ("subject", ["Patient/1", "Patient/2"])
+
+
+def test_count_pushdown():
+    query = build_query("""
+        SELECT COUNT(*) FROM Patient AS p
+        WHERE p.gender = 'female' AND p.birthdate = ge2000-01-01
+        """)
+    url = query._count_pushdown(query.aggregates["COUNT(*)"])[1]
+    assert url == "http://hapi.fhir.org/baseR4/Patient?gender=female&birthdate=ge2000-01-01"
+
+    sql_query = """
+        SELECT {} FROM Patient AS p
+        INNER JOIN Condition AS c ON c.subject = p._id
+        WHERE p.gender = 'female' AND c.code = 'covid'
+        """
+    query = build_query(sql_query.format("COUNT(DISTINCT p._id)"))
+    url = query._count_pushdown(query.aggregates["COUNT(DISTINCT p._id)"])[1]
+    assert "Patient?_has:Condition:subject:code=covid&gender=female" in url
+
+    # each patient may have several conditions
+    query = build_query(sql_query.format("COUNT(*)"))
+    url = query._count_pushdown(query.aggregates["COUNT(*)"])[1]
+    assert "Condition?subject:Patient.gender=female&code=covid" in url
+
+    # nothing ensures that the patients have a condition
+    query = build_query("""
+        SELECT COUNT(DISTINCT p._id) FROM Patient AS p
+        INNER JOIN Condition AS c ON c.subject = p._id
+        WHERE p.gender = 'female'
+        """)
+    assert query._count_pushdown(query.aggregates["COUNT(DISTINCT p._id)"]) == (None, None)
+
+
+def test_count():
+    query = build_query("SELECT COUNT(*), COUNT(DISTINCT p._id) FROM Patient AS p")
+    df = pd.DataFrame({"p:from_id": ["Patient/1", "Patient/1", "Patient/2"]})
+    assert query._count(df, query.aggregates["COUNT(*)"]) == 3
+    assert query._count(df, query.aggregates["COUNT(DISTINCT p._id)"]) == 2
+
+
+def test_sort_param():
+    query = build_query("""
+        SELECT p.gender, c.code FROM Patient AS p
+        INNER JOIN Condition AS c ON c.subject = p._id
+        ORDER BY p.birthdate DESC, p._lastUpdated
+        LIMIT 10
+        """)
+    assert query._driving_alias() == "p"
+    assert query._sort_param("p") == "-birthdate,_lastUpdated"
+    assert query._sort_param("c") is None
+    assert "_sort=-birthdate,_lastUpdated" in query._compute_url("p")
+
+    elements = query.graph_query.resources_by_alias["p"].elements.where(goal="order")
+    assert [element.fhirpath for element in elements] == [
+        "Patient.birthDate",
+        "Patient.meta.lastUpdated",
+    ]
+
+    # name.family is not a search parameter: the sort is done by the client
+    query = build_query("SELECT p.gender FROM Patient AS p ORDER BY p.name.family LIMIT 10")
+    assert query._sort_param("p") is None
+    df = pd.DataFrame({"p:order_name.family": [["b"], ["a"]], "p:from_id": ["1", "2"]})
+    assert list(query._sort(df)["p:from_id"]) == ["2", "1"]
+
+
+def test_group_count_pushdown(monkeypatch):
+    query = build_query(
+        "SELECT p.gender, COUNT(*) FROM Patient AS p WHERE p.birthdate = ge2000 GROUP BY p.gender"
+    )
+    urls = []
+
+    def get_count(self, url):
+        urls.append(url)
+        return 0 if "unknown" in url else 2
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_count", get_count)
+    df = query._group_count_pushdown()
+    assert len(urls) == 5
+    assert "Patient?birthdate=ge2000&gender=male" in urls[0]
+    assert "Patient?birthdate=ge2000&gender:missing=true" in urls[-1]
+    assert list(df.columns) == ["p:Patient.gender", "COUNT(*)"]
+    assert list(df["p:Patient.gender"]) == ["male", "female", "other", None]
+    assert list(df["COUNT(*)"]) == [2, 2, 2, 2]
+
+    # the values of name.family are unknown
+    query = build_query("SELECT COUNT(*) FROM Patient AS p GROUP BY p.name.family")
+    assert query._group_count_pushdown() is None
+
+
+def test_aggregate_split_url(monkeypatch):
+    patients = [
+        {"resourceType": "Patient", "id": str(i), "gender": ["male", "female"][i % 2]}
+        for i in range(1000)
+    ]
+
+    def get_response(self, url, entries=True):
+        ids = set(re.search(r"_id=([^&?]+)", url).group(1).split(","))
+        # the patient 0 matches all the searches the url is split into
+        matching = [patient for patient in patients if patient["id"] in ids or patient["id"] == "0"]
+        if "_summary=count" in url:
+            return Response(total=len(matching))
+        return Response(results=[{"resource": patient} for patient in matching])
+
+    updates = []
+    update = GroupByAggregator.update
+
+    def update_pages(self, df):
+        updates.append(len(df))
+        update(self, df)
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+    monkeypatch.setattr(GroupByAggregator, "update", update_pages)
+    ids = ", ".join(f"'{i}'" for i in range(1000))
+    query = Query().from_config(Parser().from_sql(f"""
+        SELECT p.gender, COUNT(*), MAX(p._id) FROM Patient AS p
+        WHERE p._id IN ({ids}) GROUP BY p.gender
+        """))
+    df = query.execute()
+    assert dict(zip(df["p:Patient.gender"], df["COUNT(*)"])) == {"male": 500, "female": 500}
+    # the pages of each search are aggregated as they are retrieved
+    assert len(updates) > 1 and sum(updates) == 1000
+
+
+@pytest.mark.parametrize(
+    "options, message",
+    [
+        ({"resume": True}, "checkpoint_dir"),
+        ({"bulk_dir": "export", "store": "store"}, "bulk_dir and store"),
+        ({"bulk_dir": "export", "patient_everything": True}, "patient_everything"),
+        ({"store": "store", "patient_everything": True}, "patient_everything"),
+        ({"bulk_dir": "export", "state_dir": "states"}, "state_dir"),
+        ({"store": "store", "checkpoint_dir": "pages"}, "checkpoint_dir"),
+    ],
+)
+def test_incompatible_options(options, message):
+    with pytest.raises(ValueError, match=message):
+        Query(**options)
+
+
+def test_residual_conditions():
+    query = build_query("""
+        SELECT p.gender FROM Patient AS p
+        INNER JOIN Condition AS c ON c.subject = p._id
+        WHERE p.gender = 'female' AND p.name.family IN ('Chopin', 'Liszt') AND c.code = 'covid'
+        """)
+    # name.family isn't a searchparam: it is not sent to the API
+    assert query._compute_url("p").endswith(
+        "Patient?_has:Condition:subject:code=covid&gender=female"
+    )
+    assert "name.family" not in query._compute_url("c")
+
+    df = pd.DataFrame(
+        {
+            "from_id": ["1", "2", "3"],
+            "where_name.family": [["Chopin", "Frederic"], "Mozart", None],
+        }
+    )
+    assert list(query._filter_residuals("p", df)["from_id"]) == ["1"]
+    assert query._residual_filter("c") is None
+
+    report = query.predicate_report().set_index("condition")
+    assert report.loc["name.family=Chopin,Liszt", "applied_by"] == "client"
+    assert report.loc["gender=female", "applied_by"] == "server"
+    assert report.loc["gender=female", "searches"] == ["p", "c"]
+
+
+def test_empty_short_circuit(monkeypatch):
+    query = Query().from_config(Parser().from_sql("""
+            SELECT p.gender, c.code FROM Patient AS p
+            INNER JOIN Condition AS c ON c.subject = p._id
+            WHERE c.code = 'unknown'
+            """))
+
+    def get_count(self, url):
+        return 0 if "/Condition?" in url else 1000
+
+    def get_response(self, url, entries=True):
+        raise AssertionError(f"{url} shouldn't be requested")
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_count", get_count)
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+    df = query.execute()
+    assert df.empty
+    assert {"p:Patient.gender", "c:Condition.code"} <= set(df.columns)
+
+
+def test_join_guard():
+    query = build_query("""
+        SELECT e.status, p.gender FROM Encounter AS e
+        INNER JOIN Practitioner AS p ON e.participant = p._id
+        """)
+    query.dataframes = {
+        "e": pd.DataFrame(
+            {
+                "e:from_id": ["Encounter/1", "Encounter/2"],
+                "e:join_participant": [["Practitioner/1", "Practitioner/2"], "Practitioner/1"],
+            }
+        ),
+        "p": pd.DataFrame({"p:from_id": ["Practitioner/1", "Practitioner/2", "Practitioner/3"]}),
+    }
+    rows, memory = query._estimate_join()
+    assert rows == len(query._join()) == 3
+    assert memory > 0
+
+    query.max_join_rows = 2
+    assert query._guard_joins()
+    query.join_guard = "raise"
+    with pytest.raises(ValueError):
+        query._guard_joins()
+    query.join_guard = "normalize"
+    assert not query._guard_joins()
+
+    with pytest.raises(ValueError):
+        Query(join_guard="abort")
+
+
+def test_normalized_output():
+    query = build_query("""
+        SELECT p.gender, o.value FROM Observation AS o
+        INNER JOIN Patient AS p ON o.subject = p._id
+        """)
+    query.dataframes = {
+        "p": pd.DataFrame({"from_id": ["1", "2"], "Patient.gender": [["female"], "male"]}),
+        "o": pd.DataFrame(
+            {
+                "from_id": ["a", "b", "c"],
+                "Observation.value": [1, 2, 3],
+                "join_subject": ["Patient/1", "Patient/1", "Patient/2"],
+            }
+        ),
+    }
+    result = query._process(output="normalized")
+    assert list(result.tables["p"]["p:Patient.gender"]) == ["female", "male"]
+    assert len(result.tables["o"]) == 3
+    assert result.links["o", "p"].to_dict("list") == {
+        "o:from_id": ["Observation/a", "Observation/b", "Observation/c"],
+        "p:from_id": ["Patient/1", "Patient/1", "Patient/2"],
+    }
+
+    df = result.flatten()
+    assert result.flatten() is df
+    assert len(df) == 3
+    assert list(df.sort_values("o:from_id")["p:Patient.gender"]) == ["female", "female", "male"]
+
+
+def test_infer_types():
+    query = build_query("""
+        SELECT p.birthDate, p.active, p.gender, o.valueQuantity.value FROM Observation AS o
+        INNER JOIN Patient AS p ON o.subject = p._id
+        """)
+    assert query._value_types() == {
+        "p:Patient.birthDate": "date",
+        "p:Patient.active": "boolean",
+        "o:Observation.valueQuantity.value": "number",
+    }
+
+    query.infer_types = True
+    query.dataframes = {
+        "p": pd.DataFrame(
+            {
+                "from_id": ["1", "2"],
+                "Patient.birthDate": [["1970-01-01"], "2001-05"],
+                "Patient.active": [True, None],
+                "Patient.gender": ["female", "male"],
+            }
+        ),
+        "o": pd.DataFrame(
+            {
+                "from_id": ["a", "b"],
+                "Observation.valueQuantity.value": [1.5, [2]],
+                "join_subject": ["Patient/1", "Patient/2"],
+            }
+        ),
+    }
+    df = query._process().sort_values("o:from_id")
+    assert df["p:Patient.birthDate"].dtype == "datetime64[ns]"
+    assert list(df["p:Patient.birthDate"]) == [pd.Timestamp("1970-01-01"), pd.Timestamp("2001-05")]
+    assert df["p:Patient.active"].dtype == "boolean"
+    assert list(df["o:Observation.valueQuantity.value"]) == [1.5, 2.0]
+    assert df["p:Patient.gender"].dtype == object
+
+
+def test_concat_types():
+    query = Query(concat_type="row").from_config(
+        {
+            "from": {"p": "Patient"},
+            "select": {"p": ["name.given", "name.family"]},
+            "concat": {"p": {"name.given": "col"}},
+        }
+    )
+    query._build_graph_query()
+    elements = query.graph_query.resources_by_alias["p"].elements.where(goal="select")
+    assert [element.concat_type for element in elements] == ["row", "col", "row"]
+
+    query.dataframes = {
+        "p": pd.DataFrame(
+            {
+                "from_id": ["1", "1", "2"],
+                "name.given_0": ["Jean", "Jean", "Anne"],
+                "name.given_1": ["Paul", "Paul", None],
+                "name.family": ["Dupont", "Martin", "Durand"],
+            }
+        )
+    }
+    df = query._process()
+    assert list(df.columns) == [
+        "p:from_id",
+        "p:name.given_0",
+        "p:name.given_1",
+        "p:name.family",
+    ]
+    assert len(df) == 3
+
+    with pytest.raises(ValueError):
+        Query(concat_type="product")
+
+
+def test_batch_counts(monkeypatch):
+    query = build_query("SELECT COUNT(*) FROM Patient AS p GROUP BY p.gender")
+    query.batch_requests = True
+    batches = []
+
+    def get_batch_counts(self, urls, max_batch_size):
+        batches.append(urls)
+        return [1] * len(urls)
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_batch_counts", get_batch_counts)
+    assert list(query._group_count_pushdown()["COUNT(*)"]) == [1] * 5
+    assert len(batches) == 1 and len(batches[0]) == 5
+
+    def reject_batch(self, urls, max_batch_size):
+        raise ValueError("batches are not supported")
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_batch_counts", reject_batch)
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_count", lambda self, url: 2)
+    assert query._get_counts(["http://fhir/Patient", "http://fhir/Condition"]) == [2, 2]
+    assert not query.batch_requests
+
+
+def test_patient_everything(monkeypatch):
+    query = Query(patient_everything=True).from_config(Parser().from_sql("""
+            SELECT p.gender, e.status, pr.gender FROM Patient AS p
+            INNER JOIN Encounter AS e ON e.subject = p._id
+            INNER JOIN Practitioner AS pr ON e.participant = pr._id
+            WHERE p.gender = 'female'
+            """))
+    practitioner = {"resourceType": "Practitioner", "id": "pr", "gender": "male"}
+    everything = {
+        patient_id: [
+            {"resourceType": "Patient", "id": patient_id, "gender": "female"},
+            {
+                "resourceType": "Encounter",
+                "id": f"e{patient_id}",
+                "status": "finished",
+                "subject": {"reference": f"Patient/{patient_id}"},
+                "participant": [{"individual": {"reference": "Practitioner/pr"}}],
+            },
+            practitioner,
+        ]
+        for patient_id in ["1", "2"]
+    }
+    requested = []
+
+    def get_response(self, url, entries=True):
+        requested.append(url)
+        if "_summary=count" in url:
+            return Response(total=2)
+        if "$everything" in url:
+            patient_id = url.split("/Patient/")[1].split("/")[0]
+            resources = everything[patient_id]
+        else:
+            assert "/Patient?gender=female" in url
+            resources = [everything[patient_id][0] for patient_id in everything]
+        return Response(results=[{"resource": resource} for resource in resources])
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+    df = query.execute()
+    assert not any("/Encounter?" in url or "/Practitioner?" in url for url in requested)
+    assert sorted(df["e:from_id"]) == ["Encounter/e1", "Encounter/e2"]
+    assert list(df["pr:Practitioner.gender"]) == ["male", "male"]
+    assert len(query.dataframes["pr"]) == 1
+
+    # a condition on a searchparam of the encounters needs a search
+    query = build_query("""
+        SELECT p.gender FROM Patient AS p
+        INNER JOIN Encounter AS e ON e.subject = p._id
+        WHERE e.status = 'finished'
+        """)
+    query.patient_everything = True
+    assert query._everything_alias() is None
+
+
+def test_incremental_refresh(monkeypatch, tmp_path):
+    sql_query = """
+        SELECT p.gender, e.status FROM Patient AS p
+        INNER JOIN Encounter AS e ON e.subject = p._id
+        WHERE p.gender = 'female'
+        """
+    server = {
+        "Patient": [
+            {"resourceType": "Patient", "id": "1", "gender": "female"},
+            {"resourceType": "Patient", "id": "2", "gender": "female"},
+        ],
+        "Encounter": [
+            {
+                "resourceType": "Encounter",
+                "id": f"e{patient_id}",
+                "status": "finished",
+                "subject": {"reference": f"Patient/{patient_id}"},
+            }
+            for patient_id in ["1", "2"]
+        ],
+    }
+    deleted = []
+    requested = []
+
+    def update(resource, instant):
+        resource["meta"] = {"lastUpdated": instant}
+        return resource
+
+    for resources in server.values():
+        for resource in resources:
+            update(resource, "2021-01-01T10:00:00+01:00")
+
+    def get_response(self, url, entries=True):
+        requested.append(url)
+        if "_summary=count" in url:
+            return Response(total=2)
+        resource_type = url.split("/")[-1].split("?")[0]
+        if resource_type == "_history":
+            return Response(
+                results=[
+                    {"request": {"method": "DELETE", "url": f"Encounter/{resource_id}/_history/2"}}
+                    for resource_id in deleted
+                ]
+            )
+        resources = server[resource_type]
+        if "gender=female" in url:
+            resources = [resource for resource in resources if resource["gender"] == "female"]
+        if "_lastUpdated=gt" in url:
+            since = pd.Timestamp(re.split("[&?]", url.split("_lastUpdated=gt")[1])[0])
+            resources = [
+                resource
+                for resource in resources
+                if pd.Timestamp(resource["meta"]["lastUpdated"]) > since
+            ]
+        return Response(results=[{"resource": resource} for resource in resources])
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+
+    def execute(**options):
+        requested.clear()
+        query = Query(state_dir=str(tmp_path), **options)
+        query.from_config(Parser().from_sql(sql_query))
+        return query, query.execute()
+
+    query, df = execute()
+    assert sorted(df["e:from_id"]) == ["Encounter/e1", "Encounter/e2"]
+    assert "p:_lastUpdated" not in df.columns
+    # the urls of an alias don't depend on the conditions of the other aliases
+    assert not any("subject" in url for url in requested)
+    assert query._state.watermarks == {
+        "p": "2021-01-01T09:00:00.000Z",
+        "e": "2021-01-01T09:00:00.000Z",
+    }
+
+    # nothing changed: the result of the last execution is reused
+    query, df = execute()
+    assert not query._state.changed
+    assert all("2021-01-01T09:00:00.000Z" in url for url in requested)
+    assert sorted(df["e:from_id"]) == ["Encounter/e1", "Encounter/e2"]
+
+    # a patient no longer respects the conditions and an encounter is deleted
+    update(server["Patient"][1], "2021-02-01T00:00:00Z")["gender"] = "male"
+    server["Encounter"].append(
+        update(
+            {
+                "resourceType": "Encounter",
+                "id": "e3",
+                "status": "planned",
+                "subject": {"reference": "Patient/1"},
+            },
+            "2021-02-01T00:00:00Z",
+        )
+    )
+    server["Encounter"] = [resource for resource in server["Encounter"] if resource["id"] != "e1"]
+    deleted.append("e1")
+    query, df = execute()
+    assert query._state.changed
+    assert list(df["e:from_id"]) == ["Encounter/e3"]
+    assert list(query.dataframes["p"]["p:from_id"]) == ["Patient/1"]
+    assert query._state.watermarks["p"] == "2021-02-01T00:00:00.000Z"
+
+    # an update not matching the query moves the watermark forward, the result is unchanged
+    server["Patient"].append(
+        update({"resourceType": "Patient", "id": "3", "gender": "male"}, "2021-03-01T00:00:00Z")
+    )
+    query, df = execute()
+    assert not query._state.changed
+    query, df = execute()
+    assert all("2021-03-01T00:00:00.000Z" in url for url in requested if "/Patient" in url)
+    assert list(df["e:from_id"]) == ["Encounter/e3"]
+
+    # the state of the query is not reused with options changing its result
+    query, df = execute(infer_types=True)
+    assert query._state.changed
+    assert not any("_lastUpdated=gt" in url for url in requested)
+
+
+@pytest.mark.parametrize(
+    "sql_query",
+    [
+        "SELECT p.gender FROM Patient AS p WHERE p.gender = 'female'",
+        "SELECT COUNT(*), MIN(p._id) FROM Patient AS p WHERE p.gender = 'female'",
+    ],
+)
+def test_resume_checkpoints(monkeypatch, tmp_path, sql_query):
+    requested = []
+    failing = [True]
+
+    def get_response(self, url, entries=True):
+        requested.append(url)
+        if "_summary=count" in url:
+            return Response(total=200)
+        page = int(re.search(r"page=(\d+)", url).group(1)) if "page=" in url else 0
+        if page == 1 and failing[0]:
+            raise ValueError("network error")
+        return Response(
+            results=[
+                {"resource": {"resourceType": "Patient", "id": f"{page}-{index}"}}
+                for index in range(100)
+            ],
+            next_url=f"http://fhir/Patient?page={page + 1}" if page == 0 else None,
+        )
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+    monkeypatch.setattr("fhir2dataset.checkpoint.CHECKPOINT_PAGES", 1)
+
+    def execute(resume):
+        requested.clear()
+        query = Query(checkpoint_dir=str(tmp_path), resume=resume)
+        return query.from_config(Parser().from_sql(sql_query)).execute()
+
+    with pytest.raises(ValueError):
+        execute(resume=False)
+
+    # the first page is stored, only the second page is requested
+    failing[0] = False
+    df = execute(resume=True)
+    assert (df["COUNT(*)"][0] if "COUNT(*)" in df.columns else len(df)) == 200
+    assert [url for url in requested if "page=" in url] == requested[1:]
+    # the checkpoints are removed once all the resources are retrieved
+    assert list(tmp_path.iterdir()) == []
+
+    # without resume, the searches start over
+    failing[0] = True
+    with pytest.raises(ValueError):
+        execute(resume=False)
+    failing[0] = False
+    execute(resume=False)
+    assert any("page=" not in url and "_summary" not in url for url in requested)
+
+
+def test_clean_columns():
+    query = build_query("SELECT p.gender FROM Patient AS p")
+    retrieved = pd.DataFrame({"from_id": ["1", "2"], "Patient.gender": ["female", "male"]})
+    query.dataframes["p"] = retrieved
+    query._clean_columns()
+
+    df = query.dataframes["p"]
+    assert list(df.columns) == ["p:from_id", "p:Patient.gender"]
+    assert df["p:from_id"].dtype == "category"
+    assert list(df["p:from_id"]) == ["Patient/1", "Patient/2"]
+    # the dataframe retrieved is unchanged
+    assert list(retrieved.columns) == ["from_id", "Patient.gender"]
+    assert list(retrieved["from_id"]) == ["1", "2"]
+
+
+def test_semi_join_limit(monkeypatch):
+    # only the patients 6 to 9 have encounters
+    patients = [{"resourceType": "Patient", "id": str(i), "gender": "female"} for i in range(10)]
+    encounters = [
+        {"resourceType": "Encounter", "id": f"e{i}", "subject": {"reference": f"Patient/{i}"}}
+        for i in range(6, 10)
+    ]
+
+    def get_response(self, url, entries=True):
+        if "/Patient" in url:
+            resources = patients
+        else:
+            subjects = re.search(r"subject=([^&?]+)", url).group(1).split(",")
+            resources = [
+                resource for resource in encounters if resource["subject"]["reference"] in subjects
+            ]
+        if "_summary=count" in url:
+            return Response(total=len(resources))
+        count = int(re.search(r"_count=(\d+)", url).group(1))
+        return Response(results=[{"resource": resource} for resource in resources[:count]])
+
+    monkeypatch.setattr("fhir2dataset.api.ApiCall._get_response", get_response)
+    query = build_query("""
+        SELECT p.gender, e.status FROM Patient AS p
+        INNER JOIN Encounter AS e ON e.subject = p._id
+        LIMIT 3
+        """)
+    assert query._driving_alias() == "p"
+    df = query.execute()
+    assert sorted(df["e:from_id"]) == ["Encounter/e6", "Encounter/e7", "Encounter/e8"]
+    # the first 3 and then the first 6 patients have less than 3 encounters
+    assert len(query.dataframes["p"]) == 10
@@ -0,0 +1,177 @@
+import json
+
+import pytest
+
+from fhir2dataset.data_class import SearchParameter
+from fhir2dataset.parser import Parser
+from fhir2dataset.query import Query
+from fhir2dataset.store import LocalStore, compile_fhirpath, date_bounds
+
+DISPLAYS = {"29463-7": "Body weight", "8302-2": "Body height"}
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path):
+    patients = [
+        {
+            "resourceType": "Patient",
+            "id": "1",
+            "name": [{"family": "Chopin", "given": ["Frédéric"]}],
+            "birthDate": "1810-03-01",
+            "gender": "male",
+        },
+        {
+            "resourceType": "Patient",
+            "id": "2",
+            "name": [{"family": "Sand", "given": ["George"]}],
+            "birthDate": "1804-07-01",
+            "gender": "female",
+        },
+    ]
+    (tmp_path / "Patient.ndjson").write_text("\n".join(json.dumps(p) for p in patients) + "\n")
+    observations = [
+        {
+            "resourceType": "Observation",
+            "id": f"o{i}",
+            "status": "final",
+            "code": {
+                "coding": [{"system": "http://loinc.org", "code": code, "display": DISPLAYS[code]}]
+            },
+            "subject": {"reference": f"Patient/{patient_id}"},
+            "effectiveDateTime": effective,
+            "valueQuantity": {"value": value, "unit": "kg"},
+        }
+        for i, (code, patient_id, effective, value) in enumerate(
+            [
+                ("29463-7", "1", "1830-01-01T10:00:00+01:00", 50),
+                ("29463-7", "2", "1840-06-01T10:00:00Z", 60),
+                ("8302-2", "2", "1840-06-01", 160),
+            ]
+        )
+    ]
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [{"resource": observation} for observation in observations],
+    }
+    (tmp_path / "observations.json").write_text(json.dumps(bundle))
+    return tmp_path
+
+
+def test_date_bounds():
+    assert date_bounds("1976") == ("1976-01-01T00:00:00.000", "1976-12-31T23:59:59.999")
+    assert date_bounds("1976-02") == ("1976-02-01T00:00:00.000", "1976-02-29T23:59:59.999")
+    assert date_bounds("2000-01-01T10:00:00+01:00") == (
+        "2000-01-01T09:00:00.000",
+        "2000-01-01T09:00:01.000",
+    )
+    assert date_bounds("unknown") is None
+
+
+def test_compile_fhirpath():
+    assert compile_fhirpath(
+        "(Observation.value as Quantity) | Observation.subject.where(resolve() is Patient)"
+    ) == [["valueQuantity"], ["subject"]]
+    assert compile_fhirpath("Patient.telecom.where(system='phone')") == []
+
+
+@pytest.mark.parametrize(
+    "resource_type, code, value, prefix, expected",
+    [
+        ("Patient", "family", "CHOP", None, ["1"]),
+        ("Patient", "given", "frederic", None, ["1"]),
+        ("Patient", "gender", "male,female", None, ["1", "2"]),
+        ("Patient", "birthdate", "1810", None, ["1"]),
+        ("Patient", "birthdate", "ge1805", None, ["1"]),
+        ("Patient", "birthdate", "1805", "lt", ["2"]),
+        ("Patient", "_id", "2", None, ["2"]),
+        ("Observation", "code", "http://loinc.org|29463-7", None, ["o0", "o1"]),
+        ("Observation", "code", "http://snomed.info/sct|29463-7", None, []),
+        ("Observation", "subject", "Patient/2", None, ["o1", "o2"]),
+        ("Observation", "patient", "1", None, ["o0"]),
+        ("Observation", "date", "1830-01-01", None, ["o0"]),
+        ("Observation", "value-quantity", "gt55", None, ["o1", "o2"]),
+    ],
+)
+def test_local_store_search(snapshot_dir, tmp_path, resource_type, code, value, prefix, expected):
+    store = LocalStore(str(snapshot_dir), index_path=str(tmp_path / "index.sqlite"))
+    assert store.is_indexed(resource_type, code)
+    condition = SearchParameter(code=code, value=value, prefix=prefix)
+    assert store.search(resource_type, [condition]) == expected
+
+
+def test_local_store_index(snapshot_dir, tmp_path, monkeypatch):
+    index_path = str(tmp_path / "index.sqlite")
+    store = LocalStore(str(snapshot_dir), index_path=index_path)
+    assert [resource["id"] for resource in store.resources("Observation", limit=2)] == [
+        "o0",
+        "o1",
+    ]
+    assert not store.is_indexed("Patient", "family:exact")
+
+    # the index is persistent, it is only rebuilt when the files change
+    def build(self):
+        raise AssertionError("the index is rebuilt")
+
+    monkeypatch.setattr("fhir2dataset.store.LocalStore.build", build)
+    assert LocalStore(str(snapshot_dir), index_path=index_path).search("Patient") == ["1", "2"]
+    (snapshot_dir / "Patient.ndjson").write_text("")
+    with pytest.raises(AssertionError):
+        LocalStore(str(snapshot_dir), index_path=index_path)
+
+
+def test_query_store(snapshot_dir, tmp_path):
+    store = LocalStore(str(snapshot_dir), index_path=str(tmp_path / "index.sqlite"))
+    query = Query(store=store).from_config(Parser().from_sql("""
+            SELECT p.name.family, o.valueQuantity.value FROM Observation AS o
+            INNER JOIN Patient AS p ON o.subject = p._id
+            WHERE o.code = 'http://loinc.org|29463-7' AND p.name.given = 'George'
+            """))
+    df = query.execute()
+    assert list(df["o:Observation.valueQuantity.value"]) == [60]
+    assert list(query.predicate_report()["applied_by"]) == ["index", "client"]
+
+
+@pytest.mark.parametrize(
+    "condition, expected",
+    [
+        ("o.code:not = '29463-7'", ["o2"]),
+        ("o.code:text = 'body w'", ["o0", "o1"]),
+        ("o.subject:Patient = '2'", ["o1", "o2"]),
+        ("o.subject:missing = 'true'", []),
+        ("o.code = '8302-2' AND o.subject:missing = 'false'", ["o2"]),
+    ],
+)
+def test_query_store_modifiers(snapshot_dir, tmp_path, condition, expected):
+    store = LocalStore(str(snapshot_dir), index_path=str(tmp_path / "index.sqlite"))
+    query = Query(store=store).from_config(
+        Parser().from_sql(f"SELECT o.status FROM Observation AS o WHERE {condition}")
+    )
+    df = query.execute()
+    assert list(df["o:from_id"]) == [f"Observation/{id}" for id in expected]
+    assert "client" in list(query.predicate_report()["applied_by"])
+
+
+@pytest.mark.parametrize(
+    "condition, expected",
+    [
+        ("p.family:exact = 'Chopin'", ["1"]),
+        ("p.family:exact = 'chopin'", []),
+        ("p.name:contains = 'EORG'", ["2"]),
+    ],
+)
+def test_query_store_string_modifiers(snapshot_dir, tmp_path, condition, expected):
+    store = LocalStore(str(snapshot_dir), index_path=str(tmp_path / "index.sqlite"))
+    query = Query(store=store).from_config(
+        Parser().from_sql(f"SELECT p.gender FROM Patient AS p WHERE {condition}")
+    )
+    assert list(query.execute()["p:from_id"]) == [f"Patient/{id}" for id in expected]
+
+
+def test_query_store_unsupported_modifier(snapshot_dir, tmp_path):
+    store = LocalStore(str(snapshot_dir), index_path=str(tmp_path / "index.sqlite"))
+    query = Query(store=store).from_config(
+        Parser().from_sql("SELECT o.status FROM Observation AS o WHERE o.code:below = '29463'")
+    )
+    with pytest.raises(ValueError, match=":below"):
+        query.execute()
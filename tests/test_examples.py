@@ -5,36 +5,22 @@ import os
 import pytest
 
 from fhir2dataset.query import Query
+from fhir2dataset.store import LocalStore
 from tests.tools import create_resource_test
 
 log_format = "[%(asctime)s] [%(levelname)s] - %(message)s"
 logging.basicConfig(level=logging.INFO, format=log_format)
 
 
-@pytest.mark.parametrize(
-    "dirname, fhir_api_url",
-    [
-        ("tests/1", "http://hapi.fhir.org/baseR4/"),
-        # ("tests/2", "http://hapi.fhir.org/baseR4/"),
-        ("tests/3", "http://hapi.fhir.org/baseR4/"),
-        # ("tests/4", "http://hapi.fhir.org/baseR4/"),
-        ("tests/5", "http://hapi.fhir.org/baseR4/"),
-    ],
-)
-def test_resources_in_dataframe(dirname, fhir_api_url):
-    create_resource_test(dirname, fhir_api_url)
-    with open(os.path.join(dirname, "config.json")) as json_file:
-        config = json.load(json_file)
+EXAMPLES = ["tests/1", "tests/3", "tests/5"]
+
+
+def check_lines(dirname, df):
     with open(os.path.join(dirname, "infos_test", "config_checks.json")) as json_file:
         checks = json.load(json_file)
     with open(os.path.join(dirname, "infos_test", "info_hapi.json")) as json_file:
         info_hapi = json.load(json_file)
 
-    query = Query(fhir_api_url)
-    query.from_config(config)
-    query.execute(debug=True)
-    df = query.main_dataframe
-
     lines = checks["line"]
     for line in lines:
         cols = []
@@ -49,3 +35,40 @@ def test_resources_in_dataframe(dirname, fhir_api_url):
         result = df[eval(condition)]
         logging.info(result)
         assert len(result.index) >= 1, f"{dirname} failed"
+
+
+@pytest.mark.parametrize(
+    "dirname, fhir_api_url",
+    [
+        ("tests/1", "http://hapi.fhir.org/baseR4/"),
+        # ("tests/2", "http://hapi.fhir.org/baseR4/"),
+        ("tests/3", "http://hapi.fhir.org/baseR4/"),
+        # ("tests/4", "http://hapi.fhir.org/baseR4/"),
+        ("tests/5", "http://hapi.fhir.org/baseR4/"),
+    ],
+)
+def test_resources_in_dataframe(dirname, fhir_api_url):
+    create_resource_test(dirname, fhir_api_url)
+    with open(os.path.join(dirname, "config.json")) as json_file:
+        config = json.load(json_file)
+
+    query = Query(fhir_api_url)
+    query.from_config(config)
+    query.execute(debug=True)
+    check_lines(dirname, query.main_dataframe)
+
+
+@pytest.mark.parametrize("dirname", EXAMPLES)
+def test_resources_in_dataframe_offline(dirname, tmp_path):
+    # the resources of the example are read from a local store instead of a FHIR server
+    store = LocalStore(
+        os.path.join(dirname, "resources"), index_path=str(tmp_path / "index.sqlite")
+    )
+    with open(os.path.join(dirname, "config.json")) as json_file:
+        config = json.load(json_file)
+
+    query = Query(store=store)
+    query.from_config(config)
+    query.execute(debug=True)
+    assert set(query.predicate_report()["applied_by"]) == {"index"}
+    check_lines(dirname, query.main_dataframe)
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+from fhir2dataset.tools.dataframe import (
+    ReferenceCodes,
+    compact_dtypes,
+    condition_mask,
+    drop_duplicate_resources,
+    expand_columns,
+    explode_rows,
+    first_value,
+    sort_dataframe,
+    unlist_column,
+    upsert_resources,
+)
+
+
+def test_first_value():
+    assert first_value([["a", "b"], "c"]) == "a"
+    assert first_value([]) is None
+    assert first_value("a") == "a"
+
+
+def test_sort_dataframe():
+    df = pd.DataFrame(
+        {
+            "birthdate": [["2001-01-01"], "1999-01-01", None, ["2000-01-01", "1900-01-01"]],
+            "id": ["1", "2", "3", "4"],
+        }
+    )
+    sorted_df = sort_dataframe(df, ["birthdate"], [True])
+    assert list(sorted_df["id"]) == ["2", "4", "1", "3"]
+
+    sorted_df = sort_dataframe(df, ["birthdate"], [False], limit=2)
+    assert list(sorted_df["id"]) == ["1", "4"]
+
+
+def test_condition_mask():
+    column = pd.Series([["a", "b"], "c", None, []])
+    assert condition_mask(column, ["b", "c"]).tolist() == [True, True, False, False]
+
+    column = pd.Series([[1, 5], "3", None, 10])
+    assert condition_mask(column, "4", prefix="gt").tolist() == [True, False, False, True]
+    assert condition_mask(column, [{"lt": "2"}, {"ge": "10"}]).tolist() == [
+        True,
+        False,
+        False,
+        True,
+    ]
+
+    column = pd.Series(["2000-01-01", "1990-02-02"])
+    assert condition_mask(column, "1995", prefix="ge").tolist() == [True, False]
+    assert condition_mask(column, "ge1995").tolist() == [True, False]
+
+
+def test_unlist_column():
+    column = pd.Series([[["a"]], ["b", "c"], "d", [], [{"e": 1}], None])
+    assert unlist_column(column).tolist() == ["a", ["b", "c"], "d", [], {"e": 1}, None]
+
+    column = pd.Series([["a", "b"], "c"])
+    assert unlist_column(column) is column
+
+
+def test_upsert_resources():
+    df = pd.DataFrame({"from_id": ["1", "2", "3"], "status": ["planned", "planned", "finished"]})
+    updated = pd.DataFrame({"from_id": ["2", "4"], "status": ["finished", "planned"]})
+    df = upsert_resources(df, updated, removed_ids=["3", "5"])
+    assert list(df["from_id"]) == ["1", "2", "4"]
+    assert list(df["status"]) == ["planned", "finished", "planned"]
+
+
+def test_compact_dtypes():
+    df = pd.DataFrame(
+        {
+            "gender": ["female", "male", None] * 100,
+            "id": [f"Patient/{index}" for index in range(300)],
+            "name": [["a"]] * 300,
+        }
+    )
+    memory = df.memory_usage(deep=True).sum()
+    df = compact_dtypes(df)
+
+    assert df["gender"].dtype == "category"
+    assert df["gender"].isna().sum() == 100
+    assert df["id"].dtype == object
+    assert df["name"].dtype == object
+    assert df.memory_usage(deep=True).sum() < memory
+
+
+def test_reference_codes():
+    codes = ReferenceCodes()
+    parent = codes.encode(pd.Series(["Patient/1", "Patient/2", np.nan, "Patient/1"]))
+    child = codes.encode(pd.Series(["Patient/2", "Patient/3"]))
+
+    assert list(parent) == [0, 1, -1, 0]
+    assert list(child) == [1, 2]
+    assert list(codes.references) == ["Patient/1", "Patient/2", "Patient/3"]
+
+
+def test_explode_rows():
+    df = pd.DataFrame({"id": [1, 2, 3], "name": [["a", ["b"]], None, []], "x": [[1, 2], 3, None]})
+    df = explode_rows(explode_rows(df, "name"), "x")
+    assert df.to_dict("list") == {
+        "id": [1, 1, 1, 1, 2, 3],
+        "name": ["a", "a", "b", "b", None, None],
+        "x": [1, 2, 1, 2, 3, None],
+    }
+
+
+def test_expand_columns():
+    df = pd.DataFrame({"x": [[1, [2]], 3, None], "id": [1, 2, 3]})
+    assert expand_columns(df, "x").to_dict("list") == {
+        "x_0": [1, 3, None],
+        "x_1": [2, None, None],
+        "id": [1, 2, 3],
+    }
+    assert list(expand_columns(df.iloc[:0], "x").columns) == ["id"]
+
+
+def test_drop_duplicate_resources():
+    df = drop_duplicate_resources(
+        [
+            pd.DataFrame({"from_id": ["1", "1", "2"], "name": ["a", "b", "c"]}),
+            pd.DataFrame({"from_id": ["2", "3"], "name": ["d", "e"]}),
+        ]
+    )
+    assert df.to_dict("list") == {"from_id": ["1", "1", "2", "3"], "name": ["a", "b", "c", "e"]}
@@ -0,0 +1,72 @@
+from fhir2dataset.parser import Parser
+from fhir2dataset.query import Query
+from fhir2dataset.url_builder import add_url_param, split_url
+
+
+def test_or_values():
+    query = Query().from_config(Parser().from_sql("""
+            SELECT p.gender FROM Patient AS p
+            WHERE p.gender IN ('female', 'other') AND (p.birthdate ge 2000 OR p.birthdate lt 1900)
+            """))
+    query._build_graph_query()
+    assert query._compute_url("p").endswith("Patient?gender=female,other&birthdate=ge2000,lt1900")
+
+    query = Query().from_config(
+        Parser().from_sql("SELECT p.gender FROM Patient AS p WHERE p.name IN ('Tom, Jerry', 'Max')")
+    )
+    query._build_graph_query()
+    assert query._compute_url("p").endswith(r"Patient?name=Tom\, Jerry,Max")
+
+
+def test_split_url():
+    url = "Patient?gender=female?code=aaaa,bbbb,cc?x=1"
+    assert split_url(url) == [url]
+    assert split_url(url, max_length=38) == [
+        "Patient?gender=female&code=aaaa&x=1",
+        "Patient?gender=female&code=bbbb,cc&x=1",
+    ]
+
+    # the parameters controlling the results and the escaped commas are not split
+    url = r"Patient?name=a\,b,c&_elements=gender,birthDate,name"
+    assert split_url(url, max_length=45) == [
+        r"Patient?name=a\,b&_elements=gender,birthDate,name",
+        "Patient?name=c&_elements=gender,birthDate,name",
+    ]
+    url = "Patient?gender=female&_sort=birthdate,name,address"
+    assert split_url(url, max_length=20) == [url]
+
+    ids = [str(i) for i in range(1000)]
+    urls = split_url(f"Patient?_id={','.join(ids)}", max_length=200)
+    assert all(len(url) <= 200 for url in urls)
+    assert [i for url in urls for i in url.split("=")[1].split(",")] == ids
+
+
+def test_multi_hop_pushdown():
+    sql_query = """
+        SELECT o.code FROM Observation AS o
+        INNER JOIN Encounter AS e ON o.encounter = e._id
+        INNER JOIN Patient AS p ON e.subject = p._id
+        WHERE p.gender = 'female' AND o.code = 'covid'
+        """
+    query = Query().from_config(Parser().from_sql(sql_query))
+    query._build_graph_query()
+    assert query._compute_url("o").endswith(
+        "Observation?encounter:Encounter.subject:Patient.gender=female&code=covid"
+    )
+    assert query._compute_url("p").endswith(
+        "Patient?_has:Encounter:subject:_has:Observation:encounter:code=covid&gender=female"
+    )
+    url = query._compute_url("e")
+    assert "subject:Patient.gender=female" in url
+    assert "_has:Observation:encounter:code=covid" in url
+
+    query.fhir_rules.max_chain_depth = 1
+    assert query._compute_url("o").endswith("Observation?code=covid")
+
+
+def test_add_url_param():
+    assert add_url_param("http://fhir/Patient", "_count", "1") == "http://fhir/Patient?_count=1"
+    assert (
+        add_url_param("http://fhir/Patient?gender=female", "_lastUpdated", "lt2021-01-01T10:00Z")
+        == "http://fhir/Patient?gender=female&_lastUpdated=lt2021-01-01T10:00Z"
+    )